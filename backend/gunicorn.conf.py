@@ -0,0 +1,31 @@
+# 本番用 gunicorn 設定
+#   gunicorn -c gunicorn.conf.py
+#
+# 環境変数で調整できる項目:
+#   PORT                  待ち受けポート (default: 5000)
+#   WEB_CONCURRENCY       ワーカープロセス数 (default: CPUコア数 * 2 + 1)
+#   GUNICORN_THREADS      ワーカーあたりのスレッド数 (default: 8)
+#   GUNICORN_WORKER_CLASS ワーカー種別 (default: gthread)
+#                         ASGI で動かす場合は uvicorn.workers.UvicornWorker
+#   GUNICORN_APP          アプリのパス (default: src.wsgi:app, ASGI は src.asgi:app)
+#   GUNICORN_KEEPALIVE    Keep-Alive 秒数 (default: 5)
+#   GUNICORN_TIMEOUT      ワーカーのタイムアウト秒数 (default: 120)
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+wsgi_app = os.environ.get("GUNICORN_APP", "src.wsgi:app")
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# 会話生成は OpenAI の応答待ちが大半なので、ワーカーごとに複数スレッドで並行処理する
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+# LLM の2回呼び出しを含むリクエストを途中で打ち切らないよう長めに取る
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+
+# キャラクター表の読み込みとDB初期化を fork 前に1回だけ行い、ワーカーで共有する
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
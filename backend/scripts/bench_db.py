@@ -0,0 +1,106 @@
+"""NFC ログ書き込みと履歴取得を複数スレッドから同時に実行し、DB 層のスループットとレイテンシを測る
+
+一時ディレクトリの SQLite（または --database-url の DB）に対して Flask アプリを直接呼ぶ。
+--baseline を付けると PRAGMA 設定と追加インデックスを外した状態（変更前相当）で測る。
+
+使い方:
+    python scripts/bench_db.py --threads 8 --requests 2000 --tags 200
+    python scripts/bench_db.py --threads 8 --requests 2000 --tags 200 --baseline
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _prepare_app(database_url, baseline):
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("LLM_BACKEND", "fake")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if baseline:
+        os.environ["SQLITE_PRAGMAS"] = "0"
+    from src.main import app
+    from src.models.user import db
+    if baseline:
+        with app.app_context():
+            for name in ("ix_nfc_records_character_id_nfc_uid", "ix_nfc_conversations_nfc_record_id",
+                         "ix_nfc_conversations_record_timestamp_id"):
+                db.session.execute(db.text(f"DROP INDEX IF EXISTS {name}"))
+            db.session.commit()
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--history-ratio", type=float, default=0.3)
+    parser.add_argument("--database-url")
+    parser.add_argument("--baseline", action="store_true")
+    parser.add_argument("--character", default="test")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_db_")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    app = _prepare_app(database_url, args.baseline)
+    local = threading.local()
+    results = {"log": [], "history": []}
+    errors = {"log": 0, "history": 0}
+    lock = threading.Lock()
+
+    def one(i):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        nfc_uid = f"bench-{random.randrange(args.tags):05d}"
+        if i >= args.tags and random.random() < args.history_ratio:
+            op = "history"
+            started = time.perf_counter()
+            response = client.get(f"/api/nfc/{args.character}/{nfc_uid}/history")
+            ok = response.status_code in (200, 404)
+        else:
+            op = "log"
+            started = time.perf_counter()
+            response = client.post(f"/api/nfc/{args.character}/{nfc_uid}/log", json={
+                "lat": 35.681, "lon": 139.767, "affection_level": 50,
+                "message": f"ベンチマーク {i}", "sender": "user",
+            })
+            ok = response.status_code == 200
+        elapsed = time.perf_counter() - started
+        with lock:
+            results[op].append(elapsed)
+            if not ok:
+                errors[op] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(one, range(args.requests)))
+    total = time.perf_counter() - started
+
+    print(f"database: {database_url} ({'baseline' if args.baseline else 'tuned'})")
+    print(f"{'op':<9}{'count':>7}{'errors':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'mean(ms)':>10}")
+    for op, samples in results.items():
+        if not samples:
+            continue
+        ms = [s * 1000 for s in samples]
+        print(f"{op:<9}{len(ms):>7}{errors[op]:>8}{_percentile(ms, 50):>10.1f}{_percentile(ms, 95):>10.1f}"
+              f"{_percentile(ms, 99):>10.1f}{statistics.mean(ms):>10.1f}")
+    print(f"{args.requests} requests in {total:.2f}s ({args.requests / total:.0f} req/s, {args.threads} threads)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""長いセッションでの1ターンあたりのプロンプトサイズを、履歴圧縮の有無で比較する
+
+要約はダミー（固定長の文字列）で代用するので OpenAI API は呼ばない。
+tiktoken がインストールされていればトークン数、なければ文字数を表示する。
+
+使い方:
+    python scripts/bench_history.py --turns 100 --window 6 --interval 4
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "unused-by-this-benchmark")
+
+from src.character_service import CharacterService
+from src.history_compactor import HistoryCompactor
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+    UNIT = "tokens"
+
+    def measure(text):
+        return len(_encoding.encode(text))
+except ImportError:
+    UNIT = "chars"
+
+    def measure(text):
+        return len(text)
+
+
+def _stub_summarize(session_key, previous_summary, turns):
+    return "これまでの会話の要約です。" * 20
+
+
+def prompt_sizes(service, character_id, turns):
+    character_data = service.characters[character_id]
+    context = service._get_current_context()
+    history = []
+    sizes = []
+    for i in range(turns):
+        user_choice = f"ターン{i}のユーザーの返答です。今日は学校帰りに駅前のカフェに寄りました。"
+        history.append({"user": user_choice, "character": f"ターン{i}のキャラクターの発言です。へえ、何を頼んだの？"})
+        character_prompt = service._build_next_character_prompt(character_data, user_choice, history, context, 50)
+        options_prompt = service._build_next_options_prompt(character_data, "次の発言", user_choice, history, character_data['性別'])
+        sizes.append(measure(character_prompt) + measure(options_prompt))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--character", default="test")
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--window", type=int, default=6)
+    parser.add_argument("--interval", type=int, default=4)
+    parser.add_argument("--every", type=int, default=10)
+    args = parser.parse_args()
+
+    service = CharacterService()
+    service.history_compactor = None
+    full = prompt_sizes(service, args.character, args.turns)
+    service.history_compactor = HistoryCompactor(_stub_summarize, window=args.window, interval=args.interval)
+    compacted = prompt_sizes(service, args.character, args.turns)
+
+    print(f"{'turn':>6}{'full(' + UNIT + ')':>16}{'compacted(' + UNIT + ')':>22}")
+    for i in range(0, args.turns, args.every):
+        print(f"{i + 1:>6}{full[i]:>16}{compacted[i]:>22}")
+    print(f"{args.turns:>6}{full[-1]:>16}{compacted[-1]:>22}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""会話1ターンあたりのレイテンシを serial / combined モードで比較する
+
+使い方:
+    python scripts/bench_pipeline.py --character test --turns 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.character_service import CharacterService
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run(service, mode, character_id, turns, lat, lon):
+    service.pipeline_mode = mode
+    latencies = []
+    history = []
+    for i in range(turns):
+        started = time.perf_counter()
+        if i == 0:
+            result = service.generate_initial_dialogue(character_id, lat, lon)
+        else:
+            user_choice = history[-1]["user"]
+            result = service.generate_next_dialogue(character_id, user_choice, history, lat, lon, 50)
+        latencies.append(time.perf_counter() - started)
+        options = result["options"] or [{"text": "うん"}]
+        history.append({"user": options[0]["text"], "character": result["message"]})
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--character", default="test")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--lat", type=float, default=35.681)
+    parser.add_argument("--lon", type=float, default=139.767)
+    parser.add_argument("--modes", default="serial,combined")
+    args = parser.parse_args()
+
+    service = CharacterService()
+    print(f"{'mode':<10}{'turns':>6}{'p50(s)':>10}{'p95(s)':>10}{'mean(s)':>10}")
+    for mode in args.modes.split(","):
+        latencies = run(service, mode, args.character, args.turns, args.lat, args.lon)
+        print(
+            f"{mode:<10}{len(latencies):>6}"
+            f"{_percentile(latencies, 50):>10.2f}{_percentile(latencies, 95):>10.2f}"
+            f"{statistics.mean(latencies):>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
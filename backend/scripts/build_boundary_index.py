@@ -0,0 +1,51 @@
+"""行政区域の GeoJSON からオフライン逆ジオコーディング用の索引ファイルを作る
+
+国土数値情報「行政区域データ（N03）」の GeoJSON を想定している。
+都道府県名・市区町村名の属性キーはオプションで変更できる。
+
+使い方:
+    python scripts/build_boundary_index.py N03-20240101.geojson src/boundary_index.bin
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.boundary_index import BoundaryIndex, build_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("geojson_path")
+    parser.add_argument("output_path")
+    parser.add_argument("--pref-key", default="N03_001")
+    parser.add_argument("--city-keys", default="N03_003,N03_004", help="市区町村名として連結する属性キー（カンマ区切り）")
+    parser.add_argument("--cell-size", type=float, default=0.02, help="グリッドのセルサイズ（度）")
+    args = parser.parse_args()
+
+    with open(args.geojson_path, "r", encoding="utf-8") as file:
+        features = json.load(file)["features"]
+
+    started = time.perf_counter()
+    summary = build_index(features, args.output_path, args.pref_key, args.city_keys.split(","), args.cell_size)
+    print(f"built {args.output_path} in {time.perf_counter() - started:.1f}s: {summary}")
+
+    # 読み込めることを確認し、セル中心での検索時間を測る
+    index = BoundaryIndex(args.output_path)
+    samples = [
+        (index.min_lat + (row + 0.5) * index.cell_size, index.min_lon + (col + 0.5) * index.cell_size)
+        for row in range(0, index.grid_h, max(1, index.grid_h // 50))
+        for col in range(0, index.grid_w, max(1, index.grid_w // 50))
+    ]
+    started = time.perf_counter()
+    for lat, lon in samples:
+        index.lookup(lat, lon)
+    elapsed = time.perf_counter() - started
+    print(f"lookup: {elapsed / len(samples) * 1e6:.1f} us/query over {len(samples)} samples")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""会話 API の負荷試験: 目標 RPS で /dialogue/start・/dialogue/next・/nfc/.../log を叩き、
+エンドポイントごとの p50/p95/p99 レイテンシとエラー率を表示する
+
+オープンループ（応答を待たずに一定間隔で送信）で、レイテンシは予定送信時刻から
+応答までを測るので、サーバーが詰まったときの待ち時間も含まれる。
+OpenAI の枠を使わないよう、サーバーは LLM_BACKEND=fake で起動しておく。
+--in-process を付けるとサーバーを起動せず Flask アプリを直接呼ぶ（LLM_BACKEND=fake を既定にする）。
+
+使い方:
+    LLM_BACKEND=fake FAKE_LLM_LATENCY=lognormal:800:0.4 gunicorn -c gunicorn.conf.py
+    python scripts/loadtest.py --url http://localhost:5000 --rps 20 --duration 60 --mix start=1,next=3,nfc=1
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class HttpTransport:
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def post(self, path, payload):
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read() or b"null")
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+
+class InProcessTransport:
+    def __init__(self):
+        os.environ.setdefault("LLM_BACKEND", "fake")
+        from src.main import app
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, path, payload):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(path, json=payload)
+        return response.status_code, response.get_json(silent=True)
+
+
+class LoadTest:
+    def __init__(self, transport, character_id, lat, lon):
+        self.transport = transport
+        self.character_id = character_id
+        self.lat = lat
+        self.lon = lon
+        self.sessions = []
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def _record(self, endpoint, latency, ok):
+        with self._lock:
+            self.results.setdefault(endpoint, []).append((latency, ok))
+
+    def _start(self):
+        status, body = self.transport.post("/api/dialogue/start", {
+            "character_id": self.character_id, "lat": self.lat, "lon": self.lon,
+        })
+        ok = status == 200 and bool(body and body.get("success"))
+        if ok and body.get("session_id"):
+            with self._lock:
+                self.sessions.append((body["session_id"], body.get("options") or []))
+        return "start", ok
+
+    def _next(self):
+        with self._lock:
+            session = random.choice(self.sessions) if self.sessions else None
+        if session is None:
+            return self._start()
+        session_id, options = session
+        user_choice = random.choice(options)["text"] if options else "うん"
+        status, body = self.transport.post("/api/dialogue/next", {
+            "session_id": session_id, "user_choice": user_choice, "affection_level": 50,
+        })
+        return "next", status == 200 and bool(body and body.get("success"))
+
+    def _nfc(self):
+        nfc_uid = f"loadtest-{random.randrange(1000):04d}"
+        status, body = self.transport.post(f"/api/nfc/{self.character_id}/{nfc_uid}/log", {
+            "lat": self.lat, "lon": self.lon, "affection_level": 50,
+            "message": "負荷試験", "sender": "user",
+        })
+        return "nfc", status == 200 and bool(body and body.get("success"))
+
+    def _run_one(self, action, scheduled_at):
+        try:
+            endpoint, ok = action()
+        except Exception:
+            endpoint, ok = action.__name__.strip("_"), False
+        self._record(endpoint, time.perf_counter() - scheduled_at, ok)
+
+    def run(self, rps, duration, mix, concurrency):
+        actions = {"start": self._start, "next": self._next, "nfc": self._nfc}
+        population = [actions[name] for name in mix]
+        weights = [mix[name] for name in mix]
+        interval = 1.0 / rps
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            i = 0
+            while True:
+                scheduled_at = started + i * interval
+                if scheduled_at - started >= duration:
+                    break
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                action = random.choices(population, weights)[0]
+                executor.submit(self._run_one, action, scheduled_at)
+                i += 1
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        print(f"{'endpoint':<8}{'count':>7}{'errors':>8}{'err%':>7}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'mean(ms)':>10}")
+        total = 0
+        for endpoint, samples in sorted(self.results.items()):
+            latencies = [latency * 1000 for latency, _ in samples]
+            errors = sum(1 for _, ok in samples if not ok)
+            total += len(samples)
+            print(f"{endpoint:<8}{len(samples):>7}{errors:>8}{errors / len(samples) * 100:>6.1f}%"
+                  f"{_percentile(latencies, 50):>10.0f}{_percentile(latencies, 95):>10.0f}"
+                  f"{_percentile(latencies, 99):>10.0f}{statistics.mean(latencies):>10.0f}")
+        print(f"completed {total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+
+def _parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {"start", "next", "nfc"}
+    if unknown:
+        raise SystemExit(f"unknown endpoints in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--in-process", action="store_true")
+    parser.add_argument("--rps", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", default="start=1,next=3,nfc=1")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--character", default="test")
+    parser.add_argument("--lat", type=float, default=35.681)
+    parser.add_argument("--lon", type=float, default=139.767)
+    args = parser.parse_args()
+
+    transport = InProcessTransport() if args.in_process else HttpTransport(args.url, args.timeout)
+    test = LoadTest(transport, args.character, args.lat, args.lon)
+    elapsed = test.run(args.rps, args.duration, _parse_mix(args.mix), args.concurrency)
+    test.report(elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""静的ファイルの圧縮済み版（.gz / .br）を作る。フロントエンドをビルドして static に置いた後に実行する
+
+テキスト系のファイルだけを対象にし、元より小さくならないものは作らない（古い圧縮版は消す）。
+.br は brotli パッケージがあるときだけ作る（pip install brotli）。
+配信側（src/static_assets.py）は起動時にこれらを見つけて Accept-Encoding に応じて返す。
+
+使い方:
+    python scripts/precompress_static.py            # src/static
+    python scripts/precompress_static.py path/to/dist
+"""
+import argparse
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_COMPRESSIBLE = (".html", ".js", ".mjs", ".css", ".svg", ".json", ".map", ".txt", ".xml", ".wasm", ".ico")
+
+
+def _write_variant(path, suffix, data):
+    variant_path = path + suffix
+    if data is None or len(data) >= os.path.getsize(path):
+        if os.path.exists(variant_path):
+            os.remove(variant_path)
+        return False
+    with open(variant_path + ".tmp", "wb") as file:
+        file.write(data)
+    os.replace(variant_path + ".tmp", variant_path)
+    # 配信時の Last-Modified が元ファイルと揃うようにする
+    stat = os.stat(path)
+    os.utime(variant_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return True
+
+
+def main():
+    default_root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "static")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", nargs="?", default=default_root)
+    parser.add_argument("--min-size", type=int, default=1024, help="これより小さいファイルは圧縮しない（バイト）")
+    args = parser.parse_args()
+
+    if brotli is None:
+        print("brotli is not installed; writing .gz only")
+    original_total = compressed_total = 0
+    for directory, _, files in os.walk(args.root):
+        for name in files:
+            if not name.endswith(_COMPRESSIBLE):
+                continue
+            path = os.path.join(directory, name)
+            size = os.path.getsize(path)
+            if size < args.min_size:
+                continue
+            with open(path, "rb") as file:
+                data = file.read()
+            # mtime=0 にして、同じ内容なら同じ .gz になるようにする
+            gz = gzip.compress(data, compresslevel=9, mtime=0)
+            br = brotli.compress(data, quality=11) if brotli is not None else None
+            written = [suffix for suffix, variant in ((".gz", gz), (".br", br)) if _write_variant(path, suffix, variant)]
+            best = min(len(v) for v in (gz, br, data) if v is not None)
+            original_total += size
+            compressed_total += best
+            print(f"{os.path.relpath(path, args.root)}: {size} -> {best} bytes {' '.join(written)}")
+    if original_total:
+        print(f"total: {original_total} -> {compressed_total} bytes ({compressed_total / original_total:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""会場などの既知の座標をまとめて逆ジオコーディングし、永続キャッシュに登録する
+
+CSV には lat, lon 列が必要（それ以外の列は無視する）。
+Nominatim の利用規約に合わせ、キャッシュにない座標は1秒に1件ずつ問い合わせる。
+取得に失敗した座標（オフライン索引で代用したもの）はキャッシュに入らないので、最後に一覧を出す。
+
+使い方:
+    python scripts/preload_geocode.py venues.csv
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.character_service import geocode_stats, resolve_location
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("csv_path")
+    parser.add_argument("--interval", type=float, default=1.0, help="Nominatim への問い合わせ間隔（秒）")
+    args = parser.parse_args()
+
+    with open(args.csv_path, "r", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file))
+
+    failed = []
+    for i, row in enumerate(rows, start=1):
+        lat, lon = float(row["lat"]), float(row["lon"])
+        (pref, city, detailed_address), source = resolve_location(lat, lon)
+        if source == "fallback":
+            failed.append((lat, lon))
+            print(f"[{i}/{len(rows)}] {lat},{lon} -> （取得失敗、オフライン索引: {detailed_address}）")
+        else:
+            print(f"[{i}/{len(rows)}] {lat},{lon} -> {detailed_address} ({source})")
+        if source in ("nominatim", "fallback"):
+            time.sleep(args.interval)
+
+    print(geocode_stats())
+    if failed:
+        print(f"failed: {len(failed)}/{len(rows)}")
+        for lat, lon in failed:
+            print(f"  {lat},{lon}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""1セッション分の入力トークン数を、ターンごとに「共通プレフィックス」と「毎回変わる部分」に分けて表示する
+
+OpenAI API は呼ばず、送信されるはずの messages を記録して数える（serial モード、
+1ターン = 発言 + 選択肢の2回呼び出し）。共通プレフィックスは、それ以前のどれかの
+呼び出しと先頭から一致している長さで、プロバイダ側のプロンプトキャッシュが
+効きうる部分。OpenAI はプロンプトが 1024 トークン以上のときだけ 128 トークン単位で
+キャッシュするので、その概算も cached 列に出す。
+
+リビジョン間の比較（変更前/変更後）は、それぞれのチェックアウトで実行して並べる。
+tiktoken がインストールされていればトークン数、なければ文字数を表示する。
+
+使い方:
+    python scripts/prompt_token_report.py --turns 20 --every 5
+"""
+import argparse
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "unused-by-this-report")
+
+from src.character_service import CharacterService
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+    UNIT = "tokens"
+
+    def measure(text):
+        return len(_encoding.encode(text))
+except Exception:
+    UNIT = "chars"
+
+    def measure(text):
+        return len(text)
+
+_MESSAGE = "へえ、そうなんだ！ところで、今日はどこに行ってきたの？"
+# OPTIONS_RESPONSE_FORMAT と同じ、種類ごとのキーを持つ JSON オブジェクト
+_OPTIONS = json.dumps(
+    {"v-good": "駅前のカフェだよ", "good": "ちょっと散歩", "bad": "内緒", "v-bad": "関係ないでしょ"},
+    ensure_ascii=False,
+)
+
+
+class _RecordingCompletions:
+    """呼び出しを記録し、発言 → 選択肢の順に固定の応答を返す"""
+
+    def __init__(self):
+        self.calls = []
+
+    def create(self, **params):
+        self.calls.append(params["messages"])
+        content = _MESSAGE if len(self.calls) % 2 == 1 else _OPTIONS
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def _serialize(messages):
+    return "".join(f"{m['role']}\n{m['content']}\n" for m in messages)
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+
+def _openai_cached(total, prefix):
+    if total < 1024 or prefix < 1024:
+        return 0
+    return 1024 + (prefix - 1024) // 128 * 128
+
+
+def record_session(service, character_id, turns):
+    recorder = _RecordingCompletions()
+    service.openai_client = SimpleNamespace(chat=SimpleNamespace(completions=recorder))
+    history = []
+    turn_calls = []
+
+    start = len(recorder.calls)
+    result = service.generate_initial_dialogue(character_id, affection_level=40)
+    turn_calls.append(recorder.calls[start:])
+    message = result["message"]
+    for i in range(1, turns):
+        user_choice = f"ターン{i}の返答です。今日は学校帰りに駅前のカフェに寄りました。"
+        history.append({"user": user_choice, "character": message})
+        start = len(recorder.calls)
+        result = service.generate_next_dialogue(
+            character_id, user_choice, list(history), affection_level=min(100, 40 + i * 5)
+        )
+        turn_calls.append(recorder.calls[start:])
+        message = result["message"]
+    return turn_calls
+
+
+def measure_turns(turn_calls):
+    seen = []
+    rows = []
+    for calls in turn_calls:
+        total = shared = cached = 0
+        for messages in calls:
+            text = _serialize(messages)
+            prefix = max((_common_prefix(text, previous) for previous in seen), key=len, default="")
+            seen.append(text)
+            call_total, call_prefix = measure(text), measure(prefix)
+            total += call_total
+            shared += call_prefix
+            cached += _openai_cached(call_total, call_prefix)
+        rows.append((total, shared, cached, total - cached))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--character", default="test")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--every", type=int, default=5)
+    args = parser.parse_args()
+
+    service = CharacterService()
+    service.pipeline_mode = "serial"
+    service.response_cache = None
+    service.opening_pool = None
+    rows = measure_turns(record_session(service, args.character, args.turns))
+
+    print(f"{'turn':>6}{'input':>10}{'shared':>10}{'cached':>10}{'uncached':>10}   ({UNIT})")
+    for i, row in enumerate(rows):
+        if i % args.every == 0 or i == len(rows) - 1:
+            print(f"{i + 1:>6}" + "".join(f"{value:>10}" for value in row))
+    totals = [sum(column) for column in zip(*rows)]
+    print(f"{'total':>6}" + "".join(f"{value:>10}" for value in totals))
+
+
+if __name__ == "__main__":
+    main()
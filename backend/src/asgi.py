@@ -0,0 +1,32 @@
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Mount
+from src.log_config import RequestIdMiddleware
+from src.metrics import AsgiMetricsMiddleware
+from src.main import app as flask_app
+from src.routes.character_async import routes as async_routes
+
+# ASGIエントリーポイント
+#   uvicorn src.asgi:app --host 0.0.0.0 --port 5000
+# 会話生成ルートは asyncio 上で処理し、キャラクター一覧・NFC・静的ファイルなど
+# 残りのルートは既存の Flask アプリをスレッドプール経由でそのまま提供する。
+
+app = Starlette(
+    routes=[
+        *async_routes,
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+    middleware=[
+        Middleware(RequestIdMiddleware),
+        # 非同期ルートの所要時間・件数（Flask 側は metrics.init_app で計測済み）
+        Middleware(AsgiMetricsMiddleware, routes=async_routes),
+        # Flask-CORS と同じくすべてのオリジンを許可する
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    ],
+)
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from openai import AsyncOpenAI
+
+from src import metrics
+from src.character_service import CharacterService
+from src.dialogue_options import COMBINED_RESPONSE_FORMAT, missing_types
+from src.fake_llm import AsyncFakeOpenAI
+from src.response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCharacterService(CharacterService):
+    """CharacterService の asyncio 版
+
+    プロンプト生成・選択肢の解析は同期版と共通で、OpenAI 呼び出しは
+    共有の AsyncOpenAI クライアント、逆ジオコーディングはスレッドに逃がして
+    イベントループを塞がないようにする。
+
+    shared に同期版のサービスを渡すと、設定と流量制御・カタログ・キャッシュ・プール・
+    先読み・ヘッジをそのまま共有する（同じプロセスで両方を提供する ASGI 用）。
+    """
+
+    def __init__(self, shared=None):
+        if shared is None:
+            super().__init__()
+        else:
+            # 別々に作るとレート上限や同時実行枠、プールのスレッドが二重になる
+            vars(self).update(vars(shared))
+        self._async_openai_client = None
+        self._async_client_pid = None
+
+    @property
+    def async_openai_client(self):
+        if self._async_openai_client is None or self._async_client_pid != os.getpid():
+            if self.llm_backend == 'fake':
+                self._async_openai_client = AsyncFakeOpenAI()
+            else:
+                self._async_openai_client = AsyncOpenAI(api_key=self._api_key, max_retries=0)
+            self._async_client_pid = os.getpid()
+        return self._async_openai_client
+
+    @async_openai_client.setter
+    def async_openai_client(self, client):
+        self._async_openai_client = client
+        self._async_client_pid = os.getpid()
+
+    async def _aget_current_context(self, lat=None, lon=None):
+        # Nominatim 呼び出しはブロッキングなのでワーカースレッドで実行
+        return await asyncio.to_thread(self._get_current_context, lat, lon)
+
+    async def _awarm_history(self, character_data, conversation_history):
+        # 履歴要約の生成はワーカースレッドで済ませ、プロンプト生成時はキャッシュを引くだけにする
+        if self.history_compactor is not None and conversation_history:
+            await asyncio.to_thread(self.history_compactor.compact, character_data['キャラクターID'], conversation_history)
+
+    async def _atake_speculative_reply(self, *args):
+        # 先読みが生成中なら完了を待つので、イベントループを塞がないようスレッドで待つ
+        if self.speculative_replies is None:
+            return None
+        return await asyncio.to_thread(self._take_speculative_reply, *args)
+
+    async def generate_initial_dialogue(self, character_id, lat=None, lon=None, affection_level=40, session_id=None):
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            return {"message": "キャラクターが見つかりません。", "error": "Character not found", "options": [], "debug_affection_level": affection_level}
+
+        context = await self._aget_current_context(lat, lon)
+        pooled = self._take_opening(character_id, context, affection_level)
+        if pooled:
+            self._speculate_replies(character_id, pooled["message"], [], pooled["options"], lat, lon, affection_level, session_id)
+            return pooled
+
+        try:
+            message, options = await self._agenerate_initial_turn(character_data, context, affection_level)
+            self._speculate_replies(character_id, message, [], options, lat, lon, affection_level, session_id)
+            random.shuffle(options)
+            return {"message": message, "options": options, "debug_affection_level": affection_level}
+        except Exception as e:
+            logger.exception("Initial dialogue generation failed for %s", character_id)
+            return {"message": f"初期会話生成エラー: {str(e)}", "error": str(e), "options": [], "debug_affection_level": affection_level}
+
+    async def _agenerate_initial_turn(self, character_data, context, affection_level):
+        character_prompt = self._build_initial_character_prompt(character_data, context, affection_level)
+        combined = await self._agenerate_combined(character_data, character_prompt) if self.pipeline_mode == 'combined' else None
+        if combined:
+            return combined
+
+        message = (await self._agenerate_with_openai(character_prompt, is_character=True, character_data=character_data)).strip()
+        gender = character_data['性別']
+        options_prompt = self._build_initial_options_prompt(character_data, message, gender)
+        return message, await self._agenerate_option_list(options_prompt, character_data)
+
+    async def generate_next_dialogue(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None, session_id=None):
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            return {"message": "キャラクターが見つかりません。", "error": "Character not found", "options": [], "debug_affection_level": affection_level}
+
+        context = await self._aget_current_context(lat, lon)
+        await self._awarm_history(character_data, conversation_history)
+        character_prompt = self._build_next_character_prompt(character_data, user_choice, conversation_history, context, affection_level)
+
+        try:
+            message = await self._atake_speculative_reply(character_id, user_choice, conversation_history, lat, lon, affection_level, session_id)
+            combined = None
+            if message is None and self.pipeline_mode == 'combined':
+                combined = await self._agenerate_combined(character_data, character_prompt)
+            if combined:
+                message, options = combined
+            else:
+                if message is None:
+                    message = (await self._agenerate_with_openai(character_prompt, is_character=True, character_data=character_data)).strip()
+                gender = character_data['性別']
+                options_prompt = self._build_next_options_prompt(character_data, message, user_choice, conversation_history, gender)
+                options = await self._agenerate_option_list(options_prompt, character_data)
+
+            self._speculate_replies(character_id, message, conversation_history, options, lat, lon, affection_level, session_id)
+            random.shuffle(options)
+            return {"message": message, "options": options, "debug_affection_level": affection_level}
+        except Exception as e:
+            logger.exception("Next dialogue generation failed for %s", character_id)
+            return {"message": f"次の会話生成エラー: {str(e)}", "error": str(e), "options": [], "debug_affection_level": affection_level}
+
+    async def stream_next_dialogue(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None, session_id=None):
+        """同期版 stream_next_dialogue と同じイベントを返す非同期ジェネレーター"""
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            yield "error", {"message": "キャラクターが見つかりません。"}
+            return
+
+        context = await self._aget_current_context(lat, lon)
+        await self._awarm_history(character_data, conversation_history)
+        character_prompt = self._build_next_character_prompt(character_data, user_choice, conversation_history, context, affection_level)
+
+        try:
+            message = await self._atake_speculative_reply(character_id, user_choice, conversation_history, lat, lon, affection_level, session_id)
+            if message is not None:
+                yield "delta", {"text": message}
+            else:
+                chunks = []
+                async for delta in self._astream_with_openai(character_prompt, is_character=True, character_data=character_data):
+                    chunks.append(delta)
+                    yield "delta", {"text": delta}
+                message = "".join(chunks).strip()
+
+            gender = character_data['性別']
+            options_prompt = self._build_next_options_prompt(character_data, message, user_choice, conversation_history, gender)
+            options = await self._agenerate_option_list(options_prompt, character_data)
+
+            self._speculate_replies(character_id, message, conversation_history, options, lat, lon, affection_level, session_id)
+            random.shuffle(options)
+            yield "options", {"message": message, "options": options, "debug_affection_level": affection_level}
+        except Exception as e:
+            logger.exception("Streaming dialogue generation failed for %s", character_id)
+            yield "error", {"message": f"次の会話生成エラー: {str(e)}"}
+
+    async def generate_character_message(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None, session_id=None):
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            return {"message": "キャラクターが見つかりません。", "error": "Character not found"}
+
+        speculative = await self._atake_speculative_reply(character_id, user_choice, conversation_history, lat, lon, affection_level, session_id)
+        if speculative is not None:
+            return {"message": speculative}
+
+        context = await self._aget_current_context(lat, lon)
+        await self._awarm_history(character_data, conversation_history)
+        character_prompt = self._build_next_character_prompt(character_data, user_choice, conversation_history, context, affection_level)
+        try:
+            message = (await self._agenerate_with_openai(character_prompt, is_character=True, character_data=character_data)).strip()
+            return {"message": message}
+        except Exception as e:
+            logger.exception("Character message generation failed for %s", character_id)
+            return {"message": f"キャラクター発言生成エラー: {str(e)}", "error": str(e)}
+
+    async def generate_options(self, character_id, character_message, user_choice, conversation_history, lat=None, lon=None, affection_level=None, session_id=None):
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            return {"options": []}
+        await self._awarm_history(character_data, conversation_history)
+        gender = character_data['性別']
+        options_prompt = self._build_next_options_prompt(character_data, character_message, user_choice, conversation_history, gender)
+        try:
+            options = await self._agenerate_option_list(options_prompt, character_data)
+            self._speculate_replies(character_id, character_message, conversation_history, options, lat, lon, affection_level, session_id)
+            random.shuffle(options)
+            return {"options": options}
+        except Exception:
+            logger.exception("Options generation failed for %s", character_id)
+            return {"options": []}
+
+    async def _agenerate_combined(self, character_data, character_prompt):
+        combined_prompt = self._build_combined_prompt(character_data, character_prompt)
+        content = await self._acreate_completion(
+            stage="combined",
+            messages=self._build_messages(combined_prompt, character_data=character_data, kind="combined"),
+            temperature=1.0,
+            response_format=COMBINED_RESPONSE_FORMAT
+        )
+        return self._parse_combined(content)
+
+    async def _acreate_completion(self, stage="other", use_cache=True, **params):
+        route = self.routes[stage]
+        params.setdefault("model", route.model)
+        params.setdefault("max_tokens", route.max_tokens)
+        key = self._cache_key(params) if use_cache else None
+        if key is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+
+        create = self.async_openai_client.chat.completions.create
+        with metrics.span(f"llm_{stage}"):
+            response = await self.hedger.acall(
+                route,
+                lambda p, k: self.completion_gate.acall(create, p, key=k, deadline=route.deadline),
+                params,
+                key=ResponseCache.make_key(**params),
+            )
+        metrics.record_usage(response, stage)
+        content = response.choices[0].message.content.strip()
+        if key is not None:
+            self.response_cache.put(key, content)
+        return content
+
+    async def _agenerate_option_list(self, options_prompt, character_data):
+        options = []
+        for attempt in range(self.options_max_retries + 1):
+            if attempt:
+                metrics.inc("options_retries_total")
+            content = await self._acreate_completion(stage="options", use_cache=attempt == 0, **self._options_params(options_prompt, character_data))
+            options = self._merge_options(options, content)
+            if not missing_types(options):
+                break
+        return options
+
+    async def _agenerate_with_openai(self, prompt, is_character=True, character_data=None):
+        return await self._acreate_completion(
+            stage="character" if is_character else "options",
+            messages=self._build_messages(prompt, is_character, character_data),
+            temperature=1.0
+        )
+
+    async def _astream_with_openai(self, prompt, is_character=True, character_data=None):
+        route = self.routes["character" if is_character else "options"]
+        stream = self.completion_gate.astream(self.async_openai_client.chat.completions.create, dict(
+            model=route.model,
+            messages=self._build_messages(prompt, is_character, character_data),
+            max_tokens=route.max_tokens,
+            temperature=1.0,
+            stream=True
+        ), deadline=route.deadline)
+        started = time.perf_counter()
+        first_token = True
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first_token:
+                    first_token = False
+                    metrics.observe("llm_first_token_seconds", time.perf_counter() - started, stage="character")
+                yield delta
@@ -0,0 +1,206 @@
+import json
+import math
+import mmap
+import struct
+
+# 行政区域ポリゴンのオフライン索引
+#
+# scripts/build_boundary_index.py で GeoJSON から下記のバイナリ形式に変換し、
+# 実行時は mmap で読み込む。座標配列やグリッドはページキャッシュ上で
+# 全ワーカーに共有され、プロセスごとのコピーは名前表だけになる。
+#
+#   header    : MAGIC + _HEADER
+#   polygons  : _POLYGON × n_polygons  (都道府県名ID, 市区町村名ID, 最初のリング, リング数, bbox)
+#   rings     : _RING × n_rings        (最初の頂点, 頂点数)  ※各ポリゴンの先頭が外周、残りは穴
+#   vertices  : float64 × 2 × n_vertices (経度, 緯度)
+#   cells     : uint32 × (grid_w * grid_h + 1)  各セルの entries 開始位置
+#   entries   : uint32 × n_entries     ポリゴンID * 2 + (セル全体を覆うなら 1)
+#   names     : UTF-8 JSON 配列
+
+MAGIC = b"BIDX0001"
+_HEADER = struct.Struct("<IIIIIdddIIQQQQQQ")
+_POLYGON = struct.Struct("<IIII4d")
+_RING = struct.Struct("<II")
+
+
+def _align(position):
+    return (position + 7) & ~7
+
+
+def _point_in_ring(lon, lat, coords, start, count):
+    """レイキャスティング法。coords は [lon0, lat0, lon1, lat1, ...] の配列"""
+    inside = False
+    j = start + count - 1
+    for i in range(start, start + count):
+        xi, yi = coords[2 * i], coords[2 * i + 1]
+        xj, yj = coords[2 * j], coords[2 * j + 1]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+class BoundaryIndex:
+    """緯度経度から (都道府県, 市区町村) を引く point-in-polygon 索引"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a boundary index")
+        (
+            self.n_polygons, n_rings, n_vertices, self.grid_w, self.grid_h,
+            self.min_lon, self.min_lat, self.cell_size, n_entries, _reserved,
+            polygons_at, rings_at, vertices_at, cells_at, entries_at, names_at,
+        ) = _HEADER.unpack_from(buffer, len(MAGIC))
+
+        self._polygons = buffer[polygons_at:polygons_at + _POLYGON.size * self.n_polygons]
+        self._rings = buffer[rings_at:rings_at + _RING.size * n_rings]
+        self._vertices = buffer[vertices_at:vertices_at + 16 * n_vertices].cast("d")
+        self._cells = buffer[cells_at:cells_at + 4 * (self.grid_w * self.grid_h + 1)].cast("I")
+        self._entries = buffer[entries_at:entries_at + 4 * n_entries].cast("I")
+        self._names = json.loads(bytes(buffer[names_at:]).decode("utf-8"))
+
+    def _contains(self, polygon_id, lon, lat):
+        _, _, ring_start, ring_count, min_lon, min_lat, max_lon, max_lat = _POLYGON.unpack_from(
+            self._polygons, polygon_id * _POLYGON.size
+        )
+        if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+            return False
+        for r in range(ring_start, ring_start + ring_count):
+            vertex_start, vertex_count = _RING.unpack_from(self._rings, r * _RING.size)
+            inside = _point_in_ring(lon, lat, self._vertices, vertex_start, vertex_count)
+            if r == ring_start and not inside:
+                return False
+            if r != ring_start and inside:
+                return False  # 穴の中
+        return True
+
+    def _names_of(self, polygon_id):
+        pref_id, city_id = struct.unpack_from("<II", self._polygons, polygon_id * _POLYGON.size)
+        return self._names[pref_id] or None, self._names[city_id] or None
+
+    def lookup(self, lat, lon):
+        """(都道府県, 市区町村) を返す。どのポリゴンにも入らなければ None"""
+        col = int((lon - self.min_lon) / self.cell_size)
+        row = int((lat - self.min_lat) / self.cell_size)
+        if not (0 <= col < self.grid_w and 0 <= row < self.grid_h):
+            return None
+        cell = row * self.grid_w + col
+        for e in range(self._cells[cell], self._cells[cell + 1]):
+            entry = self._entries[e]
+            polygon_id = entry >> 1
+            # セル全体を覆うポリゴンなら頂点判定は不要
+            if entry & 1 or self._contains(polygon_id, lon, lat):
+                return self._names_of(polygon_id)
+        return None
+
+
+def _iter_polygons(geometry):
+    if geometry is None:
+        return
+    if geometry["type"] == "Polygon":
+        yield geometry["coordinates"]
+    elif geometry["type"] == "MultiPolygon":
+        for polygon in geometry["coordinates"]:
+            yield polygon
+
+
+def build_index(features, path, pref_key, city_keys, cell_size=0.02):
+    """GeoJSON の Feature 列から索引ファイルを作る"""
+    names, name_ids = [], {}
+
+    def name_id(name):
+        if name not in name_ids:
+            name_ids[name] = len(names)
+            names.append(name)
+        return name_ids[name]
+
+    polygons, rings, coords = [], [], []
+    for feature in features:
+        properties = feature.get("properties") or {}
+        pref = properties.get(pref_key) or ""
+        city = "".join(properties.get(key) or "" for key in city_keys)
+        for polygon in _iter_polygons(feature.get("geometry")):
+            ring_start = len(rings)
+            for ring in polygon:
+                rings.append((len(coords) // 2, len(ring)))
+                for lon, lat in (point[:2] for point in ring):
+                    coords.extend((lon, lat))
+            exterior = polygon[0]
+            lons = [p[0] for p in exterior]
+            lats = [p[1] for p in exterior]
+            polygons.append((name_id(pref), name_id(city), ring_start, len(polygon),
+                             min(lons), min(lats), max(lons), max(lats)))
+
+    min_lon = min(p[4] for p in polygons)
+    min_lat = min(p[5] for p in polygons)
+    max_lon = max(p[6] for p in polygons)
+    max_lat = max(p[7] for p in polygons)
+    grid_w = int(math.ceil((max_lon - min_lon) / cell_size)) + 1
+    grid_h = int(math.ceil((max_lat - min_lat) / cell_size)) + 1
+
+    def cell_range(lo, hi, origin, size):
+        return range(int((lo - origin) / cell_size), min(int((hi - origin) / cell_size), size - 1) + 1)
+
+    cell_entries = {}
+    for polygon_id, (_, _, ring_start, ring_count, p_min_lon, p_min_lat, p_max_lon, p_max_lat) in enumerate(polygons):
+        # 辺が通過しうるセル（境界セル）を保守的に求める
+        boundary = set()
+        for r in range(ring_start, ring_start + ring_count):
+            vertex_start, vertex_count = rings[r]
+            for i in range(vertex_start, vertex_start + vertex_count):
+                j = vertex_start + (i - vertex_start + 1) % vertex_count
+                x0, y0, x1, y1 = coords[2 * i], coords[2 * i + 1], coords[2 * j], coords[2 * j + 1]
+                for row in cell_range(min(y0, y1), max(y0, y1), min_lat, grid_h):
+                    for col in cell_range(min(x0, x1), max(x0, x1), min_lon, grid_w):
+                        boundary.add(row * grid_w + col)
+        # 境界セル以外は、セル中心が内側ならセル全体が内側
+        for row in cell_range(p_min_lat, p_max_lat, min_lat, grid_h):
+            for col in cell_range(p_min_lon, p_max_lon, min_lon, grid_w):
+                cell = row * grid_w + col
+                if cell in boundary:
+                    cell_entries.setdefault(cell, []).append(polygon_id * 2)
+                    continue
+                center_lon = min_lon + (col + 0.5) * cell_size
+                center_lat = min_lat + (row + 0.5) * cell_size
+                inside = _point_in_ring(center_lon, center_lat, coords, *rings[ring_start]) and not any(
+                    _point_in_ring(center_lon, center_lat, coords, *rings[r])
+                    for r in range(ring_start + 1, ring_start + ring_count)
+                )
+                if inside:
+                    cell_entries.setdefault(cell, []).append(polygon_id * 2 + 1)
+
+    cells, entries = [0], []
+    for cell in range(grid_w * grid_h):
+        # セル全体を覆うポリゴンを先に判定する
+        entries.extend(sorted(cell_entries.get(cell, ()), key=lambda e: -(e & 1)))
+        cells.append(len(entries))
+
+    sections = [
+        b"".join(_POLYGON.pack(*polygon) for polygon in polygons),
+        b"".join(_RING.pack(*ring) for ring in rings),
+        struct.pack(f"<{len(coords)}d", *coords),
+        struct.pack(f"<{len(cells)}I", *cells),
+        struct.pack(f"<{len(entries)}I", *entries),
+        json.dumps(names, ensure_ascii=False).encode("utf-8"),
+    ]
+    # memoryview.cast で直接読めるよう、各セクションの先頭を 8 バイト境界に揃える
+    offsets, position = [], _align(len(MAGIC) + _HEADER.size)
+    for section in sections:
+        offsets.append(position)
+        position = _align(position + len(section))
+
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(_HEADER.pack(
+            len(polygons), len(rings), len(coords) // 2, grid_w, grid_h,
+            min_lon, min_lat, cell_size, len(entries), 0, *offsets,
+        ))
+        for offset, section in zip(offsets, sections):
+            file.write(b"\0" * (offset - file.tell()))
+            file.write(section)
+
+    return {"polygons": len(polygons), "vertices": len(coords) // 2, "grid": (grid_w, grid_h), "entries": len(entries)}
@@ -0,0 +1,179 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+_REQUIRED_COLUMNS = ("キャラクターID", "名前", "性別", "性格", "一人称", "ファンの名称", "口調", "背景・設定")
+
+
+class Character:
+    """characters.csv の1行。変更不可で、従来どおり character['名前'] や .get() でも引ける"""
+
+    __slots__ = (
+        "id", "name", "gender", "personality", "first_person", "fan_name", "tone", "setting",
+        "character_image_url", "background_image_url", "_row",
+    )
+
+    def __init__(self, row):
+        setter = object.__setattr__
+        setter(self, "_row", MappingProxyType(dict(row)))
+        setter(self, "id", row["キャラクターID"])
+        setter(self, "name", row["名前"])
+        setter(self, "gender", row["性別"])
+        setter(self, "personality", row["性格"])
+        setter(self, "first_person", row["一人称"])
+        setter(self, "fan_name", row["ファンの名称"])
+        setter(self, "tone", row["口調"])
+        setter(self, "setting", row["背景・設定"])
+        setter(self, "character_image_url", row.get("キャラクター画像URL") or "")
+        setter(self, "background_image_url", row.get("背景画像URL") or "")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Character is immutable")
+
+    def __getitem__(self, column):
+        return self._row[column]
+
+    def __contains__(self, column):
+        return column in self._row
+
+    def get(self, column, default=None):
+        return self._row.get(column, default)
+
+    def to_json(self):
+        """/api/characters のレスポンス形式"""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "gender": self.gender,
+            "personality": self.personality,
+            "first_person": self.first_person,
+            "fan_name": self.fan_name,
+            "tone": self.tone,
+            "setting": self.setting,
+            "character_image_url": self.character_image_url,
+            "background_image_url": self.background_image_url,
+        }
+
+
+def _rendered(payload):
+    """JSON のバイト列と、その内容から作った ETag"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return body, hashlib.sha1(body).hexdigest()[:20]
+
+
+class CharacterCatalog:
+    """読み込み済みのキャラクター一覧。作成後は変更せず、更新時は丸ごと差し替える
+
+    一覧・個別のレスポンスとシステムプロンプトは読み込み時に作っておく。
+    """
+
+    def __init__(self, characters, compile_system_prompts, signature=None):
+        self.characters = MappingProxyType(characters)
+        self.signature = signature
+        self.system_prompts = MappingProxyType({
+            character_id: compile_system_prompts(character)
+            for character_id, character in characters.items()
+        })
+        self.list_response = _rendered({
+            "success": True,
+            "characters": [character.to_json() for character in characters.values()],
+        })
+        self.detail_responses = MappingProxyType({
+            character_id: _rendered({"success": True, "character": character.to_json()})
+            for character_id, character in characters.items()
+        })
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _read_characters(path):
+    characters = {}
+    with open(path, 'r', encoding='utf-8') as file:
+        reader = csv.DictReader(file)
+        logger.debug("CSV columns: %s", reader.fieldnames)
+        missing = [column for column in _REQUIRED_COLUMNS if column not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"{path} is missing columns: {', '.join(missing)}")
+        for row in reader:
+            if not row.get('キャラクターID'):
+                logger.warning("Missing キャラクターID in row: %s", row)
+                continue
+            characters[row['キャラクターID']] = Character(row)
+    return characters
+
+
+class CatalogLoader:
+    """characters.csv の更新時刻を見て、変わっていれば読み直したカタログに差し替える
+
+    確認は check_interval 秒に1回（0 なら再読み込みしない）。読み直しは1スレッドだけが行い、
+    その間も他のスレッドは古いカタログをそのまま使う。読み込みに失敗したら古いカタログを使い続ける。
+    """
+
+    def __init__(self, path, compile_system_prompts, check_interval=2.0, on_reload=None):
+        self.path = path
+        self.check_interval = check_interval
+        self._compile = compile_system_prompts
+        self._on_reload = on_reload
+        self._reload_lock = threading.Lock()
+        self._next_check = time.monotonic() + check_interval
+        self._failed_signature = None
+        self.reloads = 0
+        self.reload_failures = 0
+        self._catalog = self._load_initial()
+
+    def _load_initial(self):
+        characters, signature = {}, None
+        try:
+            signature = _signature(self.path)
+            characters = _read_characters(self.path)
+        except FileNotFoundError:
+            logger.warning("%s not found", self.path)
+        except Exception:
+            logger.exception("Error loading CSV")
+        logger.info("Loaded %d characters from %s", len(characters), self.path)
+        return CharacterCatalog(characters, self._compile, signature)
+
+    def current(self):
+        if self.check_interval > 0 and time.monotonic() >= self._next_check:
+            self._maybe_reload()
+        return self._catalog
+
+    def _maybe_reload(self):
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                signature = _signature(self.path)
+            except OSError:
+                return
+            if signature in (self._catalog.signature, self._failed_signature):
+                return
+            try:
+                characters = _read_characters(self.path)
+                if not characters:
+                    # 書き込み途中のファイルを読んだ可能性が高いので差し替えない
+                    raise ValueError(f"{self.path} has no characters")
+                catalog = CharacterCatalog(characters, self._compile, signature)
+            except Exception:
+                self._failed_signature = signature
+                self.reload_failures += 1
+                logger.exception("Reloading %s failed, keeping the previous catalog", self.path)
+                return
+            self._catalog = catalog
+            self.reloads += 1
+            logger.info("Reloaded %d characters from %s", len(catalog.characters), self.path)
+            if self._on_reload is not None:
+                self._on_reload(catalog)
+        finally:
+            self._reload_lock.release()
@@ -1,89 +1,324 @@
-import csv
+import json
 import os
 import random
+import threading
+import time
 import logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger()
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from openai import OpenAI
 from dotenv import load_dotenv
 from dateutil import tz
 from geopy.geocoders import Nominatim
 from cachetools import TTLCache
+from src import metrics
+from src.boundary_index import BoundaryIndex
+from src.character_catalog import CatalogLoader
+from src.completion_gate import CompletionGate
+from src.dialogue_options import COMBINED_RESPONSE_FORMAT, OPTION_TYPES, OPTIONS_RESPONSE_FORMAT, affection_after, missing_types, parse_options
+from src.fake_llm import FakeOpenAI
+from src.geocode_cache import GeocodeCache, geohash
+from src.history_compactor import HistoryCompactor
+from src.model_routing import Hedger, load_routes
+from src.opening_pool import OpeningPool
+from src.prefecture_lookup import nearest_prefecture
+from src.response_cache import ResponseCache
+from src.speculative_replies import SpeculativeReplies
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 _geocoder = Nominatim(user_agent="chat-app")
 _geo_cache = TTLCache(maxsize=500, ttl=60*60*6) 
+# プロセス・ワーカー間で共有する永続キャッシュ（instance/app.db と同じ場所に置く）
+_geocode_store = GeocodeCache(
+    os.getenv('GEOCODE_CACHE_PATH') or os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'geocode_cache.db'),
+    ttl=int(os.getenv('GEOCODE_CACHE_TTL', 60*60*24*30)),
+)
+_GEOHASH_PRECISION = int(os.getenv('GEOCODE_GEOHASH_PRECISION', 7))
+# リクエストのスレッドと先読みのスレッドの両方から数えるのでロックを取る
+_geo_stats = {"memory_hits": 0, "lookups": 0, "failures": 0, "offline": 0}
+_geo_stats_lock = threading.Lock()
+# 行政区域ポリゴンの索引（scripts/build_boundary_index.py で作成）。なければ県庁所在地表で代用
+_BOUNDARY_INDEX_PATH = os.getenv('BOUNDARY_INDEX_PATH') or os.path.join(os.path.dirname(__file__), 'boundary_index.bin')
+# "nominatim": Nominatim を使い、失敗時はオフライン索引 / "offline": オフライン索引のみ
+_GEOCODER_BACKEND = os.getenv('GEOCODER_BACKEND', 'nominatim')
+_boundary_index = None
+
+def _count_geo(name):
+    with _geo_stats_lock:
+        _geo_stats[name] += 1
+
+def _cached_location(key):
+    """メモリ → 永続キャッシュの順に引く。どちらにもなければ None"""
+    if key in _geo_cache:
+        _count_geo("memory_hits")
+        return _geo_cache[key]
+
+    stored = _geocode_store.get(key)
+    if stored is not None:
+        _geo_cache[key] = stored
+    return stored
+
+def resolve_location(lat, lon):
+    """(都道府県, 市区町村, 詳細住所) と、実際に答えた取得元を返す
+
+    取得元は "cache" / "nominatim" / "offline"（GEOCODER_BACKEND=offline）/
+    "fallback"（Nominatim が失敗してオフライン索引で代用）のいずれか。
+    """
+    key = geohash(lat, lon, _GEOHASH_PRECISION)
+    cached = _cached_location(key)
+    if cached is not None:
+        return cached, "cache"
+
+    if _GEOCODER_BACKEND == 'offline':
+        # 索引の結果はキャッシュしない（Nominatim に戻したときに詳細住所の取得を妨げないよう）
+        return _offline_geocode(lat, lon), "offline"
+
+    try:
+        _count_geo("lookups")
+        result = _reverse_geocode(lat, lon)
+        _geo_cache[key] = result
+        _geocode_store.put(key, result)
+        return result, "nominatim"
+
+    except Exception as e:
+        _count_geo("failures")
+        logger.warning("Geocode failed: %s", e)
+        return _offline_geocode(lat, lon), "fallback"
 
 def _latlon_to_pref_city(lat, lon):
     """都道府県 + 市区町村 + 町名 + 丁目 + 番地 などを返す"""
     if lat is None or lon is None:
         return None, None, None
+    return resolve_location(lat, lon)[0]
+
+def _get_boundary_index():
+    global _boundary_index
+    if _boundary_index is None and os.path.exists(_BOUNDARY_INDEX_PATH):
+        _boundary_index = BoundaryIndex(_BOUNDARY_INDEX_PATH)
+    return _boundary_index
+
+def _offline_geocode(lat, lon):
+    """ネットワークを使わずに (都道府県, 市区町村, 住所) を返す"""
+    _count_geo("offline")
+    index = _get_boundary_index()
+    if index is not None:
+        found = index.lookup(lat, lon)
+        if found is not None:
+            pref, city = found
+            return pref, city, f"{pref or ''}{city or ''}"
+    pref = nearest_prefecture(lat, lon)
+    return pref, None, pref
 
-    key = f"{round(lat,3)},{round(lon,3)}"
+_geo_executor = None
+_geo_executor_pid = None
+_geo_inflight = set()
+_geo_lock = threading.Lock()
+
+def prefetch_location(lat, lon):
+    """詳細住所の逆ジオコーディングをバックグラウンドで開始する（キャッシュ済み・実行中なら何もしない）"""
+    global _geo_executor, _geo_executor_pid
+    if lat is None or lon is None:
+        return
+    key = geohash(lat, lon, _GEOHASH_PRECISION)
     if key in _geo_cache:
-        return _geo_cache[key]
+        return
+    with _geo_lock:
+        if key in _geo_inflight:
+            return
+        _geo_inflight.add(key)
+        # スレッドは fork を越えないので、ワーカープロセスごとに作り直す
+        if _geo_executor is None or _geo_executor_pid != os.getpid():
+            _geo_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="geocode")
+            _geo_executor_pid = os.getpid()
+    _geo_executor.submit(_resolve_in_background, key, lat, lon)
 
+def _resolve_in_background(key, lat, lon):
     try:
-        loc = _geocoder.reverse(
-            (lat, lon),
-            language="ja",
-            zoom=16,  # より詳細な住所を取得
-            timeout=2,
-        )
-        addr = loc.raw.get("address", {}) if loc else {}
-
-        # 都道府県
-        pref = addr.get("state") or addr.get("region") or addr.get("province")
-        # 市区町村
-        city = (
-            addr.get("city") or addr.get("town") or addr.get("village")
-            or addr.get("municipality") or addr.get("county")
-        )
-        # 町名・丁目・番地など
-        suburb = addr.get("suburb")
-        neighbourhood = addr.get("neighbourhood")
-        road = addr.get("road")
-        house_number = addr.get("house_number")
-        # 詳細住所文字列を生成
-        detailed_address = f"{pref or ''}{city or ''}{suburb or ''}{neighbourhood or ''}{road or ''}{house_number or ''}"
-        _geo_cache[key] = (pref, city, detailed_address)
-        return pref, city, detailed_address
+        _latlon_to_pref_city(lat, lon)
+    finally:
+        with _geo_lock:
+            _geo_inflight.discard(key)
 
-    except Exception as e:
-        logger.warning("Geocode failed: %s", e)
+def _latlon_to_pref_city_nowait(lat, lon):
+    """キャッシュ済みなら詳細住所を、未取得なら都道府県だけをすぐに返す
+
+    詳細住所はバックグラウンドで取得し、以降のターンで使われる。
+    """
+    if lat is None or lon is None:
         return None, None, None
 
+    cached = _cached_location(geohash(lat, lon, _GEOHASH_PRECISION))
+    if cached is not None:
+        return cached
+
+    prefetch_location(lat, lon)
+    return _offline_geocode(lat, lon)
+
+def _reverse_geocode(lat, lon):
+    """Nominatim で逆ジオコーディングして (都道府県, 市区町村, 詳細住所) を返す"""
+    loc = _geocoder.reverse(
+        (lat, lon),
+        language="ja",
+        zoom=16,  # より詳細な住所を取得
+        timeout=2,
+    )
+    addr = loc.raw.get("address", {}) if loc else {}
+
+    # 都道府県
+    pref = addr.get("state") or addr.get("region") or addr.get("province")
+    # 市区町村
+    city = (
+        addr.get("city") or addr.get("town") or addr.get("village")
+        or addr.get("municipality") or addr.get("county")
+    )
+    # 町名・丁目・番地など
+    suburb = addr.get("suburb")
+    neighbourhood = addr.get("neighbourhood")
+    road = addr.get("road")
+    house_number = addr.get("house_number")
+    # 詳細住所文字列を生成
+    detailed_address = f"{pref or ''}{city or ''}{suburb or ''}{neighbourhood or ''}{road or ''}{house_number or ''}"
+    return pref, city, detailed_address
+
+def _geocode_metrics():
+    stats = geocode_stats()
+    return [
+        ("geocode_lookups_total", "counter", {"source": "memory"}, stats["memory_hits"]),
+        ("geocode_lookups_total", "counter", {"source": "store"}, stats["store_hits"]),
+        ("geocode_lookups_total", "counter", {"source": "nominatim"}, stats["lookups"]),
+        ("geocode_lookups_total", "counter", {"source": "offline"}, stats["offline"]),
+        ("geocode_failures_total", "counter", {}, stats["failures"]),
+        ("geocode_store_entries", "gauge", {}, stats["store_size"]),
+    ]
+
+def geocode_stats():
+    """逆ジオコーディングのキャッシュ命中状況"""
+    store = _geocode_store.stats()
+    with _geo_stats_lock:
+        stats = dict(_geo_stats)
+    return {
+        "memory_hits": stats["memory_hits"],
+        "store_hits": store["hits"],
+        "store_size": store["size"],
+        "lookups": stats["lookups"],
+        "failures": stats["failures"],
+        "offline": stats["offline"],
+    }
+
+metrics.register_collector(_geocode_metrics)
+
 
 class CharacterService:
     def __init__(self):
+        # "openai": OpenAI API / "fake": 負荷試験用のローカル代替（src/fake_llm.py）
+        self.llm_backend = os.getenv('LLM_BACKEND', 'openai')
         api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
+        if self.llm_backend == 'openai' and not api_key:
             raise ValueError("OPENAI_API_KEY is not set in .env file")
-        self.openai_client = OpenAI(api_key=api_key)
-        self.characters = self._load_characters()
+        self._api_key = api_key
+        self._openai_client = None
+        self._client_pid = None
+        # OpenAI 呼び出しの流量制御・再試行（SDK 側の再試行は無効にしてここに一本化する）
+        self.completion_gate = CompletionGate(
+            rpm=int(os.getenv('OPENAI_RPM_LIMIT', 0)),
+            tpm=int(os.getenv('OPENAI_TPM_LIMIT', 0)),
+            max_concurrency=int(os.getenv('OPENAI_MAX_CONCURRENCY', 16)),
+            max_retries=int(os.getenv('OPENAI_MAX_RETRIES', 4)),
+            deadline=float(os.getenv('OPENAI_DEADLINE_SECONDS', 30)),
+        )
+        # 段階ごとのモデル・出力上限・期限と、遅い応答へのヘッジ（src/model_routing.py）
+        self.routes = load_routes(self.completion_gate.deadline)
+        self.hedger = Hedger(max_workers=self.completion_gate.max_concurrency * 2)
+        # characters.csv は更新時刻を見て読み直す（CHARACTER_RELOAD_INTERVAL=0 で無効）。
+        # キャラクターごとのシステムプロンプトは読み込み時に一度だけ組み立てる
+        self.catalog_loader = CatalogLoader(
+            os.path.join(os.path.dirname(__file__), 'characters.csv'),
+            self._compile_system_prompts,
+            check_interval=float(os.getenv('CHARACTER_RELOAD_INTERVAL', 2)),
+            on_reload=self._on_catalog_reload,
+        )
+        # "serial": 発言→選択肢の2回呼び出し / "combined": 1回の構造化出力でまとめて生成
+        self.pipeline_mode = os.getenv('DIALOGUE_PIPELINE_MODE', 'serial')
+        self.geocode_blocking = os.getenv('GEOCODE_BLOCKING') == '1'
+        # 構造化出力が崩れて選択肢が4つそろわなかったときに、足りない分を生成し直す回数
+        self.options_max_retries = int(os.getenv('OPTIONS_MAX_RETRIES', 1))
+        # /dialogue/batch の同時実行数と1リクエストあたりのジョブ数の上限
+        self.batch_parallelism = int(os.getenv('DIALOGUE_BATCH_PARALLELISM', 8))
+        self.batch_max_jobs = int(os.getenv('DIALOGUE_BATCH_MAX_JOBS', 1000))
+        # 完全一致の応答キャッシュ（DIALOGUE_CACHE_ENABLED=1 で有効）
+        self.response_cache = None
+        if os.getenv('DIALOGUE_CACHE_ENABLED') == '1':
+            self.response_cache = ResponseCache(
+                maxsize=int(os.getenv('DIALOGUE_CACHE_MAXSIZE', 1000)),
+                ttl=int(os.getenv('DIALOGUE_CACHE_TTL', 60*60)),
+                variants=int(os.getenv('DIALOGUE_CACHE_VARIANTS', 3)),
+            )
+        # 会話履歴の圧縮（HISTORY_WINDOW_TURNS > 0 で有効）
+        self.history_compactor = None
+        history_window = int(os.getenv('HISTORY_WINDOW_TURNS', 0))
+        if history_window > 0:
+            self.history_compactor = HistoryCompactor(
+                self._summarize_history,
+                window=history_window,
+                interval=int(os.getenv('HISTORY_SUMMARY_INTERVAL', 4)),
+            )
+        # 初期会話の事前生成プール（OPENING_POOL_ENABLED=1 で有効）
+        self.opening_pool = None
+        if os.getenv('OPENING_POOL_ENABLED') == '1':
+            self.opening_pool = OpeningPool(
+                self._generate_opening,
+                size=int(os.getenv('OPENING_POOL_SIZE', 4)),
+                low_watermark=int(os.getenv('OPENING_POOL_LOW_WATERMARK', 2)),
+                ttl=int(os.getenv('OPENING_POOL_TTL', 60*60)),
+                workers=int(os.getenv('OPENING_POOL_WORKERS', 2)),
+            )
+        # 選択肢ごとの次の発言の先読み（SPECULATIVE_REPLIES=1 で有効）
+        self.speculative_replies = None
+        self.speculative_types = [t for t in os.getenv('SPECULATIVE_TYPES', ','.join(OPTION_TYPES)).split(',') if t]
+        if os.getenv('SPECULATIVE_REPLIES') == '1':
+            self.speculative_replies = SpeculativeReplies(
+                self._generate_speculative_reply,
+                ttl=int(os.getenv('SPECULATIVE_TTL', 120)),
+                workers=int(os.getenv('SPECULATIVE_WORKERS', 4)),
+                tokens_per_minute=int(os.getenv('SPECULATIVE_TPM', 200000)),
+            )
         
 
 
-    def _load_characters(self):
-        characters = {}
-        csv_path = os.path.join(os.path.dirname(__file__), 'characters.csv')
-        try:
-            with open(csv_path, 'r', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                print(f"CSV columns: {reader.fieldnames}")
-                for row in reader:
-                    print(f"Row keys: {list(row.keys())}")
-                    if 'キャラクターID' not in row:
-                        print(f"Missing キャラクターID in row: {row}")
-                        continue
-                    characters[row['キャラクターID']] = row
-        except FileNotFoundError:
-            print(f"Warning: {csv_path} not found")
-        except Exception as e:
-            print(f"Error loading CSV: {e}")
-        return characters
+    @property
+    def openai_client(self):
+        # HTTP接続プールを fork 先のワーカーと共有しないよう、プロセスごとに遅延生成する
+        if self._openai_client is None or self._client_pid != os.getpid():
+            if self.llm_backend == 'fake':
+                self._openai_client = FakeOpenAI()
+            else:
+                self._openai_client = OpenAI(api_key=self._api_key, max_retries=0)
+            self._client_pid = os.getpid()
+        return self._openai_client
+
+    @openai_client.setter
+    def openai_client(self, client):
+        self._openai_client = client
+        self._client_pid = os.getpid()
+
+    @property
+    def catalog(self):
+        return self.catalog_loader.current()
+
+    @property
+    def characters(self):
+        return self.catalog.characters
+
+    @property
+    def system_prompts(self):
+        return self.catalog.system_prompts
+
+    def _on_catalog_reload(self, catalog):
+        # 事前生成済みの初期会話は古い設定で作られているので捨てる
+        if self.opening_pool is not None:
+            self.opening_pool.clear()
 
     def _get_current_context(self, lat=None, lon=None):
         now = datetime.now(tz=tz.gettz("Asia/Tokyo"))
@@ -118,7 +353,10 @@ class CharacterService:
         weekdays = ["月曜日", "火曜日", "水曜日", "木曜日", "金曜日", "土曜日", "日曜日"]
         weekday = weekdays[now.weekday()]
         
-        pref, city, detailed_address = _latlon_to_pref_city(lat, lon) or ("場所不明", "", "")
+        # 逆ジオコーディングの完了は待たない（GEOCODE_BLOCKING=1 で従来どおり待つ）
+        resolve = _latlon_to_pref_city if self.geocode_blocking else _latlon_to_pref_city_nowait
+        with metrics.span("geocode"):
+            pref, city, detailed_address = resolve(lat, lon) or ("場所不明", "", "")
         return {
             "date": now.strftime("%Y年%m月%d日"),
             "season": season,
@@ -132,160 +370,347 @@ class CharacterService:
             "detailed_address": detailed_address,
         }
 
-    def generate_initial_dialogue(self, character_id, lat=None, lon=None, affection_level=40):
-        print("TEST")
-        print(f"Generating initial dialogue for character_id: {character_id} with affection_level: {affection_level}")
+    def generate_initial_dialogue(self, character_id, lat=None, lon=None, affection_level=40, speculate=True, session_id=None, use_pool=True):
+        logger.debug("Generating initial dialogue for character_id=%s affection_level=%s", character_id, affection_level)
         character_data = self.characters.get(character_id)
         if not character_data:
-            return {"message": "キャラクターが見つかりません。", "options": [], "debug_affection_level": affection_level}
+            return {"message": "キャラクターが見つかりません。", "error": "Character not found", "options": [], "debug_affection_level": affection_level}
 
         context = self._get_current_context(lat, lon)
-        character_prompt = self._build_initial_character_prompt(character_data, context, affection_level)
+        pooled = self._take_opening(character_id, context, affection_level) if use_pool else None
+        if pooled:
+            if speculate:
+                self._speculate_replies(character_id, pooled["message"], [], pooled["options"], lat, lon, affection_level, session_id)
+            return pooled
         
         try:
-            # キャラクター発言を生成
-            character_response = self._generate_with_openai(character_prompt, is_character=True)
-            message = character_response.strip()
-            
-            # キャラクター発言内容を4択選択肢生成プロンプトに渡す
-            gender = character_data['性別']
-            options_prompt = self._build_initial_options_prompt(character_data, message, gender)
-            options_response = self._generate_with_openai(options_prompt, is_character=False)
-            options = self._parse_options_only(options_response)
-            
+            message, options = self._generate_initial_turn(character_data, context, affection_level)
+            if speculate:
+                self._speculate_replies(character_id, message, [], options, lat, lon, affection_level, session_id)
             random.shuffle(options)
             return {"message": message, "options": options, "debug_affection_level": affection_level}
         except Exception as e:
-            return {"message": f"初期会話生成エラー: {str(e)}", "options": [], "debug_affection_level": affection_level}
+            logger.exception("Initial dialogue generation failed for %s", character_id)
+            return {"message": f"初期会話生成エラー: {str(e)}", "error": str(e), "options": [], "debug_affection_level": affection_level}
+
+    def _generate_initial_turn(self, character_data, context, affection_level):
+        """初期発言と選択肢を生成して (message, options) を返す"""
+        character_prompt = self._build_initial_character_prompt(character_data, context, affection_level)
+        combined = self._generate_combined(character_data, character_prompt) if self.pipeline_mode == 'combined' else None
+        if combined:
+            return combined
 
-    def generate_next_dialogue(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None):
-        print("TEST")
-        print(f"Generating next dialogue for character_id: {character_id} with affection_level: {affection_level}")
+        # キャラクター発言を生成
+        character_response = self._generate_with_openai(character_prompt, is_character=True, character_data=character_data)
+        message = character_response.strip()
+
+        # キャラクター発言内容を4択選択肢生成プロンプトに渡す
+        gender = character_data['性別']
+        options_prompt = self._build_initial_options_prompt(character_data, message, gender)
+        return message, self._generate_option_list(options_prompt, character_data)
+
+    def _opening_bucket(self, character_id, context, affection_level):
+        return (character_id, context['pref'], context['city'], context['time_period'], affection_level)
+
+    def _take_opening(self, character_id, context, affection_level):
+        """事前生成プールに在庫があれば初期会話のレスポンスを返す"""
+        if self.opening_pool is None:
+            return None
+        entry = self.opening_pool.take(self._opening_bucket(character_id, context, affection_level))
+        if entry is None:
+            return None
+        message, options = entry
+        options = list(options)
+        random.shuffle(options)
+        return {"message": message, "options": options, "debug_affection_level": affection_level}
+
+    def _generate_opening(self, bucket):
+        """プール補充用に、バケットの地域・時間帯で初期会話を1件生成する"""
+        character_id, pref, city, time_period, affection_level = bucket
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            return None
+        context = self._get_current_context()
+        if context['time_period'] != time_period:
+            # 時間帯が変わったバケットは補充しない
+            return None
+        # プール分は市区町村単位の住所で生成し、同じ地域のプレイヤーで共有する
+        context.update(pref=pref, city=city, detailed_address=f"{pref or ''}{city or ''}")
+        message, options = self._generate_initial_turn(character_data, context, affection_level)
+        if not options:
+            return None
+        return message, tuple(options)
+
+    def generate_next_dialogue(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None, speculate=True, session_id=None):
+        logger.debug("Generating next dialogue for character_id=%s affection_level=%s", character_id, affection_level)
         character_data = self.characters.get(character_id)
         if not character_data:
-            return {"message": "キャラクターが見つかりません。", "options": [], "debug_affection_level": affection_level}
+            return {"message": "キャラクターが見つかりません。", "error": "Character not found", "options": [], "debug_affection_level": affection_level}
 
         context = self._get_current_context(lat, lon)
         character_prompt = self._build_next_character_prompt(character_data, user_choice, conversation_history, context, affection_level)
 
         try:
-            # キャラクター発言を生成
-            character_response = self._generate_with_openai(character_prompt, is_character=True)
-            message = character_response.strip()
-            
-            # キャラクター発言内容を4択選択肢生成プロンプトに渡す
+            # 先読み済みの発言があれば、選択肢だけを生成する
+            message = self._take_speculative_reply(character_id, user_choice, conversation_history, lat, lon, affection_level, session_id)
+            combined = None
+            if message is None and self.pipeline_mode == 'combined':
+                combined = self._generate_combined(character_data, character_prompt)
+            if combined:
+                message, options = combined
+            else:
+                if message is None:
+                    # キャラクター発言を生成
+                    character_response = self._generate_with_openai(character_prompt, is_character=True, character_data=character_data)
+                    message = character_response.strip()
+
+                # キャラクター発言内容を4択選択肢生成プロンプトに渡す
+                gender = character_data['性別']
+                options_prompt = self._build_next_options_prompt(character_data, message, user_choice, conversation_history, gender)
+                options = self._generate_option_list(options_prompt, character_data)
+
+            if speculate:
+                self._speculate_replies(character_id, message, conversation_history, options, lat, lon, affection_level, session_id)
+            random.shuffle(options)
+            return {"message": message, "options": options, "debug_affection_level": affection_level}
+        except Exception as e:
+            logger.exception("Next dialogue generation failed for %s", character_id)
+            return {"message": f"次の会話生成エラー: {str(e)}", "error": str(e), "options": [], "debug_affection_level": affection_level}
+
+    def stream_next_dialogue(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None, session_id=None):
+        """キャラクター発言をトークン単位で逐次返し、最後に選択肢を返すジェネレーター
+
+        ("delta", {"text": ...}) をトークン到着ごとに、発言完了後に
+        ("options", {"message": ..., "options": [...]}) を1回 yield する。
+        失敗時は ("error", {"message": ...}) を yield して終了する。
+        """
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            yield "error", {"message": "キャラクターが見つかりません。"}
+            return
+
+        context = self._get_current_context(lat, lon)
+        character_prompt = self._build_next_character_prompt(character_data, user_choice, conversation_history, context, affection_level)
+
+        try:
+            message = self._take_speculative_reply(character_id, user_choice, conversation_history, lat, lon, affection_level, session_id)
+            if message is not None:
+                # 先読み済みの発言は一度に送る
+                yield "delta", {"text": message}
+            else:
+                # キャラクター発言をストリーミングで転送
+                chunks = []
+                for delta in self._stream_with_openai(character_prompt, is_character=True, character_data=character_data):
+                    chunks.append(delta)
+                    yield "delta", {"text": delta}
+                message = "".join(chunks).strip()
+
+            # 発言確定後に4択選択肢を生成
             gender = character_data['性別']
             options_prompt = self._build_next_options_prompt(character_data, message, user_choice, conversation_history, gender)
-            options_response = self._generate_with_openai(options_prompt, is_character=False)
-            options = self._parse_options_only(options_response)
-            
+            options = self._generate_option_list(options_prompt, character_data)
+
+            self._speculate_replies(character_id, message, conversation_history, options, lat, lon, affection_level, session_id)
             random.shuffle(options)
-            return {"message": message, "options": options, "debug_affection_level": affection_level}
+            yield "options", {"message": message, "options": options, "debug_affection_level": affection_level}
         except Exception as e:
-            return {"message": f"次の会話生成エラー: {str(e)}", "options": [], "debug_affection_level": affection_level}
+            logger.exception("Streaming dialogue generation failed for %s", character_id)
+            yield "error", {"message": f"次の会話生成エラー: {str(e)}"}
 
-    def generate_character_message(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None):
-        print(f"[character_message] affection_level: {affection_level}")
+    def generate_character_message(self, character_id, user_choice, conversation_history, lat=None, lon=None, affection_level=None, session_id=None):
+        logger.debug("Generating character message for character_id=%s affection_level=%s", character_id, affection_level)
         character_data = self.characters.get(character_id)
         if not character_data:
-            return {"message": "キャラクターが見つかりません。"}
+            return {"message": "キャラクターが見つかりません。", "error": "Character not found"}
+
+        speculative = self._take_speculative_reply(character_id, user_choice, conversation_history, lat, lon, affection_level, session_id)
+        if speculative is not None:
+            return {"message": speculative}
 
         context = self._get_current_context(lat, lon)
         character_prompt = self._build_next_character_prompt(character_data, user_choice, conversation_history, context, affection_level)
         try:
-            character_response = self._generate_with_openai(character_prompt, is_character=True)
+            character_response = self._generate_with_openai(character_prompt, is_character=True, character_data=character_data)
             message = character_response.strip()
             return {"message": message}
         except Exception as e:
-            return {"message": f"キャラクター発言生成エラー: {str(e)}"}
+            logger.exception("Character message generation failed for %s", character_id)
+            return {"message": f"キャラクター発言生成エラー: {str(e)}", "error": str(e)}
 
-    def generate_options(self, character_id, character_message, user_choice, conversation_history, lat=None, lon=None, affection_level=None):
-        print(f"[options] affection_level: {affection_level}")
+    def generate_options(self, character_id, character_message, user_choice, conversation_history, lat=None, lon=None, affection_level=None, session_id=None):
+        logger.debug("Generating options for character_id=%s affection_level=%s", character_id, affection_level)
         character_data = self.characters.get(character_id)
         if not character_data:
             return {"options": []}
         gender = character_data['性別']
         options_prompt = self._build_next_options_prompt(character_data, character_message, user_choice, conversation_history, gender)
         try:
-            options_response = self._generate_with_openai(options_prompt, is_character=False)
-            options = self._parse_options_only(options_response)
+            options = self._generate_option_list(options_prompt, character_data)
+            self._speculate_replies(character_id, character_message, conversation_history, options, lat, lon, affection_level, session_id)
             random.shuffle(options)
             return {"options": options}
         except Exception as e:
+            logger.exception("Options generation failed for %s", character_id)
             return {"options": []}
 
-    def _build_initial_character_prompt(self, character_data, context, affection_level):
-        name        = character_data['名前']
-        gender      = character_data['性別']
-        personality = character_data['性格']
-        first_person = character_data['一人称']
-        fan_name    = character_data['ファンの名称']
-        tone        = character_data['口調']
-        setting     = character_data['背景・設定']
-        
-        # キャラクター発言生成用プロンプト
-        character_prompt = f"""
-あなたは{gender}の{personality}キャラクターです。
-一人称は「{first_person}」で、ファンのことを「{fan_name}」と呼びます。
-{tone}で話し、{setting}という設定です。
+    @staticmethod
+    def _speculation_slot(character_id, character_message, conversation_history, session_id=None):
+        # 選択肢を出した時点の会話。次のリクエストでは履歴の末尾に (選択, この発言) が積まれている。
+        # プールやキャッシュから同じ発言を受け取ったプレイヤー同士で上書きし合わないよう、セッションも含める
+        return ResponseCache.make_key(
+            session_id=session_id, character_id=character_id, message=character_message, history=conversation_history
+        )
 
-【重要】好感度パラメーター: {affection_level}（0〜100）
-以下の好感度対応表に従って、必ず言葉遣いと表現を調整してください：
+    def _speculate_replies(self, character_id, character_message, conversation_history, options, lat, lon, affection_level, session_id=None):
+        """選択肢ごとに、それを選んだ場合の次の発言をバックグラウンドで生成しておく"""
+        if self.speculative_replies is None or not character_message or not options:
+            return
+        character_data = self.characters.get(character_id)
+        if not character_data:
+            return
+        base_cost = len(self._system_prompt(character_data, "character")) + self.routes["speculative"].max_tokens
+        base_cost += sum(len(str(turn.get("user", ""))) + len(str(turn.get("character", ""))) for turn in conversation_history)
+        jobs = []
+        for option in options:
+            if option["type"] not in self.speculative_types:
+                continue
+            next_affection = affection_after(affection_level, option["type"])
+            history = list(conversation_history) + [{"user": option["text"], "character": character_message}]
+            key = (option["text"], next_affection, lat, lon)
+            jobs.append((key, base_cost + len(option["text"]), (character_id, option["text"], history, lat, lon, next_affection)))
+        self.speculative_replies.speculate(self._speculation_slot(character_id, character_message, conversation_history, session_id), jobs)
 
-▼好感度対応表（絶対厳守）
-- {affection_level}81~100: 好意的で甘い表現（「素敵ですね♪」「大好き」「一緒にいると楽しい」など）
-- {affection_level}61~80: 友達のようなフランクで親しみやすい表現（「そうだね！」「いいじゃん」「楽しそう」など）
-- {affection_level}41~60: 普通の丁寧で標準的な表現（「そうですね」「はい」「いいと思います」など）
-- {affection_level}21~40: そっけない素っ気ない表現
-- {affection_level}0~20: 憤怒する
+    def _generate_speculative_reply(self, job):
+        character_id, user_choice, conversation_history, lat, lon, affection_level = job
+        character_data = self.characters[character_id]
+        context = self._get_current_context(lat, lon)
+        character_prompt = self._build_next_character_prompt(character_data, user_choice, conversation_history, context, affection_level)
+        return self._create_completion(
+            stage="speculative",
+            messages=self._build_messages(character_prompt, True, character_data),
+            temperature=1.0
+        )
 
-現在の状況:
-- 日付: {context['date']} ({context['weekday']})
-- 時間帯: {context['time_period']} ({context['time_detail']})
-- 現在地: {context['detailed_address']} 
+    def _take_speculative_reply(self, character_id, user_choice, conversation_history, lat, lon, affection_level, session_id=None):
+        """このリクエスト向けに先読みした発言があれば返す（生成中なら待つ）"""
+        if self.speculative_replies is None or not user_choice or not conversation_history:
+            return None
+        last_turn = conversation_history[-1]
+        if last_turn.get("user") != user_choice:
+            return None
+        slot = self._speculation_slot(character_id, last_turn.get("character"), list(conversation_history[:-1]), session_id)
+        return self.speculative_replies.take(slot, (user_choice, affection_level, lat, lon), timeout=self.completion_gate.deadline)
 
-好感度{affection_level}に適した言葉遣いで、「{context['detailed_address']} 」らしさ（位置情報から取得した場所の名所など）を盛り込んだ自然なメッセージを生成してください。
-質問文は一回の会話につき、一つだけにしてください。
+    def generate_batch(self, jobs, parallelism=None):
+        """複数の会話生成ジョブを並列に実行し、完了した順に結果を yield する
 
-▼ルール
-- {name}のセリフのみを生成する
-- 好感度{affection_level}の言葉遣いを必ず適用する
-- Pythonで200文字以内になるように生成する
-"""
+        ジョブは {"character_id", "lat", "lon", "affection_level", "history", "user_choice"} の辞書。
+        user_choice があれば history に続く次の会話を、なければ初期会話を生成する。
+        結果には入力順の "index" を付ける。プレイヤーの操作を待つわけではないので先読みはせず、
+        プレイヤー向けの初期会話プールの在庫も使わない。
+        """
+        parallelism = max(1, min(parallelism or self.batch_parallelism, self.batch_parallelism))
+        executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="dialogue-batch")
+        try:
+            futures = {executor.submit(self._run_batch_job, job): index for index, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                yield {"index": futures[future], **future.result()}
+        finally:
+            # クライアントが途中で切断したら未着手のジョブは捨てる
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        return character_prompt
+    def _run_batch_job(self, job):
+        try:
+            character_id = job.get("character_id")
+            lat, lon = job.get("lat"), job.get("lon")
+            affection_level = job.get("affection_level", 40)
+            if job.get("user_choice") is None:
+                response = self.generate_initial_dialogue(character_id, lat, lon, affection_level, speculate=False, use_pool=False)
+            else:
+                response = self.generate_next_dialogue(
+                    character_id, job["user_choice"], job.get("history") or [], lat, lon, affection_level, speculate=False
+                )
+            return {"character_id": character_id, **response}
+        except Exception as e:
+            return {"character_id": job.get("character_id"), "error": str(e)}
 
-    def _build_initial_options_prompt(self, character_data, character_message, gender):
-        name = character_data['名前']
-        
-        # システムによる4択選択肢生成用プロンプト
-        options_prompt = f"""
-あなたは{name}とは別人で、{name}の{gender}とは違う性別の同級生です。一人称は「僕」です。{name}というキャラクターに対して、返答となるセリフの選択肢を4つ生成してください。
-必ず一人称視点のセリフを生成してください。セリフの中に{name}を含めないでください。
+    def submit_offline_batch(self, jobs):
+        """ジョブを OpenAI Batch API に投入する（結果は最大24時間後、料金は半額）
 
-直前の{name}の発言: 「{character_message}」
+        発言と選択肢は combined 形式の1リクエストにまとめる。存在しないキャラクターの
+        ジョブは投入せず、skipped に index を返す。
+        """
+        lines, skipped = [], []
+        combined_route = self.routes["combined"]
+        for index, job in enumerate(jobs):
+            character_data = self.characters.get(job.get("character_id"))
+            if not character_data:
+                skipped.append(index)
+                continue
+            context = self._get_current_context(job.get("lat"), job.get("lon"))
+            affection_level = job.get("affection_level", 40)
+            if job.get("user_choice") is None:
+                character_prompt = self._build_initial_character_prompt(character_data, context, affection_level)
+            else:
+                character_prompt = self._build_next_character_prompt(
+                    character_data, job["user_choice"], job.get("history") or [], context, affection_level
+                )
+            combined_prompt = self._build_combined_prompt(character_data, character_prompt)
+            lines.append(json.dumps({
+                "custom_id": str(index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": combined_route.model,
+                    "messages": self._build_messages(combined_prompt, character_data=character_data, kind="combined"),
+                    "max_tokens": combined_route.max_tokens,
+                    "temperature": 1.0,
+                    "response_format": COMBINED_RESPONSE_FORMAT,
+                },
+            }, ensure_ascii=False))
 
+        if not lines:
+            return {"batch_id": None, "status": "empty", "jobs": 0, "skipped": skipped}
+        input_file = self.openai_client.files.create(
+            file=("dialogue_batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = self.openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return {"batch_id": batch.id, "status": batch.status, "jobs": len(lines), "skipped": skipped}
 
-▼選択肢の種類（1つずつ生成）
-- #v-good: ユーザーが{name}に対して発するとても好意的なセリフ（好感度+10）
-- #good: ユーザーが{name}に対して発するやや好意的なセリフ（好感度+5）
-- #bad: ユーザーが{name}に対して発するやや悪印象なセリフ（好感度-5）
-- #v-bad: ユーザーが{name}に対して発する非常に悪印象なセリフ（好感度-10）
+    def offline_batch_status(self, batch_id):
+        batch = self.openai_client.batches.retrieve(batch_id)
+        return {"batch_id": batch.id, "status": batch.status, "output_file_id": batch.output_file_id}
 
-▼フォーマット（厳守）
-1. 「～」 #v-good
-2. 「～」 #good
-3. 「～」 #bad
-4. 「～」 #v-bad
+    def offline_batch_results(self, output_file_id):
+        """完了した Batch API の出力ファイルを解析し、ジョブごとの結果を yield する"""
+        content = self.openai_client.files.content(output_file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            index = int(record["custom_id"])
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                yield {"index": index, "error": str(record.get("error") or response.get("body"))}
+                continue
+            parsed = self._parse_combined(response["body"]["choices"][0]["message"]["content"])
+            if parsed is None:
+                yield {"index": index, "error": "unparseable output"}
+                continue
+            message, options = parsed
+            yield {"index": index, "message": message, "options": options}
 
-▼ルール
-- 必須: キャラクターの直前セリフに
-明確な質問（Who / What / When / Where / Why / How / どんな…?）が含まれる場合、候補a は必ず“質問に直接答える具体的な返答” にする。
-"""
+    def _compile_system_prompts(self, character_data):
+        """キャラクターごとに不変なシステムプロンプトを組み立てる
 
-        return options_prompt
-
-    def _build_next_character_prompt(self, character_data, user_choice, conversation_history, context, affection_level=None):
+        リクエストごとに変わる情報（好感度・日時・現在地・履歴）はユーザーメッセージ側に
+        まとめ、先頭の長い共通部分がプロバイダ側のプロンプトキャッシュに載るようにする。
+        """
         name        = character_data['名前']
         gender      = character_data['性別']
         personality = character_data['性格']
@@ -294,12 +719,8 @@ class CharacterService:
         tone        = character_data['口調']
         setting     = character_data['背景・設定']
 
-        history_str = "\n".join(
-            f"ユーザー: {h['user']}\n{name}: {h['character']}" for h in conversation_history
-        )
-
-        # キャラクター発言生成用プロンプト
-        character_prompt = f"""
+        # キャラクター発言生成用
+        character_system = f"""
 # キャラクター設定
 あなたは{gender}の{personality}キャラクター「{name}」です。
 - 一人称: {first_person}
@@ -307,12 +728,20 @@ class CharacterService:
 - 口調: {tone}
 - 背景: {setting}
 
-# 応答生成の思考プロセス
+# 好感度対応表（絶対厳守）
+「状況」に示す現在の好感度（0〜100）に応じて、下記から適切な言葉遣いを厳密に選択してください。
+- 81~100: 好意的で甘い表現（例：「素敵ですね♪」「大好き」「一緒にいると楽しい」）
+- 61~80: 友達のようなフランクで親しみやすい表現（例：「そうだね！」「いいじゃん」「楽しそう」）
+- 41~60: 普通の丁寧で標準的な表現（例：「そうですね」「はい」「いいと思います」）
+- 21~40: そっけない、少し距離のある表現（例：「ふーん」「そうですか」）
+- 0~20: 憤りや拒絶を感じさせる冷たい表現（例：「意味が分かりません」「もういいです」）
+
+# 応答生成の思考プロセス（会話の続きを生成する場合）
 以下のステップに従って、論理的で一貫性のある応答を生成してください。
 
 1.  **会話の文脈分析:**
     -   これまでの会話履歴を読み、現在の主要な話題を特定します。
-    -   ユーザーが選択した「{user_choice}」という発言の意図（例：同意、質問、感情表現、話題転換など）を分析します。
+    -   ユーザーの直前の発言の意図（例：同意、質問、感情表現、話題転換など）を分析します。
 
 2.  **応答方針の決定:**
     -   分析した意図に基づき、応答の方針を決定します。（例：「ユーザーの意見に共感し、関連する自分の体験を話す」「ユーザーの質問に具体的に答え、逆質問を投げかける」など）
@@ -321,22 +750,105 @@ class CharacterService:
     -   決定した方針と、以下の【絶対厳守ルール】に従って、{name}としての自然なセリフを生成します。
 
 # 【絶対厳守ルール】
-- **好感度レベルの適用:** 現在の好感度「{affection_level}」に応じて、下記の対応表から適切な言葉遣いを厳密に選択してください。
-    - 81~100: 好意的で甘い表現（例：「素敵ですね♪」「大好き」「一緒にいると楽しい」）
-    - 61~80: 友達のようなフランクで親しみやすい表現（例：「そうだね！」「いいじゃん」「楽しそう」）
-    - 41~60: 普通の丁寧で標準的な表現（例：「そうですね」「はい」「いいと思います」）
-    - 21~40: そっけない、少し距離のある表現（例：「ふーん」「そうですか」）
-    - 0~20: 憤りや拒絶を感じさせる冷たい表現（例：「意味が分かりません」「もういいです」）
+- **好感度レベルの適用:** 好感度対応表の言葉遣いを必ず適用してください。
 - **セリフのみ出力:** {name}のセリフのみを生成し、思考プロセスや説明は一切含めないでください。
 - **文字数:** 200文字以内で簡潔にまとめてください。
 - **質問:** 質問は1回の発言につき1つまでです。
+"""
+
+        # システムによる4択選択肢生成用
+        options_system = f"""
+あなたは{name}とは別人で、{name}の{gender}とは違う性別の同級生です。一人称は「僕」です。{name}というキャラクターに対して、返答となるセリフの選択肢を4つ生成してください。
+必ず一人称視点のセリフを生成してください。セリフの中に{name}を含めないでください。
+
+▼選択肢の種類（1つずつ生成）
+- v-good: ユーザーが{name}に対して発するとても好意的なセリフ（好感度+10）
+- good: ユーザーが{name}に対して発するやや好意的なセリフ（好感度+5）
+- bad: ユーザーが{name}に対して発するやや悪印象なセリフ（好感度-5）
+- v-bad: ユーザーが{name}に対して発する非常に悪印象なセリフ（好感度-10）
+
+▼出力形式（JSONのみ、厳守）
+{{"v-good": "セリフ", "good": "セリフ", "bad": "セリフ", "v-bad": "セリフ"}}
+
+▼ルール
+- 必須: キャラクターの直前セリフに
+明確な質問（Who / What / When / Where / Why / How / どんな…?）が含まれる場合、候補a は必ず“質問に直接答える具体的な返答” にする。
+- **トーンの幅**を持たせる  
+- a) 共感・肯定  
+- b) 質問・深掘り  
+- c) ユーモア・軽口  
+- d) 行動提案 or 別視点  
+- 直前の話題や直前の履歴に沿った自然な選択肢のみを生成する
+"""
+
+        # キャラクター発言と4択選択肢を1回で生成する場合の追記
+        combined_system = f"""{character_system}
+# 返答選択肢の生成
+セリフに続けて、ユーザーが{name}に返すセリフの選択肢を4つ生成してください。
+選択肢の話者は{name}とは別人で、{name}の{gender}とは違う性別の同級生です。一人称は「僕」です。
+必ず一人称視点のセリフにし、セリフの中に{name}を含めないでください。
+- v-good: とても好意的なセリフ（好感度+10）
+- good: やや好意的なセリフ（好感度+5）
+- bad: やや悪印象なセリフ（好感度-5）
+- v-bad: 非常に悪印象なセリフ（好感度-10）
+{name}のセリフに明確な質問が含まれる場合、v-good は質問に直接答える具体的な返答にしてください。
+
+# 出力形式（JSONのみ、厳守）
+{{"message": "{name}のセリフ", "options": {{"v-good": "セリフ", "good": "セリフ", "bad": "セリフ", "v-bad": "セリフ"}}}}
+"""
+
+        return {"character": character_system, "options": options_system, "combined": combined_system}
+
+    def _system_prompt(self, character_data, kind):
+        compiled = self.system_prompts.get(character_data['キャラクターID'])
+        if compiled is None:
+            compiled = self._compile_system_prompts(character_data)
+        return compiled[kind]
 
+    @metrics.timed("prompt_build")
+    def _build_initial_character_prompt(self, character_data, context, affection_level):
+        # キャラクター発言生成用プロンプト（可変部分のみ）
+        character_prompt = f"""
 # 状況
-- 現在の状況: {context['date']} {context['weekday']} {context['time_period']} ({context['time_detail']})
-- 現在地: {context['detailed_address']} （この情報を会話に自然に含めても良い）
+- 好感度: {affection_level}
+- 日付: {context['date']} ({context['weekday']})
+- 時間帯: {context['time_period']} ({context['time_detail']})
+- 現在地: {context['detailed_address']}
+
+会話の最初のメッセージとして、「{context['detailed_address']}」らしさ（位置情報から取得した場所の名所など）を盛り込んだ自然なセリフを生成してください。
+"""
 
+        return character_prompt
+
+    @metrics.timed("prompt_build")
+    def _build_initial_options_prompt(self, character_data, character_message, gender):
+        name = character_data['名前']
+
+        # システムによる4択選択肢生成用プロンプト（可変部分のみ）
+        options_prompt = f"""
+直前の{name}の発言: 「{character_message}」
+"""
+
+        return options_prompt
+
+    @metrics.timed("prompt_build")
+    def _build_next_character_prompt(self, character_data, user_choice, conversation_history, context, affection_level=None):
+        name = character_data['名前']
+
+        history_str = self._history_str(character_data, conversation_history)
+
+        # キャラクター発言生成用プロンプト（可変部分のみ）
+        # 履歴はターンごとに末尾へ伸びるだけなので、好感度などより前に置いて共通部分を長くする
+        character_prompt = f"""
 # 会話履歴
 {history_str}
+
+# 状況
+- 好感度: {affection_level}
+- 現在の状況: {context['date']} {context['weekday']} {context['time_period']} ({context['time_detail']})
+- 現在地: {context['detailed_address']} （この情報を会話に自然に含めても良い）
+
+# ユーザーの直前の発言
 ユーザー: 「{user_choice}」
 
 上記すべてを考慮し、{name}の次のセリフを生成してください。
@@ -344,83 +856,242 @@ class CharacterService:
 
         return character_prompt
 
-    def _build_next_options_prompt(self, character_data, character_message, user_choice, conversation_history,gender):
+    @metrics.timed("prompt_build")
+    def _build_next_options_prompt(self, character_data, character_message, user_choice, conversation_history, gender):
         name = character_data['名前']
-        
-        history_str = "\n".join(
-            f"ユーザー: {h['user']}\n{name}: {h['character']}" for h in conversation_history
-        )
 
-        # システムによる4択選択肢生成用プロンプト
+        history_str = self._history_str(character_data, conversation_history)
+
+        # システムによる4択選択肢生成用プロンプト（可変部分のみ）
         options_prompt = f"""
-あなたは{name}とは別人で、{name}の{gender}とは違う性別の同級生です。一人称は「僕」です。{name}というキャラクターに対して、返答となるセリフの選択肢を4つ生成してください。
-必ず一人称視点のセリフを生成してください。セリフの中に{name}を含めないでください。
+これまでの会話履歴:
+{history_str}
 
-直前の{name}の発言: 「{character_message}」
 ユーザーの直前の選択: 「{user_choice}」
+直前の{name}の発言: 「{character_message}」
+"""
+        return options_prompt
 
-これまでの会話履歴:
-{history_str}
+    def _history_str(self, character_data, conversation_history):
+        """プロンプトに埋め込む会話履歴。圧縮有効時は古いターンを要約に置き換える"""
+        name = character_data['名前']
+        summary, recent = None, conversation_history
+        if self.history_compactor is not None:
+            summary, recent = self.history_compactor.compact(character_data['キャラクターID'], conversation_history)
+        lines = [f"ユーザー: {h['user']}\n{name}: {h['character']}" for h in recent]
+        if summary:
+            lines.insert(0, f"（これまでの会話の要約）{summary}")
+        return "\n".join(lines)
 
-▼選択肢の種類（1つずつ生成）
-- #v-good: ユーザーが{name}に対して発するとても好意的なセリフ（好感度+10）
-- #good: ユーザーが{name}に対して発するやや好意的なセリフ（好感度+5）
-- #bad: ユーザーが{name}に対して発するやや悪印象なセリフ（好感度-5）
-- #v-bad: ユーザーが{name}に対して発する非常に悪印象なセリフ（好感度-10）
+    def _build_history_summary_prompt(self, character_data, previous_summary, turns):
+        name = character_data['名前']
+        turns_str = "\n".join(
+            f"ユーザー: {h['user']}\n{name}: {h['character']}" for h in turns
+        )
+
+        # 会話履歴の要約用プロンプト
+        summary_prompt = f"""
+ユーザーと{name}の会話を、今後の会話の文脈として使えるように要約してください。
+
+これまでの要約:
+{previous_summary or "（なし）"}
 
-▼フォーマット（厳守）
-1. 「～」 #v-good
-2. 「～」 #good
-3. 「～」 #bad
-4. 「～」 #v-bad
+新しい会話:
+{turns_str}
 
 ▼ルール
-- 必須: キャラクターの直前セリフに
-明確な質問（Who / What / When / Where / Why / How / どんな…?）が含まれる場合、候補a は必ず“質問に直接答える具体的な返答” にする。
-- **トーンの幅**を持たせる  
-- a) 共感・肯定  
-- b) 質問・深掘り  
-- c) ユーモア・軽口  
-- d) 行動提案 or 別視点  
-- 直前の話題や直前の履歴に沿った自然な選択肢のみを生成する
+- これまでの要約と新しい会話の内容をまとめ、1つの要約にする
+- 話題、ユーザーが答えた事実（好み・予定など）、{name}の感情の変化を残す
+- 300文字以内で、要約文のみを出力する
 """
-        return options_prompt
 
-    def _generate_with_openai(self, prompt, is_character=True):
-        if is_character:
+        return summary_prompt
+
+    def _summarize_history(self, character_id, previous_summary, turns):
+        character_data = self.characters[character_id]
+        summary_prompt = self._build_history_summary_prompt(character_data, previous_summary, turns)
+        return self._create_completion(
+            stage="summary",
+            messages=[
+                {"role": "system", "content": "あなたは会話ログを簡潔に要約するアシスタントです。"},
+                {"role": "user", "content": summary_prompt}
+            ],
+            temperature=0.3
+        )
+
+    def _build_combined_prompt(self, character_data, character_prompt):
+        # 出力形式の指示はシステムプロンプト側にあるので、可変部分に一文足すだけ
+        return f"{character_prompt}\nセリフと返答選択肢を出力形式のJSONで生成してください。\n"
+
+    def _generate_combined(self, character_data, character_prompt):
+        """発言と選択肢を1回の呼び出しで生成する。解析できなければ None を返す"""
+        combined_prompt = self._build_combined_prompt(character_data, character_prompt)
+        content = self._create_completion(
+            stage="combined",
+            messages=self._build_messages(combined_prompt, character_data=character_data, kind="combined"),
+            temperature=1.0,
+            response_format=COMBINED_RESPONSE_FORMAT
+        )
+        return self._parse_combined(content)
+
+    def _parse_combined(self, response_text):
+        try:
+            payload = json.loads(response_text)
+            message = str(payload["message"]).strip()
+        except (ValueError, KeyError, TypeError) as e:
+            metrics.inc("options_parse_total", result="failed")
+            logger.warning("Combined output parse failed: %s", e)
+            return None
+        options = self._record_options_parse(*parse_options(json.dumps(payload.get("options"), ensure_ascii=False)), response_text)
+        if not message or not options:
+            return None
+        return message, options
+
+    def _build_messages(self, prompt, is_character=True, character_data=None, kind=None):
+        if character_data is not None:
+            # キャラクターごとの事前生成済みシステムプロンプト
+            system_content = self._system_prompt(character_data, kind or ("character" if is_character else "options"))
+        elif is_character:
             system_content = "あなたは指定されたキャラクターになりきって、自然なメッセージを生成するVtuberです。"
         else:
             system_content = "あなたはVtuberの同級生の男性です。"
-            
-        response = self.openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_content},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=200,
+        return [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": prompt}
+        ]
+
+    def _cache_key(self, params):
+        if self.response_cache is None:
+            return None
+        return ResponseCache.make_key(**params)
+
+    def _create_completion(self, stage="other", use_cache=True, **params):
+        """chat.completions.create を呼び、応答本文を返す（キャッシュ有効時は再利用）
+
+        stage は計測とモデル選択の区分（character / options / combined / summary / speculative）で、
+        model / max_tokens を省略すると段階ごとの設定を使う。
+        use_cache=False ならキャッシュを引かずに生成し直す。
+        """
+        route = self.routes[stage]
+        params.setdefault("model", route.model)
+        params.setdefault("max_tokens", route.max_tokens)
+        key = self._cache_key(params) if use_cache else None
+        if key is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+
+        # 同じパラメーターの呼び出しが実行中なら、その応答を共有する。遅ければヘッジする
+        create = self.openai_client.chat.completions.create
+        with metrics.span(f"llm_{stage}"):
+            response = self.hedger.call(
+                route,
+                lambda p, k: self.completion_gate.call(create, p, key=k, deadline=route.deadline),
+                params,
+                key=ResponseCache.make_key(**params),
+            )
+        metrics.record_usage(response, stage)
+        content = response.choices[0].message.content.strip()
+        if key is not None:
+            self.response_cache.put(key, content)
+        return content
+
+    def _generate_with_openai(self, prompt, is_character=True, character_data=None):
+        return self._create_completion(
+            stage="character" if is_character else "options",
+            messages=self._build_messages(prompt, is_character, character_data),
             temperature=1.0
         )
-        return response.choices[0].message.content.strip()
 
-    def _parse_options_only(self, response_text):
-        options = []
-        lines = [line.strip() for line in response_text.splitlines() if line.strip()]
-
-        # Parse option lines
-        for line in lines:
-            try:
-                # 「番号. テキスト #tag」の形式を分解
-                num, rest = line.split(".", 1)
-                text, tag = rest.rsplit("#", 1)
-                options.append({"text": text.strip(" 「」"), "type": tag.strip()})
-            except ValueError:
-                # Ignore malformed option lines
+    def _stream_with_openai(self, prompt, is_character=True, character_data=None):
+        """生成されたテキストの差分を到着順に yield する"""
+        # ストリーミングは段階ごとのモデル・期限だけ使い、ヘッジはしない（途中まで送った本文を差し替えられない）
+        route = self.routes["character" if is_character else "options"]
+        stream = self.completion_gate.stream(self.openai_client.chat.completions.create, dict(
+            model=route.model,
+            messages=self._build_messages(prompt, is_character, character_data),
+            max_tokens=route.max_tokens,
+            temperature=1.0,
+            stream=True
+        ), deadline=route.deadline)
+        started = time.perf_counter()
+        first_token = True
+        for chunk in stream:
+            if not chunk.choices:
                 continue
-        
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first_token:
+                    first_token = False
+                    metrics.observe("llm_first_token_seconds", time.perf_counter() - started, stage="character")
+                yield delta
+
+    def _options_params(self, options_prompt, character_data):
+        return dict(
+            messages=self._build_messages(options_prompt, is_character=False, character_data=character_data),
+            temperature=1.0,
+            response_format=OPTIONS_RESPONSE_FORMAT,
+        )
+
+    def _merge_options(self, options, response_text):
+        """これまでに取れた選択肢に、新しい応答から足りない種類の分だけ足す"""
+        missing = set(missing_types(options))
+        merged = options + [o for o in self._parse_options_only(response_text) if o["type"] in missing]
+        return sorted(merged, key=lambda o: OPTION_TYPES.index(o["type"]))
+
+    def _generate_option_list(self, options_prompt, character_data):
+        """4択選択肢を構造化出力で生成する。4つそろわなければ options_max_retries 回まで生成し直す"""
+        options = []
+        for attempt in range(self.options_max_retries + 1):
+            if attempt:
+                metrics.inc("options_retries_total")
+            # 生成し直すときは、崩れた応答を返しうるキャッシュを通さない
+            content = self._create_completion(stage="options", use_cache=attempt == 0, **self._options_params(options_prompt, character_data))
+            options = self._merge_options(options, content)
+            if not missing_types(options):
+                break
+        return options
+
+    def _record_options_parse(self, options, status, response_text):
+        metrics.inc("options_parse_total", result=status)
+        if status != "ok":
+            logger.warning("Options output %s (%d/4): %.200r", status, len(options), response_text)
         return options
-  
-    
+
+    @metrics.timed("parse_options")
+    def _parse_options_only(self, response_text):
+        """選択肢の応答を解析する。形式が崩れていても取れる分は修復して返す（src/dialogue_options.py）"""
+        return self._record_options_parse(*parse_options(response_text), response_text)
+
+    def metrics_samples(self):
+        """/api/metrics 用に、キャッシュ・プール・流量制御の状態を (名前, 種類, ラベル, 値) で返す"""
+        samples = []
+        for name, value in self.completion_gate.stats().items():
+            kind = "gauge" if name == "in_flight" else "counter"
+            samples.append((f"llm_{name}" + ("" if kind == "gauge" else "_total"), kind, {}, value))
+        if self.response_cache is not None:
+            stats = self.response_cache.stats()
+            samples.append(("response_cache_entries", "gauge", {}, stats["size"]))
+            samples.append(("response_cache_lookups_total", "counter", {"result": "hit"}, stats["hits"]))
+            samples.append(("response_cache_lookups_total", "counter", {"result": "miss"}, stats["misses"]))
+        if self.opening_pool is not None:
+            stats = self.opening_pool.stats()
+            samples.append(("opening_pool_entries", "gauge", {}, stats["entries"]))
+            samples.append(("opening_pool_takes_total", "counter", {"result": "hit"}, stats["hits"]))
+            samples.append(("opening_pool_takes_total", "counter", {"result": "miss"}, stats["misses"]))
+        if self.speculative_replies is not None:
+            stats = self.speculative_replies.stats()
+            samples.append(("speculative_reply_slots", "gauge", {}, stats["slots"]))
+            samples.append(("speculative_replies_total", "counter", {"result": "started"}, stats["started"]))
+            samples.append(("speculative_replies_total", "counter", {"result": "over_budget"}, stats["over_budget"]))
+            samples.append(("speculative_replies_total", "counter", {"result": "discarded"}, stats["discarded"]))
+            for result, name in (("hit", "hits"), ("pending_hit", "pending_hits"), ("miss", "misses"), ("failed", "failed")):
+                samples.append(("speculative_reply_lookups_total", "counter", {"result": result}, stats[name]))
+        for stage, delay in self.hedger.stats(self.routes).items():
+            samples.append(("llm_hedge_after_seconds", "gauge", {"stage": stage}, delay))
+        samples.append(("character_catalog_reloads_total", "counter", {"result": "ok"}, self.catalog_loader.reloads))
+        samples.append(("character_catalog_reloads_total", "counter", {"result": "error"}, self.catalog_loader.reload_failures))
+        return samples
 
     def get_characters(self):
         return list(self.characters.keys())
\ No newline at end of file
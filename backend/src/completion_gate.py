@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    """呼び出しの期限までに OpenAI の応答を得られなかった"""
+
+
+class TokenBucket:
+    """1分あたりの上限を持つトークンバケット（rate_per_minute <= 0 なら無制限）
+
+    reserve() は先に残量を引き落とし、足りない分が補充されるまでの待ち秒数を返す。
+    待つのは呼び出し側なので、同期・非同期のどちらからでも使える。
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        if self.capacity <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.capacity / 60)
+            self._updated_at = now
+            self._tokens -= amount
+            return max(0.0, -self._tokens * 60 / self.capacity)
+
+    def try_reserve(self, amount=1):
+        """残量が足りるときだけ引き落として True を返す（待たずに諦める呼び出し用）"""
+        if self.capacity <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.capacity / 60)
+            self._updated_at = now
+            if self._tokens < amount:
+                return False
+            self._tokens -= amount
+            return True
+
+
+def _estimate_tokens(params):
+    # 日本語はおおむね1文字1トークンなので、文字数 + 出力上限で多めに見積もる
+    prompt = sum(len(str(m.get("content", ""))) for m in params.get("messages", ()))
+    return prompt + int(params.get("max_tokens") or 0)
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # 接続エラー・タイムアウト（openai.APIConnectionError 系）
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+class CompletionGate:
+    """OpenAI 呼び出しの流量制御
+
+    - RPM / TPM のトークンバケットと同時実行数の上限で、超過分は短い待ち行列にする
+    - 429 / 5xx / 接続エラーはジッター付き指数バックオフで再試行（Retry-After を優先）
+    - 呼び出しごとに期限を設け、残り時間を SDK の timeout に渡す
+    - 同じパラメーターの呼び出しが実行中なら、その結果を待って共有する
+
+    同期版と非同期版は同じバケットと同時実行枠を使うので、1つのゲートを両方から使えば
+    プロセス全体の上限になる。
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=16, max_retries=4,
+                 base_delay=0.5, max_delay=8.0, deadline=30.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._semaphore_pid = os.getpid()
+        self._loop_inflight = weakref.WeakKeyDictionary()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.deadline_exceeded = 0
+
+    def _expired(self):
+        with self._lock:
+            self.deadline_exceeded += 1
+        raise DeadlineExceeded("OpenAI call did not complete before its deadline")
+
+    def _remaining(self, expires_at):
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            self._expired()
+        return remaining
+
+    def _backoff(self, attempt, error):
+        delay = _retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, self.max_delay)
+
+    def _admission_wait(self, params):
+        return max(self.requests.reserve(1), self.tokens.reserve(_estimate_tokens(params)))
+
+    def _track(self, delta):
+        with self._lock:
+            self.in_flight += delta
+
+    def _shared_semaphore(self):
+        """同期版・非同期版で共有する同時実行枠"""
+        # fork 先のワーカーには親のロック状態を持ち込まない
+        if self._semaphore_pid != os.getpid():
+            self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+            self._semaphore_pid = os.getpid()
+        return self._semaphore
+
+    # 同期版
+
+    def _acquire_sync(self, semaphore, expires_at):
+        if not semaphore.acquire(timeout=self._remaining(expires_at)):
+            self._expired()
+
+    def _send(self, create, params, expires_at):
+        """流量制御と再試行付きで create(**params) を1回分成功させる"""
+        attempt = 0
+        while True:
+            wait = self._admission_wait(params)
+            if wait >= self._remaining(expires_at):
+                self._expired()
+            time.sleep(wait)
+            try:
+                return create(**params, timeout=self._remaining(expires_at))
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay >= self._remaining(expires_at):
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                logger.warning("OpenAI call failed (%s), retrying in %.2fs", e, delay)
+                time.sleep(delay)
+
+    def call(self, create, params, key=None, deadline=None):
+        """create(**params) を実行して応答を返す。key が同じ呼び出しは実行中の結果を共有する
+
+        deadline を渡せば、その呼び出しだけ既定の期限（秒）を置き換える。
+        """
+        deadline = deadline or self.deadline
+        if key is not None:
+            with self._lock:
+                leader = self._inflight.get(key)
+                if leader is None:
+                    future = self._inflight[key] = Future()
+                else:
+                    self.coalesced += 1
+            if leader is not None:
+                try:
+                    return leader.result(timeout=deadline)
+                except FutureTimeoutError:
+                    self._expired()
+        try:
+            result = self._call(create, params, deadline)
+        except BaseException as e:
+            if key is not None:
+                self._finish(key, future, error=e)
+            raise
+        if key is not None:
+            self._finish(key, future, result=result)
+        return result
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _call(self, create, params, deadline):
+        expires_at = time.monotonic() + deadline
+        semaphore = self._shared_semaphore()
+        self._acquire_sync(semaphore, expires_at)
+        self._track(1)
+        try:
+            return self._send(create, params, expires_at)
+        finally:
+            self._track(-1)
+            semaphore.release()
+
+    def stream(self, create, params, deadline=None):
+        """ストリーミング呼び出し。チャンクを読み終えるまで同時実行枠を占有する"""
+        expires_at = time.monotonic() + (deadline or self.deadline)
+        semaphore = self._shared_semaphore()
+        self._acquire_sync(semaphore, expires_at)
+        self._track(1)
+        try:
+            yield from self._send(create, params, expires_at)
+        finally:
+            self._track(-1)
+            semaphore.release()
+
+    # 非同期版
+
+    def _inflight_for_loop(self):
+        # 相乗り用の asyncio.Future はイベントループに紐づくので、ループごとに持つ
+        loop = asyncio.get_running_loop()
+        inflight = self._loop_inflight.get(loop)
+        if inflight is None:
+            inflight = self._loop_inflight[loop] = {}
+        return inflight
+
+    async def _asend(self, create, params, expires_at):
+        attempt = 0
+        while True:
+            wait = self._admission_wait(params)
+            if wait >= self._remaining(expires_at):
+                self._expired()
+            await asyncio.sleep(wait)
+            try:
+                return await create(**params, timeout=self._remaining(expires_at))
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay >= self._remaining(expires_at):
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                logger.warning("OpenAI call failed (%s), retrying in %.2fs", e, delay)
+                await asyncio.sleep(delay)
+
+    async def _acquire(self, semaphore, expires_at):
+        # 同期版と同じ枠を使う。イベントループを塞がないよう、空くまで短い間隔で取り直す
+        delay = 0.005
+        while not semaphore.acquire(blocking=False):
+            await asyncio.sleep(min(delay, self._remaining(expires_at)))
+            delay = min(delay * 2, 0.05)
+
+    async def acall(self, create, params, key=None, deadline=None):
+        """call() の非同期版。create は coroutine を返す関数"""
+        deadline = deadline or self.deadline
+        semaphore, inflight = self._shared_semaphore(), self._inflight_for_loop()
+        if key is not None:
+            leader = inflight.get(key)
+            if leader is not None:
+                with self._lock:
+                    self.coalesced += 1
+                try:
+                    return await asyncio.wait_for(asyncio.shield(leader), timeout=deadline)
+                except asyncio.TimeoutError:
+                    self._expired()
+            future = inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            expires_at = time.monotonic() + deadline
+            await self._acquire(semaphore, expires_at)
+            self._track(1)
+            try:
+                result = await self._asend(create, params, expires_at)
+            finally:
+                self._track(-1)
+                semaphore.release()
+        except BaseException as e:
+            if key is not None:
+                inflight.pop(key, None)
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                    future.exception()  # 待つ側がいなくても警告を出さない
+                else:
+                    future.cancel()
+            raise
+        if key is not None:
+            inflight.pop(key, None)
+            future.set_result(result)
+        return result
+
+    async def astream(self, create, params, deadline=None):
+        """stream() の非同期版"""
+        expires_at = time.monotonic() + (deadline or self.deadline)
+        semaphore = self._shared_semaphore()
+        await self._acquire(semaphore, expires_at)
+        self._track(1)
+        try:
+            stream = await self._asend(create, params, expires_at)
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self._track(-1)
+            semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "coalesced": self.coalesced,
+                "retries": self.retries,
+                "deadline_exceeded": self.deadline_exceeded,
+            }
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# DB 接続まわりの設定
+#
+#   DATABASE_URL=sqlite:///app.db         接続先（postgres:// なども可。ドライバーは別途インストール）
+#   DB_POOL_SIZE=10 / DB_MAX_OVERFLOW=10  接続プール（gunicorn のスレッド数以上にする）
+#   SQLITE_BUSY_TIMEOUT_MS=5000           書き込みロック待ちの上限
+#   SQLITE_SYNCHRONOUS=NORMAL             WAL と組み合わせるとコミットごとの fsync が不要になる
+
+_SQLITE_PRAGMAS_ENABLED = os.getenv('SQLITE_PRAGMAS', '1') == '1'
+_SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+if _SQLITE_SYNCHRONOUS not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+    raise ValueError(f"Invalid SQLITE_SYNCHRONOUS: {_SQLITE_SYNCHRONOUS}")
+
+
+def database_uri():
+    uri = os.getenv('DATABASE_URL', 'sqlite:///app.db')
+    # Heroku / Render 形式の postgres:// は SQLAlchemy 2 では postgresql:// と書く必要がある
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def is_memory_uri(uri):
+    return uri in ('sqlite://', 'sqlite:///:memory:')
+
+
+def engine_options(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS。インメモリ SQLite は単一接続なのでプール設定を付けない"""
+    if is_memory_uri(uri):
+        return {}
+    options = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    }
+    if not uri.startswith('sqlite'):
+        # サーバー DB ではアイドル切断された接続を使い回さない
+        options.update(pool_pre_ping=True, pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)))
+    return options
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not _SQLITE_PRAGMAS_ENABLED or not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f"PRAGMA synchronous={_SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))}")
+    cursor.close()
+
+
+def ensure_indexes(db):
+    """モデルに定義したインデックスを既存の DB にも作る（create_all は既存テーブルに追加しない）"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
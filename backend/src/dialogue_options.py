@@ -0,0 +1,175 @@
+import json
+import re
+
+# 4択選択肢の出力形式と解析
+#
+# 選択肢は種類ごとに1つずつのキーを持つ JSON オブジェクトとして構造化出力で生成させる。
+# 配列の件数指定に頼らず、スキーマ上で「4種類がちょうど1つずつ」になるようにしている。
+# 構造化出力が崩れた場合や旧形式（「1. 「～」 #v-good」）の応答は parse_options が
+# 手元で修復し、足りない選択肢だけを呼び出し側で生成し直す。
+
+OPTION_TYPES = ("v-good", "good", "bad", "v-bad")
+# 選んだときの好感度の増減（フロントエンドと同じ値）
+AFFECTION_DELTAS = {"v-good": 10, "good": 5, "bad": -5, "v-bad": -10}
+
+_OPTIONS_OBJECT_SCHEMA = {
+    "type": "object",
+    "properties": {option_type: {"type": "string"} for option_type in OPTION_TYPES},
+    "required": list(OPTION_TYPES),
+    "additionalProperties": False,
+}
+
+OPTIONS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "dialogue_options",
+        "strict": True,
+        "schema": _OPTIONS_OBJECT_SCHEMA,
+    },
+}
+
+COMBINED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "dialogue_turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"message": {"type": "string"}, "options": _OPTIONS_OBJECT_SCHEMA},
+            "required": ["message", "options"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+_TYPE_ALIASES = {
+    "v-good": "v-good", "vgood": "v-good", "very-good": "v-good", "verygood": "v-good",
+    "good": "good",
+    "bad": "bad",
+    "v-bad": "v-bad", "vbad": "v-bad", "very-bad": "v-bad", "verybad": "v-bad",
+}
+# 途中で切れた JSON からも "種類": "セリフ" の組を拾う
+_JSON_PAIR = re.compile(r'"([A-Za-z_ -]{3,9})"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_JSON_ITEM = re.compile(
+    r'\{[^{}]*?"text"\s*:\s*"((?:[^"\\]|\\.)*)"[^{}]*?"type"\s*:\s*"([^"]*)"'
+    r'|\{[^{}]*?"type"\s*:\s*"([^"]*)"[^{}]*?"text"\s*:\s*"((?:[^"\\]|\\.)*)"'
+)
+_LINE_PREFIX = re.compile(r'^\s*(?:[-*・]|\(?[0-9０-９a-dA-D]+[.)．:、])\s*')
+_LINE_TAG = re.compile(r'[#＃]\s*([A-Za-z_ -]+?)\s*$')
+
+
+def normalize_type(value):
+    """"V_GOOD" や "#very good" などの表記ゆれを OPTION_TYPES のいずれかにそろえる（該当なしは None）"""
+    key = re.sub(r'[\s_]+', '-', str(value).strip().strip('#＃').strip().lower())
+    return _TYPE_ALIASES.get(key) or _TYPE_ALIASES.get(key.replace('-', ''))
+
+
+def _clean_text(text):
+    text = str(text).strip().strip('"').strip()
+    return text.strip('「」『』').strip()
+
+
+def _unescape(value):
+    try:
+        return json.loads(f'"{value}"')
+    except ValueError:
+        return value
+
+
+def _from_json(payload):
+    """JSON として読めた応答から (種類, セリフ) の組を取り出す"""
+    if isinstance(payload, dict) and "options" in payload:
+        payload = payload["options"]
+    pairs = []
+    if isinstance(payload, dict):
+        pairs = [(key, value) for key, value in payload.items() if isinstance(value, str)]
+    elif isinstance(payload, list):
+        for item in payload:
+            if isinstance(item, dict):
+                pairs.append((item.get("type"), item.get("text")))
+            elif isinstance(item, str):
+                pairs.append((None, item))
+    return pairs
+
+
+def _from_text(text):
+    """JSON として読めない応答（途中で切れた JSON・旧形式の行）から組を拾う"""
+    pairs = [(t1 or t2, _unescape(x1 or x2)) for x1, t1, t2, x2 in _JSON_ITEM.findall(text)]
+    if pairs:
+        return pairs
+    pairs = [(key, _unescape(value)) for key, value in _JSON_PAIR.findall(text) if normalize_type(key)]
+    if pairs:
+        return pairs
+    for line in text.splitlines():
+        line = _LINE_PREFIX.sub('', line).strip()
+        if not line or line.startswith(('{', '}', '[', ']', '```')):
+            continue
+        tag = _LINE_TAG.search(line)
+        if tag:
+            pairs.append((tag.group(1), line[:tag.start()]))
+        else:
+            pairs.append((None, line))
+    return pairs
+
+
+def _strip_fence(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    return text.strip()
+
+
+def parse_options(response_text):
+    """応答を解析して (選択肢のリスト, 状態) を返す
+
+    選択肢は OPTION_TYPES の順に {"text", "type"} で、種類ごとに最大1件。
+    状態は "ok"（形式どおり4件）/ "repaired"（手元で修復して4件）/
+    "partial"（4件に満たない）/ "failed"（1件も取れない）のいずれか。
+    """
+    text = _strip_fence(response_text or "")
+    structured = True
+    try:
+        pairs = _from_json(json.loads(text))
+    except ValueError:
+        structured = False
+        pairs = _from_text(text)
+
+    by_type, untyped, duplicated = {}, [], False
+    for raw_type, raw_text in pairs:
+        option_text = _clean_text(raw_text) if raw_text is not None else ""
+        if not option_text:
+            continue
+        option_type = normalize_type(raw_type) if raw_type is not None else None
+        if option_type is None:
+            untyped.append(option_text)
+        elif option_type in by_type:
+            # 同じ種類が重複したら最初の1件だけ使う（別の種類に付け替えると好感度がずれる）
+            duplicated = True
+        else:
+            by_type[option_type] = option_text
+
+    exact = structured and len(by_type) == len(OPTION_TYPES) and not untyped and not duplicated
+    # 種類の付いていないセリフは、並び順（好意的な順）のまま空いている種類に割り当てる
+    for option_type in OPTION_TYPES:
+        if option_type not in by_type and untyped:
+            by_type[option_type] = untyped.pop(0)
+
+    options = [{"text": by_type[t], "type": t} for t in OPTION_TYPES if t in by_type]
+    if not options:
+        return [], "failed"
+    if len(options) < len(OPTION_TYPES):
+        return options, "partial"
+    return options, "ok" if exact else "repaired"
+
+
+def affection_after(affection_level, option_type):
+    """選択肢を選んだ後の好感度（0〜100）。好感度が不明なら None"""
+    if affection_level is None:
+        return None
+    return max(0, min(100, affection_level + AFFECTION_DELTAS.get(option_type, 0)))
+
+
+def missing_types(options):
+    present = {option["type"] for option in options}
+    return [option_type for option_type in OPTION_TYPES if option_type not in present]
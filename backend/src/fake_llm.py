@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+# 負荷試験・ローカル開発用の OpenAI クライアント代替（LLM_BACKEND=fake）
+#
+# chat.completions.create だけを実装し、プロンプトの種類（発言・4択選択肢・
+# combined の JSON・履歴要約）に合った形式の応答を、設定した遅延分布で返す。
+# 応答の文面はプロンプトのハッシュで決まるので、同じ入力には同じ応答を返す。
+# FAKE_LLM_TRUNCATE_RATE の割合で応答を途中で切り、出力形式の崩れを再現する。
+# FAKE_LLM_SLOW_RATE の割合で FAKE_LLM_SLOW_LATENCY の遅延を使い、遅いレプリカに当たった
+# 場合のテールを再現する。FAKE_LLM_MODEL_LATENCY（"model=spec;model=spec"）でモデルごとの遅延を変えられる。
+
+_MESSAGES = [
+    "こんにちは！今日はいい天気だね。どこかに出かけてたの？",
+    "へえ、そうなんだ！それってすごく楽しそう。今度一緒に行ってみたいな。",
+    "ふふっ、ありがとう。そう言ってもらえると嬉しいよ。最近何かハマってることある？",
+    "そうなんだね。私もこの前、駅前の新しいカフェに行ってきたんだ。",
+]
+_OPTIONS = [
+    ("駅前のカフェに行ってたよ", "v-good"),
+    ("ちょっと散歩してただけ", "good"),
+    ("別に、どこでもいいでしょ", "bad"),
+    ("話しかけないで", "v-bad"),
+]
+_SUMMARY = "ユーザーと近況について話した。ユーザーはカフェ巡りが好きで、キャラクターは一緒に出かけたがっている。"
+
+
+class LatencyModel:
+    """応答遅延の分布
+
+    spec は "fixed:MS" / "uniform:MIN_MS:MAX_MS" / "lognormal:MEDIAN_MS:SIGMA" のいずれか。
+    stream 時は first_token_ratio の割合を最初のチャンクまでの待ちに、残りをチャンク間に割り振る。
+    """
+
+    def __init__(self, spec="lognormal:800:0.4", seed=None, first_token_ratio=0.3):
+        kind, *args = spec.split(":")
+        self.kind = kind
+        self.args = [float(a) for a in args]
+        self.first_token_ratio = first_token_ratio
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """1回の呼び出しにかかる秒数"""
+        with self._lock:
+            if self.kind == "fixed":
+                ms = self.args[0]
+            elif self.kind == "uniform":
+                ms = self._random.uniform(self.args[0], self.args[1])
+            elif self.kind == "lognormal":
+                ms = self.args[0] * self._random.lognormvariate(0, self.args[1])
+            else:
+                raise ValueError(f"unknown latency distribution: {self.kind}")
+        return ms / 1000
+
+
+class FakeAPIError(Exception):
+    """status_code を持つ、openai.APIStatusError 相当の例外"""
+
+    def __init__(self, status_code):
+        super().__init__(f"fake upstream error {status_code}")
+        self.status_code = status_code
+
+
+def _pick(options, key):
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    return options[digest[0] % len(options)]
+
+
+def _content_for(params):
+    """プロンプトの種類に合わせた応答本文"""
+    messages = params.get("messages") or []
+    system = messages[0]["content"] if messages else ""
+    prompt = "".join(str(m.get("content", "")) for m in messages)
+    message = _pick(_MESSAGES, prompt)
+    response_format = params.get("response_format") or {}
+    schema_name = (response_format.get("json_schema") or {}).get("name")
+    if schema_name == "dialogue_options":
+        return json.dumps({kind: text for text, kind in _OPTIONS}, ensure_ascii=False)
+    if schema_name:
+        return json.dumps({"message": message, "options": {kind: text for text, kind in _OPTIONS}}, ensure_ascii=False)
+    if response_format:
+        return json.dumps({
+            "message": message,
+            "options": [{"text": text, "type": kind} for text, kind in _OPTIONS],
+        }, ensure_ascii=False)
+    if "要約" in system:
+        return _SUMMARY
+    if "選択肢を4つ" in system or "選択肢を4つ" in prompt:
+        return "\n".join(f"{i}. 「{text}」 #{kind}" for i, (text, kind) in enumerate(_OPTIONS, start=1))
+    return message
+
+
+def _usage(params, content):
+    prompt_tokens = sum(len(str(m.get("content", ""))) for m in params.get("messages") or [])
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=len(content),
+        total_tokens=prompt_tokens + len(content),
+    )
+
+
+def _completion(params, content):
+    return SimpleNamespace(
+        id="fake-completion",
+        model=params.get("model"),
+        choices=[SimpleNamespace(index=0, finish_reason="stop", message=SimpleNamespace(role="assistant", content=content))],
+        usage=_usage(params, content),
+    )
+
+
+def _chunks(content, size=4):
+    for i in range(0, len(content), size):
+        yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=content[i:i + size]))])
+
+
+class _FakeCompletions:
+    def __init__(self, latency, error_rate, seed, truncate_rate=0.0, slow_rate=0.0, slow_latency=None, model_latency=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.model_latency = model_latency or {}
+        self._random = random.Random(seed)
+
+    def _sample_latency(self, params):
+        if self.slow_rate and self._random.random() < self.slow_rate:
+            return self.slow_latency.sample()
+        return self.model_latency.get(params.get("model"), self.latency).sample()
+
+    def _prepare(self, params):
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise FakeAPIError(self._random.choice((429, 500, 503)))
+        content = _content_for(params)
+        if self.truncate_rate and self._random.random() < self.truncate_rate:
+            content = content[:len(content) * 2 // 3]
+        return content, self._sample_latency(params)
+
+    def create(self, **params):
+        content, seconds = self._prepare(params)
+        if params.get("stream"):
+            return self._stream(content, seconds)
+        time.sleep(seconds)
+        return _completion(params, content)
+
+    def _stream(self, content, seconds):
+        chunks = list(_chunks(content))
+        time.sleep(seconds * self.latency.first_token_ratio)
+        interval = seconds * (1 - self.latency.first_token_ratio) / max(1, len(chunks))
+        for chunk in chunks:
+            yield chunk
+            time.sleep(interval)
+
+
+class _AsyncFakeCompletions(_FakeCompletions):
+    async def create(self, **params):
+        content, seconds = self._prepare(params)
+        if params.get("stream"):
+            return self._stream(content, seconds)
+        await asyncio.sleep(seconds)
+        return _completion(params, content)
+
+    async def _stream(self, content, seconds):
+        chunks = list(_chunks(content))
+        await asyncio.sleep(seconds * self.latency.first_token_ratio)
+        interval = seconds * (1 - self.latency.first_token_ratio) / max(1, len(chunks))
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(interval)
+
+
+def _settings():
+    seed = os.getenv('FAKE_LLM_SEED')
+    seed = int(seed) if seed is not None else None
+    latency = LatencyModel(os.getenv('FAKE_LLM_LATENCY', 'lognormal:800:0.4'), seed=seed)
+    return latency, float(os.getenv('FAKE_LLM_ERROR_RATE', 0)), seed, float(os.getenv('FAKE_LLM_TRUNCATE_RATE', 0))
+
+
+def _replica_settings(seed):
+    """遅いレプリカの割合・遅延と、モデルごとの遅延"""
+    slow_latency = LatencyModel(os.getenv('FAKE_LLM_SLOW_LATENCY', 'fixed:5000'), seed=seed)
+    model_latency = {}
+    for entry in os.getenv('FAKE_LLM_MODEL_LATENCY', '').split(';'):
+        if '=' in entry:
+            model, spec = entry.split('=', 1)
+            model_latency[model.strip()] = LatencyModel(spec.strip(), seed=seed)
+    return float(os.getenv('FAKE_LLM_SLOW_RATE', 0)), slow_latency, model_latency
+
+
+class FakeOpenAI:
+    """OpenAI クライアントの代替。FAKE_LLM_LATENCY / FAKE_LLM_ERROR_RATE / FAKE_LLM_SEED /
+    FAKE_LLM_TRUNCATE_RATE / FAKE_LLM_SLOW_RATE / FAKE_LLM_SLOW_LATENCY / FAKE_LLM_MODEL_LATENCY で挙動を変える"""
+
+    def __init__(self, latency=None, error_rate=None, seed=None, truncate_rate=None, slow_rate=None):
+        default_latency, default_error_rate, default_seed, default_truncate_rate = _settings()
+        seed = default_seed if seed is None else seed
+        default_slow_rate, slow_latency, model_latency = _replica_settings(seed)
+        completions = self._completions_class(
+            latency or default_latency,
+            default_error_rate if error_rate is None else error_rate,
+            seed,
+            default_truncate_rate if truncate_rate is None else truncate_rate,
+            default_slow_rate if slow_rate is None else slow_rate,
+            slow_latency,
+            model_latency,
+        )
+        self.chat = SimpleNamespace(completions=completions)
+
+    _completions_class = _FakeCompletions
+
+
+class AsyncFakeOpenAI(FakeOpenAI):
+    """AsyncOpenAI クライアントの代替"""
+
+    _completions_class = _AsyncFakeCompletions
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import threading
+import time
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat, lon, precision=7):
+    """緯度経度を geohash 文字列に変換する（precision=7 でおよそ 150m 四方）"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+class GeocodeCache:
+    """逆ジオコーディング結果を geohash 単位で SQLite に永続化するキャッシュ
+
+    WAL モードの SQLite ファイルを全ワーカーで共有するので、再起動や
+    ワーカー間でも Nominatim への問い合わせを重複させない。
+    """
+
+    def __init__(self, path, ttl=60*60*24*30):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS geocode_cache ("
+            " geohash TEXT PRIMARY KEY,"
+            " pref TEXT, city TEXT, detailed_address TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        # sqlite3 の接続はスレッド・プロセスをまたいで使えないので、それぞれで開き直す
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT pref, city, detailed_address FROM geocode_cache WHERE geohash = ? AND updated_at >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tuple(row) if row is not None else None
+
+    def put(self, key, value):
+        pref, city, detailed_address = value
+        self._connect().execute(
+            "INSERT OR REPLACE INTO geocode_cache (geohash, pref, city, detailed_address, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (key, pref, city, detailed_address, time.time()),
+        )
+
+    def stats(self):
+        size = self._connect().execute("SELECT COUNT(*) FROM geocode_cache").fetchone()[0]
+        with self._lock:
+            return {"size": size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import logging
+import threading
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryCompactor:
+    """会話履歴を「古いターンの要約 + 直近のターン」に圧縮する
+
+    直近 window ターン以上は逐語で残し、それより古いターンは interval ターン単位で
+    要約にまとめる。要約は要約済みターン列のハッシュをキーにキャッシュするので、
+    同じセッションの次のターンでは差分の interval ターン分だけ要約し直せばよい。
+    summarize(session_key, previous_summary, turns) は前回までの要約と
+    新しいターン列から新しい要約文字列を返すコールバック。
+    要約に失敗したときは、キャッシュ済みの要約とそれ以降のターンを逐語でそのまま使う。
+    """
+
+    def __init__(self, summarize, window=6, interval=4, maxsize=10000, ttl=60*60*6):
+        self._summarize = summarize
+        self.window = window
+        self.interval = max(1, interval)
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def compact(self, session_key, history):
+        """(要約 or None, 逐語で残すターンのリスト) を返す"""
+        older = len(history) - self.window
+        covered = (older // self.interval) * self.interval if older > 0 else 0
+        if covered <= 0:
+            return None, history
+        summary, covered = self._summary_for(session_key, history, covered)
+        return summary, history[covered:]
+
+    def _prefix_keys(self, session_key, history, covered):
+        # interval ターンごとの累積ハッシュ（= その時点までの要約のキャッシュキー）
+        digest = hashlib.sha256(str(session_key).encode("utf-8"))
+        keys = {}
+        for i, turn in enumerate(history[:covered], start=1):
+            digest.update(json.dumps(turn, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            if i % self.interval == 0:
+                keys[i] = digest.hexdigest()
+        return keys
+
+    def _summary_for(self, session_key, history, covered):
+        """(要約, 要約に含めたターン数) を返す"""
+        keys = self._prefix_keys(session_key, history, covered)
+
+        # キャッシュ済みの最も新しい要約を探し、そこから先だけを要約する
+        summary, start = None, 0
+        with self._lock:
+            for end in range(covered, 0, -self.interval):
+                cached = self._cache.get(keys[end])
+                if cached is not None:
+                    summary, start = cached, end
+                    break
+        if start == covered:
+            return summary, covered
+
+        try:
+            new_summary = self._summarize(session_key, summary, history[start:covered])
+        except Exception as e:
+            # 要約できなくても会話は続けられるので、要約済みの範囲を進めずに逐語で渡す
+            logger.warning("History summary failed, keeping %d turns verbatim: %s", len(history) - start, e)
+            return summary, start
+        with self._lock:
+            self._cache[keys[covered]] = new_summary
+        return new_summary, covered
@@ -0,0 +1,176 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+# ログ出力の設定
+#
+# リクエストスレッドはキューに積むだけで、stdout への書き込みと整形は
+# リスナースレッドが行う。レベルで弾かれたログは %-形式の引数を展開しないので、
+# logger.debug("... %s", value) のように書けば無効なレベルの整形コストはかからない。
+#
+#   LOG_LEVEL=INFO                                        ルートのレベル
+#   LOG_LEVELS=src.character_service=DEBUG,werkzeug=WARNING  モジュールごとのレベル
+#   LOG_FORMAT=text|json                                  出力形式
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+_TEXT_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
+
+
+class RequestIdFilter(logging.Filter):
+    """レコードに現在のリクエストIDを付ける"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class _ForkSafeQueueHandler(QueueHandler):
+    """キューに積むだけのハンドラー。fork 後の最初のログでリスナースレッドを起動し直す"""
+
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self._target = target
+        self._listener = None
+        self._pid = None
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._listener = QueueListener(self.queue, self._target, respect_handler_level=True)
+        self._listener.start()
+
+    def prepare(self, record):
+        # メッセージの展開と例外の文字列化だけをここで行い、整形はリスナー側に任せる
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        self._ensure_listener()
+        super().emit(record)
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+
+
+_handler = None
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in (spec or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """ルートロガーにキュー経由のハンドラーを設定する（複数回呼んでも1回だけ）"""
+    global _handler
+    if _handler is not None:
+        return
+
+    target = logging.StreamHandler(sys.stdout)
+    if os.getenv('LOG_FORMAT', 'text') == 'json':
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter(_TEXT_FORMAT))
+
+    _handler = _ForkSafeQueueHandler(target)
+    _handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    for name, level in _parse_levels(os.getenv('LOG_LEVELS')).items():
+        logging.getLogger(name).setLevel(level)
+    # 終了時にキューに残ったログを書き出す
+    atexit.register(_handler.stop)
+
+
+def _incoming_request_id(value):
+    # ヘッダー由来の値はログに出るので長さと文字種を制限する
+    if value and len(value) <= 64 and all(c.isalnum() or c in "-_." for c in value):
+        return value
+    return uuid.uuid4().hex[:16]
+
+
+def init_app(app):
+    """リクエストごとに X-Request-ID（なければ生成）をログのコンテキストに設定する"""
+    from flask import g, request
+
+    @app.before_request
+    def _bind_request_id():
+        request_id = _incoming_request_id(request.headers.get("X-Request-ID"))
+        g.request_id_token = request_id_var.set(request_id)
+
+    @app.after_request
+    def _return_request_id(response):
+        response.headers["X-Request-ID"] = request_id_var.get()
+        return response
+
+    @app.teardown_request
+    def _unbind_request_id(error=None):
+        token = g.pop("request_id_token", None)
+        if token is not None:
+            request_id_var.reset(token)
+
+
+class RequestIdMiddleware:
+    """ASGI 版。Starlette のルートでもリクエストIDを設定し、マウントした Flask 側へはヘッダーで引き継ぐ"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        request_id = _incoming_request_id(headers.get(b"x-request-id", b"").decode("latin-1"))
+        scope = dict(scope)
+        scope["headers"] = [(k, v) for k, v in scope.get("headers") or [] if k != b"x-request-id"]
+        scope["headers"].append((b"x-request-id", request_id.encode("latin-1")))
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                response_headers = [(k, v) for k, v in message.get("headers", []) if k.lower() != b"x-request-id"]
+                response_headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = {**message, "headers": response_headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
@@ -1,48 +1,74 @@
-print(__file__)
 import os
 import sys
 # DON\'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory
+from src import log_config
+# ルートの import 時（キャラクター表の読み込みなど）のログも拾えるよう最初に設定する
+log_config.configure_logging()
+
+from flask import Flask
 from flask_cors import CORS
+from src import database, metrics, static_assets
 from src.routes.character import character_bp
 from src.models.user import db
-from src.models import user, nfc  # モデルをimportしてテーブル作成対象に含める
+from src.nfc_writer import NfcWriteBehind
+from src.models import user, nfc, dialogue_session  # モデルをimportしてテーブル作成対象に含める
+
+def create_app(config=None):
+    """Flask アプリケーションファクトリ
+
+    gunicorn の preload_app と組み合わせると、キャラクター表の読み込み
+    （routes.character の import 時）は fork 前のマスタープロセスで1回だけ行われる。
+    """
+    log_config.configure_logging()
+    app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+    app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
+    app.config['SQLALCHEMY_DATABASE_URI'] = database.database_uri()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if config:
+        app.config.update(config)
+    # 接続プールの設定は、呼び出し側が渡した URI に合わせて決める
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', database.engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
 
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
-app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # DB初期化
+    CORS(app)
+    db.init_app(app)
+    metrics.init_app(app)
+    log_config.init_app(app)
 
-# DB初期化
-CORS(app)
-db.init_app(app)
+    app.register_blueprint(character_bp, url_prefix='/api')
+    static_assets.init_app(app)
 
-app.register_blueprint(character_bp, url_prefix='/api')
+    # NFCログの書き込み遅延（NFC_WRITE_BEHIND=1 で有効）
+    if os.getenv('NFC_WRITE_BEHIND') == '1':
+        writer = NfcWriteBehind(
+            app,
+            batch_size=int(os.getenv('NFC_WRITE_BATCH_SIZE', 500)),
+            flush_interval=float(os.getenv('NFC_WRITE_FLUSH_MS', 500)) / 1000,
+            max_queue=int(os.getenv('NFC_WRITE_QUEUE_MAXSIZE', 10000)),
+        )
+        app.extensions['nfc_writer'] = writer
+        metrics.register_collector(lambda: [
+            (f"nfc_write_behind_{name}" + ("" if name == "queued" else "_total"),
+             "gauge" if name == "queued" else "counter", {}, value)
+            for name, value in writer.stats().items()
+        ])
+
+    with app.app_context():
+        db.create_all()
+        database.ensure_indexes(db)
+        # fork 前に開いた接続をワーカーへ持ち越さない（インメモリ DB は接続を閉じると消えるので除く）
+        if not database.is_memory_uri(app.config['SQLALCHEMY_DATABASE_URI']):
+            db.engine.dispose()
 
+    return app
 
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
-def serve(path):
-    static_folder_path = app.static_folder
-    if static_folder_path is None:
-            return "Static folder not configured", 404
 
-    if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-        return send_from_directory(static_folder_path, path)
-    else:
-        index_path = os.path.join(static_folder_path, 'index.html')
-        if os.path.exists(index_path):
-            return send_from_directory(static_folder_path, 'index.html')
-        else:
-            return "index.html not found", 404
+app = create_app()
 
 
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
+    # 開発用サーバー。本番は gunicorn -c gunicorn.conf.py を使う
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
-
-
@@ -0,0 +1,215 @@
+import bisect
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# プロセス内の簡易メトリクス（Prometheus テキスト形式で /api/metrics から出力する）
+#
+# 集計はワーカープロセスごと。区間の計測は METRICS_SAMPLE_RATE の割合だけ行い、
+# 間引いた分は記録しないので、_count はサンプル数として読む（総数は *_total カウンター側）。
+
+SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', 1.0))
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_collectors = []
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def observe(name, seconds, **labels):
+    key = (name, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram()
+        histogram.observe(seconds)
+
+
+def inc(name, amount=1, **labels):
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def gauge_add(name, amount, **labels):
+    key = (name, _labels_key(labels))
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + amount
+
+
+def sampled():
+    return SAMPLE_RATE >= 1.0 or random.random() < SAMPLE_RATE
+
+
+@contextmanager
+def span(stage, **labels):
+    """処理区間の所要時間を dialogue_stage_seconds{stage=...} に記録する"""
+    if not sampled():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("dialogue_stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+
+def timed(stage):
+    """関数全体を span で囲むデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_usage(response, stage):
+    """chat.completions の usage をトークン数カウンターに加算する"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    inc("llm_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, stage=stage, kind="prompt")
+    inc("llm_tokens_total", getattr(usage, "completion_tokens", 0) or 0, stage=stage, kind="completion")
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) if details is not None else 0
+    if cached:
+        inc("llm_tokens_total", cached, stage=stage, kind="cached_prompt")
+
+
+def register_collector(collect, **labels):
+    """出力時に呼ぶコールバックを登録する
+
+    collect() は (名前, 種類, ラベル辞書, 値) の列を返す。labels は全サンプルに付ける固定ラベル。
+    """
+    _collectors.append((collect, labels))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def render():
+    """Prometheus テキスト形式（version 0.0.4）"""
+    with _lock:
+        histograms = {key: (list(h.counts), h.sum, h.count) for key, h in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    # 同じ名前のサンプルは1か所にまとめて出力する必要があるので、名前ごとに集める
+    families = {}
+
+    def add(name, kind, line):
+        families.setdefault(name, (kind, []))[1].append(line)
+
+    for (name, labels), (counts, total, count) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            add(name, "histogram", f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+        add(name, "histogram", f"{name}_sum{_format_labels(labels)} {total}")
+        add(name, "histogram", f"{name}_count{_format_labels(labels)} {count}")
+    for (name, labels), value in sorted(counters.items()):
+        add(name, "counter", f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(gauges.items()):
+        add(name, "gauge", f"{name}{_format_labels(labels)} {value}")
+    for collect, constant_labels in _collectors:
+        for name, kind, labels, value in collect():
+            add(name, kind, f"{name}{_format_labels(_labels_key({**constant_labels, **labels}))} {value}")
+    add("metrics_sample_rate", "gauge", f"metrics_sample_rate {SAMPLE_RATE}")
+
+    lines = []
+    for name, (kind, samples) in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """Flask アプリにリクエスト単位の計測（所要時間・処理中の件数）を組み込む"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+        gauge_add("http_requests_in_flight", 1)
+
+    @app.teardown_request
+    def _stop_timer(error=None):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return
+        gauge_add("http_requests_in_flight", -1)
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        inc("http_requests_total", endpoint=endpoint, method=request.method, error=str(error is not None).lower())
+        if sampled():
+            observe("http_request_seconds", time.perf_counter() - started, endpoint=endpoint, method=request.method)
+
+
+class AsgiMetricsMiddleware:
+    """init_app() の ASGI 版。routes に一致したリクエストだけを計測する
+
+    マウントした Flask 側のリクエストは init_app() のフックが数えるので、ここでは数えない。
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    def _endpoint(self, scope):
+        from starlette.routing import Match
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return None
+
+    async def __call__(self, scope, receive, send):
+        endpoint = self._endpoint(scope) if scope["type"] == "http" else None
+        if endpoint is None:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        gauge_add("http_requests_in_flight", 1)
+        error = False
+        try:
+            await self.app(scope, receive, send)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            gauge_add("http_requests_in_flight", -1)
+            inc("http_requests_total", endpoint=endpoint, method=scope["method"], error=str(error).lower())
+            if sampled():
+                observe("http_request_seconds", time.perf_counter() - started, endpoint=endpoint, method=scope["method"])
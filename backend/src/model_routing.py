@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+# 生成の段階（stage）ごとのモデル・出力上限・期限と、ヘッジ（重複リクエスト）の設定
+#
+#   LLM_MODEL=gpt-4o-mini                   全段階の既定モデル
+#   LLM_<STAGE>_MODEL / LLM_<STAGE>_MAX_TOKENS / LLM_<STAGE>_DEADLINE_SECONDS
+#                                           段階ごとの上書き（STAGE は CHARACTER / OPTIONS / COMBINED / SUMMARY / SPECULATIVE）
+#   LLM_HEDGING=1                           ヘッジを有効にする
+#   LLM_<STAGE>_HEDGE_AFTER_MS=1500         この時間で応答がなければ2本目を投げる（省略時は直近の p90）
+#   LLM_<STAGE>_HEDGE_MODEL=...             2本目に使うモデル（省略時は同じモデル）
+#
+# 先読み（speculative）は待っている人がいないのでヘッジしない。
+
+_STAGE_DEFAULTS = {
+    "character": 200,
+    "options": 200,
+    "combined": 500,
+    "summary": 300,
+    "speculative": 200,
+}
+_NO_HEDGE_STAGES = ("speculative",)
+# p90 を推定するのに使う直近の件数と、推定に必要な最小件数
+_WINDOW = 200
+_MIN_SAMPLES = 20
+_MIN_HEDGE_AFTER = 0.1
+
+
+class StageRoute:
+    __slots__ = ("stage", "model", "max_tokens", "deadline", "hedge", "hedge_after", "hedge_model")
+
+    def __init__(self, stage, model, max_tokens, deadline, hedge=False, hedge_after=None, hedge_model=None):
+        self.stage = stage
+        self.model = model
+        self.max_tokens = max_tokens
+        self.deadline = deadline
+        self.hedge = hedge
+        # None なら直近の p90 を使う
+        self.hedge_after = hedge_after
+        self.hedge_model = hedge_model or model
+
+
+def load_routes(default_deadline):
+    """環境変数から段階ごとの StageRoute を作る"""
+    default_model = os.getenv('LLM_MODEL', 'gpt-4o-mini')
+    hedging = os.getenv('LLM_HEDGING') == '1'
+    routes = {}
+    for stage, max_tokens in _STAGE_DEFAULTS.items():
+        prefix = f"LLM_{stage.upper()}_"
+        # 先読みは既定でキャラクター発言と同じモデルを使う
+        fallback_model = os.getenv('LLM_CHARACTER_MODEL', default_model) if stage == "speculative" else default_model
+        hedge_after = os.getenv(prefix + 'HEDGE_AFTER_MS')
+        routes[stage] = StageRoute(
+            stage,
+            model=os.getenv(prefix + 'MODEL', fallback_model),
+            max_tokens=int(os.getenv(prefix + 'MAX_TOKENS', max_tokens)),
+            deadline=float(os.getenv(prefix + 'DEADLINE_SECONDS', default_deadline)),
+            hedge=hedging and stage not in _NO_HEDGE_STAGES,
+            hedge_after=float(hedge_after) / 1000 if hedge_after else None,
+            hedge_model=os.getenv(prefix + 'HEDGE_MODEL'),
+        )
+    return routes
+
+
+class _LatencyWindow:
+    """直近 _WINDOW 件の応答時間から p90 を出す"""
+
+    def __init__(self):
+        self._samples = deque(maxlen=_WINDOW)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p90(self):
+        with self._lock:
+            if len(self._samples) < _MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[int(len(ordered) * 0.9) - 1]
+
+
+class Hedger:
+    """応答が hedge_after 秒を過ぎても返らなければ同じリクエストをもう1本投げ、先に成功した方を使う
+
+    負けた方は取り消さずに最後まで走らせる（同じキーで相乗りしている呼び出しがあるため）。
+    """
+
+    def __init__(self, max_workers=32):
+        self.max_workers = max_workers
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def _window(self, stage):
+        with self._lock:
+            window = self._windows.get(stage)
+            if window is None:
+                window = self._windows[stage] = _LatencyWindow()
+            return window
+
+    def hedge_after(self, route):
+        """ヘッジするまでの秒数。ヘッジしないなら None"""
+        if not route.hedge:
+            return None
+        if route.hedge_after is not None:
+            return route.hedge_after
+        p90 = self._window(route.stage).p90()
+        return max(p90, _MIN_HEDGE_AFTER) if p90 is not None else None
+
+    def _ensure_executor(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._executor_pid != pid:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="llm-hedge")
+                self._executor_pid = pid
+            return self._executor
+
+    def _timed(self, route, send, params, key):
+        started = time.monotonic()
+        result = send(params, key)
+        self._window(route.stage).add(time.monotonic() - started)
+        return result
+
+    async def _atimed(self, route, send, params, key):
+        started = time.monotonic()
+        result = await send(params, key)
+        self._window(route.stage).add(time.monotonic() - started)
+        return result
+
+    @staticmethod
+    def _hedge_params(route, params):
+        return {**params, "model": route.hedge_model}
+
+    def _won(self, route, winner):
+        metrics.inc("llm_hedges_total", stage=route.stage, winner=winner)
+
+    def call(self, route, send, params, key=None):
+        """send(params, key) を呼び、必要ならヘッジする"""
+        delay = self.hedge_after(route)
+        if delay is None:
+            return self._timed(route, send, params, key)
+
+        executor = self._ensure_executor()
+        primary = executor.submit(self._timed, route, send, params, key)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        # 2本目は相乗りさせず、必ず新しいリクエストとして送る
+        hedge = executor.submit(self._timed, route, send, self._hedge_params(route, params), None)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._won(route, "hedge" if future is hedge else "primary")
+                    return future.result()
+        self._won(route, "none")
+        return primary.result()
+
+    async def acall(self, route, send, params, key=None):
+        """call() の非同期版。send は coroutine を返す関数"""
+        delay = self.hedge_after(route)
+        if delay is None:
+            return await self._atimed(route, send, params, key)
+
+        primary = asyncio.ensure_future(self._atimed(route, send, params, key))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        hedge = asyncio.ensure_future(self._atimed(route, send, self._hedge_params(route, params), None))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    self._won(route, "hedge" if task is hedge else "primary")
+                    for loser in pending:
+                        # 結果は使わないが、例外を未回収のまま残さない
+                        loser.add_done_callback(lambda t: t.cancelled() or t.exception())
+                    return task.result()
+        self._won(route, "none")
+        return primary.result()
+
+    def stats(self, routes):
+        """段階ごとの現在のヘッジ待ち時間（秒、ヘッジしない段階は含めない）"""
+        stats = {}
+        for stage, route in routes.items():
+            delay = self.hedge_after(route)
+            if delay is not None:
+                stats[stage] = delay
+        return stats
@@ -0,0 +1,19 @@
+from datetime import datetime
+from .user import db
+
+class DialogueSession(db.Model):
+    __tablename__ = 'dialogue_sessions'
+    id = db.Column(db.String(32), primary_key=True)
+    character_id = db.Column(db.String(80), nullable=False)
+    last_character_message = db.Column(db.Text)
+    affection_level = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+class DialogueTurn(db.Model):
+    __tablename__ = 'dialogue_turns'
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), db.ForeignKey('dialogue_sessions.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_message = db.Column(db.Text)
+    character_message = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
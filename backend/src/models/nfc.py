@@ -4,6 +4,8 @@ from .user import db
 
 class NfcRecord(db.Model):
     __tablename__ = 'nfc_records'
+    # ログ・履歴 API は (character_id, nfc_uid) で引く
+    __table_args__ = (db.Index('ix_nfc_records_character_id_nfc_uid', 'character_id', 'nfc_uid'),)
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.String(80), nullable=False)
     nfc_uid = db.Column(db.String(80), nullable=False, unique=True)
@@ -17,6 +19,8 @@ class NfcRecord(db.Model):
 
 class NfcConversation(db.Model):
     __tablename__ = 'nfc_conversations'
+    # 履歴はタグごとに (timestamp, id) のキーセットでページングする
+    __table_args__ = (db.Index('ix_nfc_conversations_record_timestamp_id', 'nfc_record_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     nfc_record_id = db.Column(db.Integer, db.ForeignKey('nfc_records.id'), nullable=False)
     message = db.Column(db.Text)
@@ -0,0 +1,95 @@
+import os
+from datetime import datetime
+from sqlalchemy import and_, or_, select
+from src.models.nfc import NfcConversation
+from src.models.user import db
+
+# NFC会話履歴の読み出し
+#
+# 履歴は (timestamp, id) のキーセットでページングするので、何ページ目でも
+# ix_nfc_conversations_record_timestamp_id を1回たどるだけで済む。
+# ORM オブジェクトは作らず、必要な列だけを取り出す。
+#
+#   NFC_HISTORY_DEFAULT_LIMIT=0    limit も before も省略したときの件数（0 なら従来どおり全件）
+#   NFC_HISTORY_MAX_LIMIT=500      limit の上限
+#   NFC_EXPORT_CHUNK_SIZE=1000     エクスポート時に1回のクエリで読む件数
+
+DEFAULT_LIMIT = int(os.getenv('NFC_HISTORY_DEFAULT_LIMIT', 0))
+# before だけを指定したときのページの件数
+PAGE_LIMIT = 50
+MAX_LIMIT = int(os.getenv('NFC_HISTORY_MAX_LIMIT', 500))
+EXPORT_CHUNK_SIZE = int(os.getenv('NFC_EXPORT_CHUNK_SIZE', 1000))
+
+_COLUMNS = (NfcConversation.id, NfcConversation.message, NfcConversation.sender, NfcConversation.timestamp)
+
+
+def encode_cursor(timestamp, conversation_id):
+    return f"{timestamp.isoformat()}_{conversation_id}"
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を (timestamp, id) に戻す。不正な値は ValueError"""
+    timestamp, _, conversation_id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(conversation_id)
+
+
+def record_summary(record):
+    """NfcRecord の要約（会話は含めない）"""
+    return {
+        'character_id': record.character_id,
+        'nfc_uid': record.nfc_uid,
+        'last_location_lat': record.last_location_lat,
+        'last_location_lon': record.last_location_lon,
+        'last_location_time': record.last_location_time.isoformat() if record.last_location_time else None,
+        'affection_level': record.affection_level,
+    }
+
+
+def _conversation(row):
+    return {
+        'id': row.id,
+        'message': row.message,
+        'sender': row.sender,
+        'timestamp': row.timestamp.isoformat(),
+    }
+
+
+def conversation_page(record_id, before=None, limit=PAGE_LIMIT):
+    """before より前の会話を新しい順に最大 limit 件読み、古い順に並べて返す
+
+    戻り値は (会話のリスト, さらに古い会話を読むためのカーソル or None)。
+    """
+    query = select(*_COLUMNS).where(NfcConversation.nfc_record_id == record_id)
+    if before is not None:
+        timestamp, conversation_id = before
+        query = query.where(or_(
+            NfcConversation.timestamp < timestamp,
+            and_(NfcConversation.timestamp == timestamp, NfcConversation.id < conversation_id),
+        ))
+    query = query.order_by(NfcConversation.timestamp.desc(), NfcConversation.id.desc()).limit(limit + 1)
+    rows = db.session.execute(query).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return [_conversation(row) for row in reversed(rows)], next_cursor
+
+
+def iter_conversations(record_id, chunk_size=EXPORT_CHUNK_SIZE):
+    """全会話を古い順に chunk_size 件ずつ読みながら返す（メモリ使用量は履歴の長さによらない）"""
+    after = None
+    while True:
+        query = select(*_COLUMNS).where(NfcConversation.nfc_record_id == record_id)
+        if after is not None:
+            query = query.where(or_(
+                NfcConversation.timestamp > after[0],
+                and_(NfcConversation.timestamp == after[0], NfcConversation.id > after[1]),
+            ))
+        query = query.order_by(NfcConversation.timestamp, NfcConversation.id).limit(chunk_size)
+        rows = db.session.execute(query).all()
+        for row in rows:
+            yield _conversation(row)
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1].timestamp, rows[-1].id)
@@ -0,0 +1,180 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from src import metrics
+from src.models.nfc import NfcRecord, NfcConversation
+from src.models.user import db
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _apply(record, event):
+    """NFCログ1件分の位置情報・好感度を NfcRecord に反映する"""
+    if event["lat"] is not None:
+        record.last_location_lat = event["lat"]
+    if event["lon"] is not None:
+        record.last_location_lon = event["lon"]
+    record.last_location_time = event["timestamp"]
+    if event["affection_level"] is not None:
+        record.affection_level = event["affection_level"]
+    record.updated_at = event["timestamp"]
+
+
+def write_nfc_events(events):
+    """NFCログをまとめて1トランザクションで書き込む（app context 内で呼ぶ）
+
+    NfcRecord は (character_id, nfc_uid) ごとに1回だけ引いて更新し、
+    NfcConversation は一括で INSERT する。
+    """
+    records = {}
+    with metrics.span("nfc_db_query"):
+        for key in {(e["character_id"], e["nfc_uid"]) for e in events}:
+            records[key] = NfcRecord.query.filter_by(character_id=key[0], nfc_uid=key[1]).first()
+
+    conversations = []
+    for event in events:
+        key = (event["character_id"], event["nfc_uid"])
+        record = records[key]
+        if record is None:
+            record = records[key] = NfcRecord(character_id=key[0], nfc_uid=key[1])
+            db.session.add(record)
+        _apply(record, event)
+        if event["message"]:
+            conversations.append((record, event))
+
+    with metrics.span("nfc_db_commit"):
+        if conversations:
+            # 新規レコードの id を確定させてから会話をまとめて INSERT する
+            db.session.flush()
+            db.session.bulk_insert_mappings(NfcConversation, [
+                {
+                    "nfc_record_id": record.id,
+                    "message": event["message"],
+                    "sender": event["sender"],
+                    "timestamp": event["timestamp"],
+                }
+                for record, event in conversations
+            ])
+        db.session.commit()
+
+
+class NfcWriteBehind:
+    """NFCログを受け付け順にキューへ積み、バックグラウンドでまとめて書き込む
+
+    最初のイベントから flush_interval 秒以内、または batch_size 件たまった時点で
+    1トランザクションで書き込む。キューが満杯なら submit() は False を返すので、
+    呼び出し側で同期書き込みに切り替える。終了時は atexit でキューを書き切る。
+    """
+
+    def __init__(self, app, batch_size=500, flush_interval=0.5, max_queue=10000):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._worker_pid = None
+        self._stopping = False
+        self.flushed = 0
+        self.batches = 0
+        self.failed = 0
+
+    def submit(self, event):
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def _ensure_worker(self):
+        # スレッドは fork を越えて引き継がれないので、プロセスごとに起動する
+        pid = os.getpid()
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._worker_pid = pid
+            self._thread = threading.Thread(target=self._run, name="nfc-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.drain)
+
+    def _next_batch(self):
+        event = self._queue.get()
+        if event is _STOP:
+            return None
+        batch = [event]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                event = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if event is _STOP:
+                # 手元の分を書き込んでから止まる
+                self._stopping = True
+                break
+            batch.append(event)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._flush(batch)
+            if self._stopping:
+                return
+
+    def _flush(self, batch):
+        with self.app.app_context():
+            try:
+                write_nfc_events(batch)
+                with self._lock:
+                    self.flushed += len(batch)
+                    self.batches += 1
+                return
+            except Exception:
+                db.session.rollback()
+                logger.exception("NFC write-behind flush of %d events failed, retrying one by one", len(batch))
+            # 1件の不正なイベントでバッチ全体を失わないよう、個別に書き直す
+            for event in batch:
+                try:
+                    write_nfc_events([event])
+                    with self._lock:
+                        self.flushed += 1
+                except Exception:
+                    db.session.rollback()
+                    with self._lock:
+                        self.failed += 1
+                    logger.exception("Dropped NFC event for %s/%s", event["character_id"], event["nfc_uid"])
+            with self._lock:
+                self.batches += 1
+
+    def drain(self, timeout=10):
+        """キューに残ったイベントを書き込んでからワーカーを止める"""
+        thread = self._thread
+        if thread is None or self._worker_pid != os.getpid() or not thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("NFC write-behind queue did not drain before shutdown")
+            return
+        thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "flushed": self.flushed,
+                "batches": self.batches,
+                "failed": self.failed,
+            }
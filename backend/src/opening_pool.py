@@ -0,0 +1,113 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class OpeningPool:
+    """バケットごとに生成済みの初期会話を貯めておき、バックグラウンドで補充するプール
+
+    バケットは (キャラクターID, 都道府県, 市区町村, 時間帯, 好感度) のような
+    ハッシュ可能なタプルで、中身の意味は generate コールバック側が解釈する。
+    take() で在庫が low_watermark を下回ったバケットは補充キューに積まれ、
+    ワーカースレッドが size 件になるまで generate(bucket) で生成し直す。
+    """
+
+    def __init__(self, generate, size=4, low_watermark=2, ttl=60*60, workers=2, max_buckets=1000):
+        self._generate = generate
+        self.size = size
+        self.low_watermark = low_watermark
+        self.ttl = ttl
+        self.workers = workers
+        self._pools = LRUCache(maxsize=max_buckets)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._worker_pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, bucket):
+        """在庫があれば1件取り出して返す。なければ None"""
+        now = time.monotonic()
+        entry = None
+        with self._lock:
+            pool = self._pools.get(bucket)
+            if pool is None:
+                pool = self._pools[bucket] = deque()
+            while pool:
+                created_at, candidate = pool.popleft()
+                if now - created_at < self.ttl:
+                    entry = candidate
+                    break
+            remaining = len(pool)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if remaining < self.low_watermark:
+            self.schedule(bucket)
+        return entry
+
+    def schedule(self, bucket):
+        """バケットを補充キューに積む（補充待ちなら何もしない）"""
+        with self._lock:
+            if bucket in self._pending:
+                return
+            self._pending.add(bucket)
+        self._ensure_workers()
+        self._queue.put(bucket)
+
+    def _ensure_workers(self):
+        # スレッドは fork を越えて引き継がれないので、プロセスごとに起動する
+        pid = os.getpid()
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._worker_pid = pid
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"opening-pool-{i}", daemon=True).start()
+
+    def _stock(self, bucket):
+        with self._lock:
+            pool = self._pools.get(bucket)
+            return len(pool) if pool is not None else 0
+
+    def _run(self):
+        while True:
+            bucket = self._queue.get()
+            try:
+                while self._stock(bucket) < self.size:
+                    entry = self._generate(bucket)
+                    if entry is None:
+                        break
+                    with self._lock:
+                        pool = self._pools.get(bucket)
+                        if pool is None:
+                            pool = self._pools[bucket] = deque()
+                        pool.append((time.monotonic(), entry))
+            except Exception as e:
+                logger.warning("Opening pool refill failed for %s: %s", bucket, e)
+            finally:
+                with self._lock:
+                    self._pending.discard(bucket)
+
+    def clear(self):
+        """在庫をすべて捨てる（補充中のバケットは次の take() から補充し直す）"""
+        with self._lock:
+            self._pools.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buckets": len(self._pools),
+                "entries": sum(len(pool) for pool in self._pools.values()),
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,37 @@
+import csv
+import math
+import os
+
+# 各都道府県の県庁所在地と主要都市の座標（prefecture_points.csv）から、
+# 最寄りの地点の都道府県を返す簡易オフライン判定。
+# 県境付近では外れることがあるので、詳細住所が取れるまでのつなぎとして使う。
+
+_POINTS_PATH = os.path.join(os.path.dirname(__file__), 'prefecture_points.csv')
+_points = None
+
+
+def _load_points():
+    with open(_POINTS_PATH, 'r', encoding='utf-8') as file:
+        return [
+            (row['都道府県'], float(row['緯度']), float(row['経度']))
+            for row in csv.DictReader(file)
+        ]
+
+
+def nearest_prefecture(lat, lon):
+    """最寄りの基準点の都道府県名を返す。日本から大きく離れていれば None"""
+    global _points
+    if _points is None:
+        _points = _load_points()
+
+    cos_lat = math.cos(math.radians(lat))
+    best, best_distance = None, None
+    for pref, p_lat, p_lon in _points:
+        # 数百km 程度なので正距円筒近似で十分
+        distance = (lat - p_lat) ** 2 + ((lon - p_lon) * cos_lat) ** 2
+        if best_distance is None or distance < best_distance:
+            best, best_distance = pref, distance
+    # 最寄りの基準点から約 3度（300km 強）以上離れていれば国外とみなす
+    if best_distance is None or best_distance > 9:
+        return None
+    return best
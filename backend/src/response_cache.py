@@ -0,0 +1,45 @@
+import hashlib
+import json
+import random
+import threading
+from cachetools import TTLCache
+
+
+class ResponseCache:
+    """プロンプトとモデルパラメーターの完全一致で LLM 応答を再利用するキャッシュ
+
+    1つのキーに最大 variants 件の応答を貯め、揃うまではミス扱いで新規生成させる。
+    揃った後はその中からランダムに1件返すので、temperature=1.0 の多様さを保てる。
+    件数上限を超えたキーは LRU で、ttl 秒を過ぎたキーは期限切れで破棄される。
+    """
+
+    def __init__(self, maxsize=1000, ttl=60*60, variants=3):
+        self.variants = max(1, variants)
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(**params):
+        payload = json.dumps(params, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            pool = self._cache.get(key)
+            if pool is None or len(pool) < self.variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return random.choice(pool)
+
+    def put(self, key, value):
+        with self._lock:
+            pool = self._cache.get(key, ())
+            if len(pool) < self.variants:
+                self._cache[key] = pool + (value,)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
@@ -1,14 +1,25 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 from flask_cors import cross_origin
-from src.character_service import CharacterService
-from src.models.nfc import NfcRecord, NfcConversation
-from src.models.user import db
+from src.character_service import CharacterService, geocode_stats, prefetch_location
+from src.models.nfc import NfcRecord
+from src.nfc_writer import write_nfc_events
+from src import metrics, nfc_history, session_store
 from datetime import datetime
+import json
 
 character_bp = Blueprint("character", __name__)
 character_service = CharacterService()
+# 非同期版のサービスも同じ状態を共有しているので、ラベルなしで1回だけ登録する
+metrics.register_collector(character_service.metrics_samples)
 
 
+def _load_session_turn(session_id, user_choice):
+    """セッションを読み込み、今回の選択で履歴に積まれるターンと一緒に返す"""
+    session = session_store.load_session(session_id)
+    if session is None:
+        return None, None
+    return session, session_store.pending_turn(session, user_choice)
+
 @character_bp.route("/dialogue/start", methods=["POST"])
 @cross_origin()
 def start_dialogue():
@@ -18,10 +29,17 @@ def start_dialogue():
         character_id = data.get("character_id", "mano")
         lat = float(data["lat"]) if data.get("lat") is not None else None
         lon = float(data["lon"]) if data.get("lon") is not None else None
-        response = character_service.generate_initial_dialogue(character_id, lat, lon)
+        # 先読みをこのセッション単位にするため、ID は生成前に払い出しておく
+        session_id = session_store.new_session_id() if character_id in character_service.characters else None
+        response = character_service.generate_initial_dialogue(character_id, lat, lon, session_id=session_id)
+        if session_id is not None:
+            # 生成に失敗したときはエラー文を直前の発言として残さない
+            opening = None if response.get("error") else response["message"]
+            session_store.create_session(character_id, opening, response["debug_affection_level"], session_id=session_id)
         
         return jsonify({
             "success": True,
+            "session_id": session_id,
             "message": response["message"],
             "options": response["options"]
         })
@@ -47,11 +65,26 @@ def next_dialogue():
 
         if user_choice is None:
             return jsonify({"success": False, "error": "user_choice is required"}), 400
+
+        session, turn = None, None
+        if data.get("session_id"):
+            session, turn = _load_session_turn(data["session_id"], user_choice)
+            if session is None:
+                return jsonify({"success": False, "error": "Session not found"}), 404
+            character_id = session["character_id"]
+            conversation_history = session_store.history_with(session, turn)
+            affection_level = session_store.turn_affection(session, turn, affection_level, data.get("option_type"))
         
-        response = character_service.generate_next_dialogue(character_id, user_choice, conversation_history, lat, lon, affection_level)
+        response = character_service.generate_next_dialogue(
+            character_id, user_choice, conversation_history, lat, lon, affection_level, session_id=data.get("session_id")
+        )
+        # 生成に失敗したときは記録せず、同じ選択でやり直せるようにする
+        if session is not None and not response.get("error"):
+            session_store.record_turn(session["session_id"], turn, response["message"], affection_level)
         
         return jsonify({
             "success": True,
+            "session_id": session["session_id"] if session else None,
             "message": response["message"],
             "options": response["options"]
         })
@@ -62,6 +95,53 @@ def next_dialogue():
             "error": str(e)
         }), 500
 
+def _sse(event, data):
+    """Server-Sent Events の1イベント分の文字列を生成"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@character_bp.route("/dialogue/next/stream", methods=["POST"])
+@cross_origin()
+def next_dialogue_stream():
+    """次のメッセージをトークン単位でSSE配信し、最後に選択肢を送る"""
+    data = request.get_json()
+    character_id = data.get("character_id", "mano")
+    user_choice = data.get("user_choice")
+    conversation_history = data.get("conversation_history", [])
+    lat = data.get("lat")
+    lon = data.get("lon")
+    affection_level = data.get("affection_level")
+
+    if user_choice is None:
+        return jsonify({"success": False, "error": "user_choice is required"}), 400
+
+    session, turn = None, None
+    if data.get("session_id"):
+        session, turn = _load_session_turn(data["session_id"], user_choice)
+        if session is None:
+            return jsonify({"success": False, "error": "Session not found"}), 404
+        character_id = session["character_id"]
+        conversation_history = session_store.history_with(session, turn)
+        affection_level = session_store.turn_affection(session, turn, affection_level, data.get("option_type"))
+
+    def generate():
+        events = character_service.stream_next_dialogue(
+            character_id, user_choice, conversation_history, lat, lon, affection_level, session_id=data.get("session_id")
+        )
+        for event, payload in events:
+            if event == "options" and session is not None:
+                session_store.record_turn(session["session_id"], turn, payload["message"], affection_level)
+            yield _sse(event, payload)
+        yield _sse("done", {})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # リバースプロキシでのバッファリングを無効化
+        },
+    )
+
 @character_bp.route("/dialogue/character", methods=["POST"])
 @cross_origin()
 def character_dialogue():
@@ -75,10 +155,25 @@ def character_dialogue():
         lon = data.get("lon")
         affection_level = data.get("affection_level")
 
+        session, turn = None, None
+        if data.get("session_id"):
+            session, turn = _load_session_turn(data["session_id"], user_choice)
+            if session is None:
+                return jsonify({"success": False, "error": "Session not found"}), 404
+            character_id = session["character_id"]
+            conversation_history = session_store.history_with(session, turn)
+            affection_level = session_store.turn_affection(session, turn, affection_level, data.get("option_type"))
+
         # キャラクター発言のみ生成
-        response = character_service.generate_character_message(character_id, user_choice, conversation_history, lat, lon, affection_level)
+        response = character_service.generate_character_message(
+            character_id, user_choice, conversation_history, lat, lon, affection_level, session_id=data.get("session_id")
+        )
+        # 生成に失敗したときは記録せず、同じ選択でやり直せるようにする
+        if session is not None and not response.get("error"):
+            session_store.record_turn(session["session_id"], turn, response["message"], affection_level)
         return jsonify({
             "success": True,
+            "session_id": session["session_id"] if session else None,
             "message": response["message"]
         })
     except Exception as e:
@@ -98,8 +193,23 @@ def options_dialogue():
         lon = data.get("lon")
         affection_level = data.get("affection_level")
 
+        # session_id があれば直前の発言と履歴をサーバー側から補う
+        if data.get("session_id"):
+            session = session_store.load_session(data["session_id"])
+            if session is None:
+                return jsonify({"success": False, "error": "Session not found"}), 404
+            character_id = session["character_id"]
+            conversation_history = session["history"]
+            character_message = character_message or session["character_message"]
+            if user_choice is None and conversation_history:
+                user_choice = conversation_history[-1]["user"]
+            # 直前の /dialogue/character で保存した好感度を使う
+            affection_level = session_store.turn_affection(session, None, affection_level)
+
         # 4択選択肢のみ生成
-        response = character_service.generate_options(character_id, character_message, user_choice, conversation_history, lat, lon, affection_level)
+        response = character_service.generate_options(
+            character_id, character_message, user_choice, conversation_history, lat, lon, affection_level, session_id=data.get("session_id")
+        )
         return jsonify({
             "success": True,
             "options": response["options"]
@@ -107,70 +217,98 @@ def options_dialogue():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@character_bp.route("/sessions", methods=["POST"])
+@cross_origin()
+def create_session():
+    """会話履歴をサーバー側で保持するセッションを作成"""
+    data = request.get_json(silent=True) or {}
+    character_id = data.get("character_id", "mano")
+    if character_id not in character_service.characters:
+        return jsonify({"success": False, "error": "Character not found"}), 404
+    session_id = session_store.create_session(character_id, affection_level=data.get("affection_level"))
+    return jsonify({"success": True, "session_id": session_id}), 201
+
+def _ndjson(results):
+    for result in results:
+        yield json.dumps(result, ensure_ascii=False) + "\n"
+
+@character_bp.route("/dialogue/batch", methods=["POST"])
+@cross_origin()
+def batch_dialogue():
+    """複数の会話生成ジョブを並列実行し、完了順に NDJSON で返す
+
+    mode="offline" なら OpenAI Batch API に投入して batch_id を返す。
+    """
+    data = request.get_json(silent=True) or {}
+    jobs = data.get("jobs")
+    if not isinstance(jobs, list) or not all(isinstance(job, dict) for job in jobs):
+        return jsonify({"success": False, "error": "jobs must be a list of objects"}), 400
+    if len(jobs) > character_service.batch_max_jobs:
+        return jsonify({"success": False, "error": f"too many jobs (max {character_service.batch_max_jobs})"}), 400
+    parallelism = data.get("parallelism")
+    # 不正な値はストリーム開始後ではなくここで弾く（bool は int の派生なので除く）
+    if parallelism is not None and (not isinstance(parallelism, int) or isinstance(parallelism, bool) or parallelism < 1):
+        return jsonify({"success": False, "error": "parallelism must be a positive integer"}), 400
+
+    if data.get("mode") == "offline":
+        try:
+            return jsonify({"success": True, **character_service.submit_offline_batch(jobs)}), 202
+        except Exception as e:
+            return jsonify({"success": False, "error": str(e)}), 500
+
+    results = character_service.generate_batch(jobs, parallelism)
+    return Response(stream_with_context(_ndjson(results)), mimetype="application/x-ndjson")
+
+@character_bp.route("/dialogue/batch/<batch_id>", methods=["GET"])
+@cross_origin()
+def batch_dialogue_results(batch_id):
+    """オフラインバッチの状態を返す。完了していれば結果を NDJSON で返す"""
+    try:
+        status = character_service.offline_batch_status(batch_id)
+        if status["status"] != "completed" or not status["output_file_id"]:
+            return jsonify({"success": True, **status})
+        results = character_service.offline_batch_results(status["output_file_id"])
+        return Response(stream_with_context(_ndjson(results)), mimetype="application/x-ndjson")
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+def _catalog_response(rendered):
+    """読み込み時に作った JSON をそのまま返す。If-None-Match が一致すれば 304"""
+    body, etag = rendered
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    # キャラクターの更新がすぐ反映されるよう、毎回 ETag で再検証させる
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
 @character_bp.route("/characters", methods=["GET"])
 @cross_origin()
 def get_characters():
     """利用可能なキャラクター一覧を取得"""
-    try:
-        characters = []
-        for char_id, char_data in character_service.characters.items():
-            characters.append({
-                "id": char_id,
-                "name": char_data["名前"],
-                "gender": char_data["性別"],
-                "personality": char_data["性格"],
-                "first_person": char_data["一人称"],
-                "fan_name": char_data["ファンの名称"],
-                "tone": char_data["口調"],
-                "setting": char_data["背景・設定"],
-                "character_image_url": char_data.get("キャラクター画像URL", ""),
-                "background_image_url": char_data.get("背景画像URL", "")
-            })
-        
-        return jsonify({
-            "success": True,
-            "characters": characters
-        })
-    
-    except Exception as e:
-        return jsonify({
-            "success": False,
-            "error": str(e)
-        }), 500
+    return _catalog_response(character_service.catalog.list_response)
 
 @character_bp.route("/characters/<character_id>", methods=["GET"])
 @cross_origin()
 def get_character(character_id):
     """特定のキャラクター情報を取得"""
-    try:
-        character_data = character_service.characters.get(character_id)
-        if not character_data:
-            return jsonify({
-                "success": False,
-                "error": "Character not found"
-            }), 404
-        
-        return jsonify({
-            "success": True,
-            "character": {
-                "id": character_id,
-                "name": character_data["名前"],
-                "gender": character_data["性別"],
-                "personality": character_data["性格"],
-                "first_person": character_data["一人称"],
-                "fan_name": character_data["ファンの名称"],
-                "tone": character_data["口調"],
-                "setting": character_data["背景・設定"],
-                "character_image_url": character_data.get("キャラクター画像URL", ""),
-                "background_image_url": character_data.get("背景画像URL", "")
-            }
-        })
-    
-    except Exception as e:
+    rendered = character_service.catalog.detail_responses.get(character_id)
+    if rendered is None:
         return jsonify({
             "success": False,
-            "error": str(e)
-        }), 500
+            "error": "Character not found"
+        }), 404
+    return _catalog_response(rendered)
+
+@character_bp.route("/geocode/stats", methods=["GET"])
+@cross_origin()
+def get_geocode_stats():
+    """逆ジオコーディングキャッシュのヒット・ミス数を取得"""
+    return jsonify({"success": True, "stats": geocode_stats()})
+
+@character_bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus 形式のメトリクス（ワーカープロセスごとの集計）"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @character_bp.route('/nfc/<character_id>/<nfc_uid>/log', methods=['POST'])
 @cross_origin()
@@ -184,54 +322,77 @@ def log_nfc_data(character_id, nfc_uid):
     sender = data.get('sender')  # 'user' or 'character'
     now = datetime.utcnow()
 
-    # nfc_uid + character_idでレコードを検索
-    nfc_record = NfcRecord.query.filter_by(character_id=character_id, nfc_uid=nfc_uid).first()
-    if not nfc_record:
-        nfc_record = NfcRecord(character_id=character_id, nfc_uid=nfc_uid)
-        db.session.add(nfc_record)
-
-    # 位置情報・好感度を更新
-    if lat is not None:
-        nfc_record.last_location_lat = lat
-    if lon is not None:
-        nfc_record.last_location_lon = lon
-    nfc_record.last_location_time = now
-    if affection_level is not None:
-        nfc_record.affection_level = affection_level
-    nfc_record.updated_at = now
-
-    # 会話内容があれば履歴に追加
-    if message:
-        conv = NfcConversation(nfc_record=nfc_record, message=message, sender=sender, timestamp=now)
-        db.session.add(conv)
-
-    db.session.commit()
+    # 次の会話生成までに詳細住所を用意しておく
+    if lat is not None and lon is not None:
+        prefetch_location(lat, lon)
+
+    event = {
+        'character_id': character_id,
+        'nfc_uid': nfc_uid,
+        'lat': lat,
+        'lon': lon,
+        'affection_level': affection_level,
+        'message': message,
+        'sender': sender,
+        'timestamp': now,
+    }
+
+    # 書き込み遅延モードならキューに積んで即応答（キューが満杯なら同期で書き込む）
+    writer = current_app.extensions.get('nfc_writer')
+    if writer is not None and writer.submit(event):
+        return jsonify({'success': True, 'queued': True})
+
+    write_nfc_events([event])
     return jsonify({'success': True})
 
 @character_bp.route('/nfc/<character_id>/<nfc_uid>/history', methods=['GET'])
 @cross_origin()
 def get_nfc_history(character_id, nfc_uid):
-    """NFCタグごとの履歴取得"""
+    """NFCタグごとの履歴取得
+
+    ?limit=N&before=<cursor> で新しい方から N 件ずつ取得する（各ページ内は古い順）。
+    次のページは next_before をそのまま before に渡す。?summary=1 なら会話を含めない。
+    どちらも指定しなければ従来どおり全件を返す（NFC_HISTORY_DEFAULT_LIMIT で件数を絞れる）。
+    """
+    try:
+        limit = request.args.get('limit')
+        before = request.args.get('before')
+        if limit is None and before is None and nfc_history.DEFAULT_LIMIT > 0:
+            limit = nfc_history.DEFAULT_LIMIT
+        if limit is not None:
+            limit = min(max(int(limit), 1), nfc_history.MAX_LIMIT)
+        elif before is not None:
+            limit = nfc_history.PAGE_LIMIT
+        before = nfc_history.decode_cursor(before) if before else None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid limit or before'}), 400
+
+    with metrics.span("nfc_db_query"):
+        nfc_record = NfcRecord.query.filter_by(character_id=character_id, nfc_uid=nfc_uid).first()
+        if not nfc_record:
+            return jsonify({'success': False, 'error': 'NFC record not found'}), 404
+        body = {'success': True, **nfc_history.record_summary(nfc_record)}
+        if request.args.get('summary') not in ('1', 'true'):
+            if limit is None:
+                # ページングを指定しない従来のクライアントには全件を返す
+                body['conversations'], body['next_before'] = list(nfc_history.iter_conversations(nfc_record.id)), None
+            else:
+                body['conversations'], body['next_before'] = nfc_history.conversation_page(nfc_record.id, before, limit)
+    return jsonify(body)
+
+@character_bp.route('/nfc/<character_id>/<nfc_uid>/history/export', methods=['GET'])
+@cross_origin()
+def export_nfc_history(character_id, nfc_uid):
+    """NFCタグの全履歴を NDJSON で返す（1行目がタグの要約、以降は会話を古い順に1件ずつ）"""
     nfc_record = NfcRecord.query.filter_by(character_id=character_id, nfc_uid=nfc_uid).first()
     if not nfc_record:
         return jsonify({'success': False, 'error': 'NFC record not found'}), 404
-    conversations = [
-        {
-            'message': conv.message,
-            'sender': conv.sender,
-            'timestamp': conv.timestamp.isoformat()
-        }
-        for conv in nfc_record.conversations
-    ]
-    return jsonify({
-        'success': True,
-        'character_id': nfc_record.character_id,
-        'nfc_uid': nfc_record.nfc_uid,
-        'last_location_lat': nfc_record.last_location_lat,
-        'last_location_lon': nfc_record.last_location_lon,
-        'last_location_time': nfc_record.last_location_time.isoformat() if nfc_record.last_location_time else None,
-        'affection_level': nfc_record.affection_level,
-        'conversations': conversations
-    })
+    summary, record_id = nfc_history.record_summary(nfc_record), nfc_record.id
+
+    def generate():
+        yield from _ndjson([summary])
+        yield from _ndjson(nfc_history.iter_conversations(record_id))
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
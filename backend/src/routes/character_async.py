@@ -0,0 +1,232 @@
+import asyncio
+import json
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from src import session_store
+from src.async_character_service import AsyncCharacterService
+from src.routes.character import character_service as sync_character_service
+
+# Flask 側（/api のその他のルート）と同じ流量制御・キャッシュ・プールを使う。
+# 状態は共有しているので、メトリクスは同期版のコレクターがまとめて出す
+character_service = AsyncCharacterService(shared=sync_character_service)
+
+
+def _coord(value):
+    return float(value) if value is not None else None
+
+
+def _in_app_context(func, *args):
+    # セッションストアは Flask-SQLAlchemy を使うので Flask の app context 内で実行する
+    from src.main import app as flask_app
+    with flask_app.app_context():
+        return func(*args)
+
+
+async def _store(func, *args):
+    """セッションストアの DB 操作をワーカースレッドで実行する"""
+    return await asyncio.to_thread(_in_app_context, func, *args)
+
+
+async def _load_session_turn(session_id, user_choice):
+    session = await _store(session_store.load_session, session_id)
+    if session is None:
+        return None, None
+    return session, session_store.pending_turn(session, user_choice)
+
+
+def _session_not_found():
+    return JSONResponse({"success": False, "error": "Session not found"}, status_code=404)
+
+
+async def start_dialogue(request):
+    """会話の初期メッセージと選択肢を生成"""
+    try:
+        data = await request.json()
+        character_id = data.get("character_id", "mano")
+        lat = _coord(data.get("lat"))
+        lon = _coord(data.get("lon"))
+        # 先読みをこのセッション単位にするため、ID は生成前に払い出しておく
+        session_id = session_store.new_session_id() if character_id in character_service.characters else None
+        response = await character_service.generate_initial_dialogue(character_id, lat, lon, session_id=session_id)
+        if session_id is not None:
+            # 生成に失敗したときはエラー文を直前の発言として残さない
+            opening = None if response.get("error") else response["message"]
+            await _store(session_store.create_session, character_id, opening, response["debug_affection_level"], session_id)
+
+        return JSONResponse({
+            "success": True,
+            "session_id": session_id,
+            "message": response["message"],
+            "options": response["options"]
+        })
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+async def next_dialogue(request):
+    """ユーザーの選択に基づいて次のメッセージと選択肢を生成"""
+    try:
+        data = await request.json()
+        character_id = data.get("character_id", "mano")
+        user_choice = data.get("user_choice")
+        conversation_history = data.get("conversation_history", [])
+        lat = data.get("lat")
+        lon = data.get("lon")
+        affection_level = data.get("affection_level")
+
+        if user_choice is None:
+            return JSONResponse({"success": False, "error": "user_choice is required"}, status_code=400)
+
+        session, turn = None, None
+        if data.get("session_id"):
+            session, turn = await _load_session_turn(data["session_id"], user_choice)
+            if session is None:
+                return _session_not_found()
+            character_id = session["character_id"]
+            conversation_history = session_store.history_with(session, turn)
+            affection_level = session_store.turn_affection(session, turn, affection_level, data.get("option_type"))
+
+        response = await character_service.generate_next_dialogue(
+            character_id, user_choice, conversation_history, lat, lon, affection_level, session_id=data.get("session_id")
+        )
+        # 生成に失敗したときは記録せず、同じ選択でやり直せるようにする
+        if session is not None and not response.get("error"):
+            await _store(session_store.record_turn, session["session_id"], turn, response["message"], affection_level)
+
+        return JSONResponse({
+            "success": True,
+            "session_id": session["session_id"] if session else None,
+            "message": response["message"],
+            "options": response["options"]
+        })
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def next_dialogue_stream(request):
+    """次のメッセージをトークン単位でSSE配信し、最後に選択肢を送る"""
+    data = await request.json()
+    character_id = data.get("character_id", "mano")
+    user_choice = data.get("user_choice")
+    conversation_history = data.get("conversation_history", [])
+    lat = data.get("lat")
+    lon = data.get("lon")
+    affection_level = data.get("affection_level")
+
+    if user_choice is None:
+        return JSONResponse({"success": False, "error": "user_choice is required"}, status_code=400)
+
+    session, turn = None, None
+    if data.get("session_id"):
+        session, turn = await _load_session_turn(data["session_id"], user_choice)
+        if session is None:
+            return _session_not_found()
+        character_id = session["character_id"]
+        conversation_history = session_store.history_with(session, turn)
+        affection_level = session_store.turn_affection(session, turn, affection_level, data.get("option_type"))
+
+    async def generate():
+        events = character_service.stream_next_dialogue(
+            character_id, user_choice, conversation_history, lat, lon, affection_level, session_id=data.get("session_id")
+        )
+        async for event, payload in events:
+            if event == "options" and session is not None:
+                await _store(session_store.record_turn, session["session_id"], turn, payload["message"], affection_level)
+            yield _sse(event, payload)
+        yield _sse("done", {})
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def character_dialogue(request):
+    """キャラクター発言のみを生成"""
+    try:
+        data = await request.json()
+        character_id = data.get("character_id", "mano")
+        user_choice = data.get("user_choice")
+        conversation_history = data.get("conversation_history", [])
+        affection_level = data.get("affection_level")
+
+        session, turn = None, None
+        if data.get("session_id"):
+            session, turn = await _load_session_turn(data["session_id"], user_choice)
+            if session is None:
+                return _session_not_found()
+            character_id = session["character_id"]
+            conversation_history = session_store.history_with(session, turn)
+            affection_level = session_store.turn_affection(session, turn, affection_level, data.get("option_type"))
+
+        response = await character_service.generate_character_message(
+            character_id,
+            user_choice,
+            conversation_history,
+            data.get("lat"),
+            data.get("lon"),
+            affection_level,
+            session_id=data.get("session_id"),
+        )
+        # 生成に失敗したときは記録せず、同じ選択でやり直せるようにする
+        if session is not None and not response.get("error"):
+            await _store(session_store.record_turn, session["session_id"], turn, response["message"], affection_level)
+        return JSONResponse({
+            "success": True,
+            "session_id": session["session_id"] if session else None,
+            "message": response["message"]
+        })
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+async def options_dialogue(request):
+    """4択選択肢のみを生成"""
+    try:
+        data = await request.json()
+        character_id = data.get("character_id", "mano")
+        character_message = data.get("character_message")
+        user_choice = data.get("user_choice")
+        conversation_history = data.get("conversation_history", [])
+        affection_level = data.get("affection_level")
+
+        if data.get("session_id"):
+            session = await _store(session_store.load_session, data["session_id"])
+            if session is None:
+                return _session_not_found()
+            character_id = session["character_id"]
+            conversation_history = session["history"]
+            character_message = character_message or session["character_message"]
+            if user_choice is None and conversation_history:
+                user_choice = conversation_history[-1]["user"]
+            # 直前の /dialogue/character で保存した好感度を使う
+            affection_level = session_store.turn_affection(session, None, affection_level)
+
+        response = await character_service.generate_options(
+            character_id,
+            character_message,
+            user_choice,
+            conversation_history,
+            data.get("lat"),
+            data.get("lon"),
+            affection_level,
+            session_id=data.get("session_id"),
+        )
+        return JSONResponse({"success": True, "options": response["options"]})
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+# それ以外の /api 配下は Flask アプリに流すため、パスは /api から完全一致で指定する
+routes = [
+    Route("/api/dialogue/start", start_dialogue, methods=["POST"]),
+    Route("/api/dialogue/next", next_dialogue, methods=["POST"]),
+    Route("/api/dialogue/next/stream", next_dialogue_stream, methods=["POST"]),
+    Route("/api/dialogue/character", character_dialogue, methods=["POST"]),
+    Route("/api/dialogue/options", options_dialogue, methods=["POST"]),
+]
@@ -0,0 +1,98 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+from src.dialogue_options import affection_after, normalize_type
+from src.models.dialogue_session import DialogueSession, DialogueTurn
+from src.models.user import db
+
+# 最終更新からこの時間が経ったセッションは破棄する
+SESSION_TTL = timedelta(hours=float(os.getenv('DIALOGUE_SESSION_TTL_HOURS', 24)))
+
+# 会話履歴をサーバー側に保持するセッションストア
+# クライアントは session_id と新しい user_choice だけを送ればよい。
+# 戻り値はすべて素の dict / str で、呼び出し側の app context の外でも扱える。
+
+
+def new_session_id():
+    """create_session より先に ID が必要なとき（初期会話の生成中に使う場合など）に払い出す"""
+    return uuid.uuid4().hex
+
+
+def create_session(character_id, character_message=None, affection_level=None, session_id=None):
+    """セッションを作成して session_id を返す"""
+    _purge_expired()
+    session = DialogueSession(
+        id=session_id or new_session_id(),
+        character_id=character_id,
+        last_character_message=character_message,
+        affection_level=affection_level,
+    )
+    db.session.add(session)
+    db.session.commit()
+    return session.id
+
+
+def load_session(session_id):
+    """セッションと会話履歴を読み込む。存在しない・期限切れなら None"""
+    session = db.session.get(DialogueSession, session_id)
+    if session is None or session.updated_at < datetime.utcnow() - SESSION_TTL:
+        return None
+    turns = (
+        DialogueTurn.query
+        .filter_by(session_id=session_id)
+        .order_by(DialogueTurn.id)
+        .all()
+    )
+    return {
+        "session_id": session.id,
+        "character_id": session.character_id,
+        "character_message": session.last_character_message,
+        "affection_level": session.affection_level,
+        "history": [{"user": t.user_message, "character": t.character_message} for t in turns],
+    }
+
+
+def pending_turn(session, user_choice):
+    """直前のキャラクター発言への user_choice を、履歴に積む1ターンとして返す"""
+    if session["character_message"] is None or not user_choice:
+        return None
+    return {"user": user_choice, "character": session["character_message"]}
+
+
+def turn_affection(session, turn, requested=None, option_type=None):
+    """今回のターンの好感度
+
+    クライアントが affection_level を送ればそれを使う。送らなければ保存済みの値に、
+    選んだ選択肢の種類（option_type）の増減を足す（選択肢はサーバーが出したもの）。
+    """
+    if requested is not None:
+        return requested
+    if turn and option_type:
+        return affection_after(session["affection_level"], normalize_type(option_type))
+    return session["affection_level"]
+
+
+def history_with(session, turn):
+    """クライアントが従来送っていた conversation_history と同じ形の履歴"""
+    return session["history"] + [turn] if turn else session["history"]
+
+
+def record_turn(session_id, turn, character_message, affection_level=None):
+    """ターンを追記し、最新のキャラクター発言を更新する"""
+    session = db.session.get(DialogueSession, session_id)
+    if session is None:
+        return
+    if turn:
+        db.session.add(DialogueTurn(session_id=session_id, user_message=turn["user"], character_message=turn["character"]))
+    session.last_character_message = character_message
+    if affection_level is not None:
+        session.affection_level = affection_level
+    session.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _purge_expired():
+    cutoff = datetime.utcnow() - SESSION_TTL
+    expired = db.select(DialogueSession.id).where(DialogueSession.updated_at < cutoff)
+    DialogueTurn.query.filter(DialogueTurn.session_id.in_(expired)).delete(synchronize_session=False)
+    DialogueSession.query.filter(DialogueSession.updated_at < cutoff).delete(synchronize_session=False)
@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from src.completion_gate import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculativeReplies:
+    """選択肢を返した時点で、選ばれそうな選択肢ごとの次の発言を先に生成しておく
+
+    スロットは「選択肢を出した時点の会話」（キャラクター・直前の発言・履歴）ごとに1つで、
+    中身は {選択内容のキー: Future}。プレイヤーが選んだら take() で該当の1件を取り出し、
+    残りは破棄する（未着手のものは取り消す）。生成中なら完了を待つが、まだ実行待ちの列に
+    並んでいるだけなら取り消して外れ扱いにする（待つより呼び出し側で生成し直す方が早い）。
+    先読みの消費は tokens_per_minute の見積もりトークン数と workers の同時実行数で抑え、
+    上限を超える分は生成しない。
+    """
+
+    def __init__(self, generate, ttl=120, workers=4, tokens_per_minute=0, max_slots=10000):
+        self._generate = generate
+        self.workers = workers
+        self._slots = TTLCache(maxsize=max_slots, ttl=ttl)
+        self._budget = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self.started = 0
+        self.over_budget = 0
+        self.hits = 0
+        self.pending_hits = 0
+        self.misses = 0
+        self.failed = 0
+        self.discarded = 0
+
+    def _ensure_executor(self):
+        # スレッドは fork を越えて引き継がれないので、プロセスごとに作る
+        pid = os.getpid()
+        with self._lock:
+            if self._executor_pid != pid:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="speculative-reply")
+                self._executor_pid = pid
+            return self._executor
+
+    def speculate(self, slot, jobs):
+        """jobs は (キー, 見積もりトークン数, generate に渡す引数) のリスト。同じスロットの前回分は破棄する"""
+        executor = self._ensure_executor()
+        futures = {}
+        for key, cost, job in jobs:
+            if not self._budget.try_reserve(cost):
+                with self._lock:
+                    self.over_budget += 1
+                continue
+            futures[key] = executor.submit(self._generate, job)
+        with self._lock:
+            self.started += len(futures)
+            previous = self._slots.pop(slot, None)
+            if futures:
+                self._slots[slot] = futures
+        self._discard(previous)
+
+    def _discard(self, futures):
+        if not futures:
+            return
+        for future in futures.values():
+            future.cancel()
+        with self._lock:
+            self.discarded += len(futures)
+
+    def take(self, slot, key, timeout=None):
+        """先読みした発言を取り出す。なければ None（生成中なら timeout 秒まで待つ）"""
+        with self._lock:
+            futures = self._slots.pop(slot, None)
+        future = futures.pop(key, None) if futures else None
+        self._discard(futures)
+        # cancel() が通るのは未着手のものだけ
+        if future is None or future.cancel() or future.cancelled():
+            with self._lock:
+                self.misses += 1
+            return None
+
+        pending = not future.done()
+        try:
+            message = future.result(timeout=timeout)
+        except Exception as e:
+            logger.warning("Speculative reply unavailable: %s", e)
+            with self._lock:
+                self.failed += 1
+            return None
+        with self._lock:
+            if pending:
+                self.pending_hits += 1
+            else:
+                self.hits += 1
+        return message
+
+    def stats(self):
+        with self._lock:
+            return {
+                "slots": len(self._slots),
+                "started": self.started,
+                "over_budget": self.over_budget,
+                "hits": self.hits,
+                "pending_hits": self.pending_hits,
+                "misses": self.misses,
+                "failed": self.failed,
+                "discarded": self.discarded,
+            }
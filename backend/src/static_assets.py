@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from flask import current_app, request, send_file
+
+logger = logging.getLogger(__name__)
+
+# SPA の静的ファイル配信
+#
+# 起動時に static フォルダーを走査してマニフェストを作り、リクエストごとには
+# ファイルシステムを見ずにマニフェストから引く。scripts/precompress_static.py で
+# 作った .br / .gz があれば Accept-Encoding に合わせてそちらを返す。
+# 本体は send_file 経由で返すので ETag / Range / If-None-Match に対応し、
+# gunicorn では wsgi.file_wrapper による sendfile でコピーせずに送られる。
+#
+#   STATIC_IMMUTABLE_PATTERN=...  ファイル名にハッシュを含む（中身が変わらない）ファイルのパターン
+#                                 （既定は Vite の出力 assets/name-<hash>.ext）
+#   STATIC_IMMUTABLE_MAX_AGE=31536000
+
+_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+_IMMUTABLE_PATTERN = re.compile(os.getenv('STATIC_IMMUTABLE_PATTERN', r'(^|/)assets/.+-[A-Za-z0-9_-]{8,}\.\w+$'))
+_IMMUTABLE_MAX_AGE = int(os.getenv('STATIC_IMMUTABLE_MAX_AGE', 365*24*60*60))
+
+
+class StaticAsset:
+    __slots__ = ("path", "mimetype", "etag", "immutable", "variants")
+
+    def __init__(self, path, mimetype, etag, immutable, variants):
+        self.path = path
+        self.mimetype = mimetype
+        self.etag = etag
+        self.immutable = immutable
+        # [(Content-Encoding, パス, ETag)] を優先順に
+        self.variants = variants
+
+
+def _file_etag(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:20]
+
+
+def build_manifest(root):
+    """static フォルダー以下の全ファイルを {URLパス: StaticAsset} にまとめる"""
+    manifest = {}
+    if root is None or not os.path.isdir(root):
+        return manifest
+    for directory, _, files in os.walk(root):
+        names = set(files)
+        for name in files:
+            if any(name.endswith(suffix) and name[:-len(suffix)] in names for _, suffix in _ENCODINGS):
+                continue  # 圧縮済みの別表現は本体のエントリーにまとめる
+            path = os.path.join(directory, name)
+            url_path = os.path.relpath(path, root).replace(os.sep, '/')
+            etag = _file_etag(path)
+            variants = [
+                (encoding, path + suffix, f"{etag}-{suffix[1:]}")
+                for encoding, suffix in _ENCODINGS
+                if name + suffix in names
+            ]
+            manifest[url_path] = StaticAsset(
+                path=path,
+                mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                etag=etag,
+                immutable=bool(_IMMUTABLE_PATTERN.search(url_path)),
+                variants=variants,
+            )
+    logger.info("Static manifest: %d files (%d precompressed) in %s",
+                len(manifest), sum(1 for asset in manifest.values() if asset.variants), root)
+    return manifest
+
+
+def _send_asset(asset):
+    path, etag, encoding = asset.path, asset.etag, None
+    accepted = request.accept_encodings
+    for candidate, variant_path, variant_etag in asset.variants:
+        if accepted[candidate]:
+            path, etag, encoding = variant_path, variant_etag, candidate
+            break
+
+    response = send_file(path, mimetype=asset.mimetype, etag=etag, conditional=True)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if asset.variants:
+        response.vary.add('Accept-Encoding')
+    if asset.immutable:
+        response.headers['Cache-Control'] = f"public, max-age={_IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        # index.html などは毎回 ETag で再検証させ、新しいビルドをすぐ反映する
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def serve(path):
+    manifest = current_app.extensions['static_manifest']
+    asset = manifest.get(path) if path else None
+    if asset is not None:
+        return _send_asset(asset)
+    # 拡張子付きのパスは存在しないファイルなので index.html を返さない
+    if '.' in path.rsplit('/', 1)[-1]:
+        return "Not found", 404
+    index = manifest.get('index.html')
+    if index is None:
+        return "index.html not found", 404
+    return _send_asset(index)
+
+
+def init_app(app):
+    """マニフェストを作り、/ 以下のキャッチオールルートを登録する"""
+    app.extensions['static_manifest'] = build_manifest(app.static_folder)
+    app.add_url_rule('/', 'serve', serve, defaults={'path': ''})
+    app.add_url_rule('/<path:path>', 'serve', serve)
@@ -0,0 +1,9 @@
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from src.main import app
+
+# WSGIエントリーポイント
+#   gunicorn -c gunicorn.conf.py
+# （gunicorn.conf.py の wsgi_app = "src.wsgi:app"）
@@ -7,6 +7,7 @@ import brokenHeartIcon from './assets/broken-heart.png'
 import { getPrefectureFromLocation, getPrefectureImage, getDetailedAddress, formatAddress } from './utils/locationUtils.js'
 import { getBestStreetViewImage, getPrefectureLandmark } from './utils/streetViewUtils.js'
 import { API_ENDPOINTS } from './config/api.js'
+import { readServerSentEvents } from './utils/sseUtils.js'
 import './App.css'
 import { Routes, Route, useParams, useNavigate } from 'react-router-dom'
 
@@ -17,9 +18,12 @@ function CharacterChat() {
   const [message, setMessage] = useState('こんにちは！今日もお疲れさまです。')
   const [options, setOptions] = useState([])
   const [isLoading, setIsLoading] = useState(false)
+  // 次の発言をトークン単位で受信中（届いた分から表示する）
+  const [isStreaming, setIsStreaming] = useState(false)
   const [characterName, setCharacterName] = useState('')
   const [currentDateTime, setCurrentDateTime] = useState(new Date())
-  const [conversationHistory, setConversationHistory] = useState([])
+  // 会話履歴はサーバー側のセッションに保持し、毎ターン session_id と選択だけを送る
+  const [sessionId, setSessionId] = useState(null)
   const [isDialogueMode, setIsDialogueMode] = useState(false)
   const [effects, setEffects] = useState([])
   const [location, setLocation] = useState({ lat: null, lon: null });
@@ -194,36 +198,42 @@ function CharacterChat() {
     }
     setIsLoading(true)
     setIsDialogueMode(true)
-    setConversationHistory([])
+    setSessionId(null)
     try {
+      // 0. 会話履歴を保持するセッションを作成
+      const sessionRes = await fetch(API_ENDPOINTS.SESSIONS, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          character_id: currentCharacter.id,
+          affection_level: affectionLevel
+        })
+      })
+      if (!sessionRes.ok) throw new Error('セッション作成失敗')
+      const { session_id: newSessionId } = await sessionRes.json()
+      setSessionId(newSessionId)
       // 1. キャラクター発言のみ取得
       const charRes = await fetch(API_ENDPOINTS.DIALOGUE_CHARACTER, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
-          character_id: currentCharacter.id,
+          session_id: newSessionId,
           user_choice: '',
-          conversation_history: [],
           lat: location.lat,
-          lon: location.lon,
-          affection_level: affectionLevel
+          lon: location.lon
         })
       })
       if (!charRes.ok) throw new Error('キャラクター発言取得失敗')
       const charData = await charRes.json()
       setMessage(charData.message)
-      // 2. 4択選択肢のみ取得
+      // 2. 4択選択肢のみ取得（直前の発言はセッションから補われる）
       const optRes = await fetch(API_ENDPOINTS.DIALOGUE_OPTIONS, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
-          character_id: currentCharacter.id,
-          character_message: charData.message,
-          user_choice: '',
-          conversation_history: [],
+          session_id: newSessionId,
           lat: location.lat,
-          lon: location.lon,
-          affection_level: affectionLevel
+          lon: location.lon
         })
       })
       if (!optRes.ok) throw new Error('選択肢取得失敗')
@@ -291,8 +301,12 @@ function CharacterChat() {
       setMessage('キャラクターが選択されていません。');
       return;
     }
+    if (!sessionId) {
+      setMessage('会話が開始されていません。');
+      return;
+    }
     setIsLoading(true)
-    // 好感度を更新
+    // 好感度を更新（表示用。サーバーは option_type から同じ値を計算する）
     let newAffectionLevel = affectionLevel
     switch (option.type) {
       case 'v-good': newAffectionLevel = Math.min(100, affectionLevel + 10); break
@@ -302,53 +316,48 @@ function CharacterChat() {
     }
     setAffectionLevel(newAffectionLevel)
     showEffect(option.type)
-    const newHistory = [...conversationHistory, { user: option.text, character: message }]
-    setConversationHistory(newHistory)
     try {
-      // 1. キャラクター発言のみ取得
-      const charRes = await fetch(API_ENDPOINTS.DIALOGUE_CHARACTER, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          character_id: currentCharacter.id,
-          user_choice: option.text,
-          conversation_history: newHistory,
-          lat: location.lat,
-          lon: location.lon,
-          affection_level: newAffectionLevel
-        })
-      })
-      if (!charRes.ok) throw new Error('キャラクター発言取得失敗')
-      const charData = await charRes.json()
-      setMessage(charData.message)
-      // 2. 4択選択肢のみ取得
-      const optRes = await fetch(API_ENDPOINTS.DIALOGUE_OPTIONS, {
+      // 発言は SSE でトークン単位に受け取り、最後に選択肢を受け取る（履歴はサーバー側のセッションに積まれる）
+      const res = await fetch(API_ENDPOINTS.DIALOGUE_NEXT_STREAM, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
-          character_id: currentCharacter.id,
-          character_message: charData.message,
+          session_id: sessionId,
           user_choice: option.text,
-          conversation_history: newHistory,
+          option_type: option.type,
           lat: location.lat,
-          lon: location.lon,
-          affection_level: newAffectionLevel
+          lon: location.lon
         })
       })
-      if (!optRes.ok) throw new Error('選択肢取得失敗')
-      const optData = await optRes.json()
-      setOptions(optData.options)
+      if (!res.ok) throw new Error('キャラクター発言取得失敗')
+      let streamed = ''
+      let completed = false
+      for await (const { event, data } of readServerSentEvents(res)) {
+        if (event === 'delta') {
+          streamed += data.text
+          setIsStreaming(true)
+          setMessage(streamed)
+        } else if (event === 'options') {
+          completed = true
+          setMessage(data.message)
+          setOptions(data.options)
+        } else if (event === 'error') {
+          throw new Error(data.message)
+        }
+      }
+      if (!completed) throw new Error('選択肢取得失敗')
     } catch (error) {
       setMessage('次の会話の取得に失敗しました。')
       setOptions([])
     }
+    setIsStreaming(false)
     setIsLoading(false)
   }
 
   // 会話をリセットする
   const resetDialogue = () => {
     setIsDialogueMode(false)
-    setConversationHistory([])
+    setSessionId(null)
     setOptions([])
     setMessage('やっほー！今日もお疲れ！')
     setAffectionLevel(40) // 好感度を初期値にリセット
@@ -480,7 +489,7 @@ function CharacterChat() {
           {characterName}
         </div>
         <div className="message-text">
-          {isLoading ? (
+          {isLoading && !isStreaming ? (
             <span className="loading-dots"> </span>
           ) : (
             message
@@ -0,0 +1,41 @@
+/**
+ * fetch のレスポンス本文を Server-Sent Events として読み、到着順に返す
+ * （EventSource は POST を送れないので、ReadableStream を自前で区切る）
+ * @param {Response} response - text/event-stream のレスポンス
+ * @returns {AsyncGenerator<{event: string, data: any}>} イベント名と JSON を解析した data
+ */
+export async function* readServerSentEvents(response) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  try {
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      // イベントは空行で区切られる
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const parsed = parseEvent(buffer.slice(0, boundary));
+        buffer = buffer.slice(boundary + 2);
+        if (parsed) yield parsed;
+      }
+    }
+  } finally {
+    reader.releaseLock();
+  }
+}
+
+function parseEvent(block) {
+  let event = 'message';
+  const dataLines = [];
+  for (const line of block.split('\n')) {
+    if (line.startsWith('event:')) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith('data:')) {
+      dataLines.push(line.slice(5).replace(/^ /, ''));
+    }
+  }
+  if (dataLines.length === 0) return null;
+  return { event, data: JSON.parse(dataLines.join('\n')) };
+}